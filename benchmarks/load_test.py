@@ -0,0 +1,355 @@
+"""
+HTTP load test for the server
+
+Starts the server with gunicorn, as in the `Procfile`, using an SQLite
+database built from the output files as a stand-in for the elasticsearch
+index. A mix of reconciliation batches, searches, autocomplete prefixes and
+record lookups, made from records in the output file, is sent at a fixed
+concurrency. Throughput and latency percentiles for each route are written
+out as JSON, so that runs can be compared between releases:
+
+    python benchmarks/load_test.py data/output/all.jsonl.gz --concurrency 16 --duration 30 --output before.json
+    python benchmarks/load_test.py data/output/all.jsonl.gz --concurrency 16 --duration 30 --compare before.json
+
+Run it from the root of the repository.
+"""
+import argparse
+import gzip
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+from metrics import percentile  # noqa: E402
+
+# how often each kind of request is made, relative to the others
+DEFAULT_MIX = {
+    "reconcile_batch": 2,
+    "reconcile": 2,
+    "search": 3,
+    "autocomplete": 4,
+    "charity": 4,
+    "orgid": 2,
+}
+
+
+def load_sample(filename, size=5000):
+    """
+    Pick records from a gzipped JSON lines file to make requests from
+    """
+    sample = []
+    with gzip.open(filename, 'rt', encoding='utf8') as records:
+        for i, line in enumerate(records):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            item = {
+                "id": record["id"],
+                "name": record.get("known_as") or record["id"],
+                "orgids": record.get("org-ids") or [],
+            }
+            # reservoir sampling, so the sample is spread across the whole file
+            if len(sample) < size:
+                sample.append(item)
+            else:
+                j = random.randint(0, i)
+                if j < size:
+                    sample[j] = item
+    return sample
+
+
+class RequestMaker:
+    """
+    Creates the requests for each kind in the mix
+    """
+
+    def __init__(self, sample, batch_size=10):
+        self.sample = sample
+        self.batch_size = batch_size
+
+    def make(self, kind):
+        """
+        Returns `(method, path, body, headers)` for a random request of a kind
+        """
+        record = random.choice(self.sample)
+        if kind == "reconcile_batch":
+            queries = {
+                "q{}".format(i): {"query": r["name"]}
+                for i, r in enumerate(random.sample(self.sample, min(self.batch_size, len(self.sample))))
+            }
+            body = urllib.parse.urlencode({"queries": json.dumps(queries)})
+            return "POST", "/reconcile", body, {"Content-Type": "application/x-www-form-urlencoded"}
+        if kind == "reconcile":
+            return "GET", "/reconcile?" + urllib.parse.urlencode({"query": record["name"]}), None, {}
+        if kind == "search":
+            words = record["name"].split()
+            term = " ".join(words[:random.randint(1, max(1, len(words)))])
+            return "GET", "/?" + urllib.parse.urlencode({"q": term}), None, {}
+        if kind == "autocomplete":
+            prefix = record["name"][:random.randint(3, 8)]
+            return "GET", "/autocomplete?" + urllib.parse.urlencode({"q": prefix}), None, {}
+        if kind == "charity":
+            return "GET", "/charity/{}.json".format(urllib.parse.quote(record["id"])), None, {}
+        if kind == "orgid":
+            orgid = random.choice(record["orgids"]) if record["orgids"] else "GB-CHC-" + record["id"]
+            return "GET", "/orgid/{}.json".format(urllib.parse.quote(orgid)), None, {}
+        raise ValueError("Unknown kind of request: {}".format(kind))
+
+
+def build_database(source, target):
+    """
+    Build the SQLite stand-in for the elasticsearch index with `server/storage.py`
+    """
+    subprocess.check_call([sys.executable, os.path.join("server", "storage.py"), source, target])
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(database, port, workers, threads):
+    """
+    Start the server with gunicorn and wait until it responds
+    """
+    env = dict(os.environ, SQLITE_DB=database)
+    for e_v in ["ELASTICSEARCH_URL", "ES_URL", "BONSAI_URL", "SLOW_QUERY_LOG"]:
+        env.pop(e_v, None)
+    process = subprocess.Popen([
+        sys.executable, "-m", "gunicorn", "--pythonpath", "server", "server:application",
+        "--bind", "127.0.0.1:{}".format(port),
+        "--workers", str(workers), "--threads", str(threads),
+        "--log-level", "warning",
+    ], env=env)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Server stopped with exit code {}".format(process.returncode))
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", "/about")
+            conn.getresponse().read()
+            conn.close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("Server didn't start")
+
+
+class LoadTest:
+    """
+    Sends requests from `concurrency` threads, each with a keep-alive connection
+    """
+
+    def __init__(self, host, port, maker, mix, concurrency=8, timeout=30):
+        self.host = host
+        self.port = port
+        self.maker = maker
+        self.kinds = list(mix.keys())
+        self.weights = [mix[k] for k in self.kinds]
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.recording = False
+
+    def worker(self, stop_at, requests_left):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        while time.monotonic() < stop_at:
+            if requests_left is not None:
+                with self.lock:
+                    if requests_left[0] <= 0:
+                        break
+                    requests_left[0] -= 1
+            kind = random.choices(self.kinds, self.weights)[0]
+            method, path, body, headers = self.maker.make(kind)
+            start = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                res = conn.getresponse()
+                res.read()
+                failed = res.status >= 400
+            except (OSError, http.client.HTTPException):
+                failed = True
+                conn.close()
+                conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            elapsed = time.perf_counter() - start
+            if not self.recording:
+                continue
+            with self.lock:
+                self.latencies[kind].append(elapsed)
+                if failed:
+                    self.errors[kind] += 1
+        conn.close()
+
+    def run(self, duration, requests=None, recording=True):
+        """
+        Send requests for `duration` seconds (or until `requests` have been sent)
+
+        Returns the number of seconds taken.
+        """
+        self.recording = recording
+        requests_left = [requests] if requests else None
+        stop_at = time.monotonic() + duration
+        start = time.perf_counter()
+        threads = [
+            threading.Thread(target=self.worker, args=(stop_at, requests_left))
+            for _ in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    def report(self, elapsed):
+        """
+        Throughput and latency for each kind of request, and for all of them
+        """
+        def summary(latencies, errors):
+            return {
+                "requests": len(latencies),
+                "errors": errors,
+                "rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+                "mean_ms": round(1000 * sum(latencies) / len(latencies), 2) if latencies else None,
+                "p50_ms": _ms(percentile(latencies, 50)),
+                "p95_ms": _ms(percentile(latencies, 95)),
+                "p99_ms": _ms(percentile(latencies, 99)),
+                "max_ms": _ms(max(latencies) if latencies else None),
+            }
+
+        routes = {kind: summary(self.latencies[kind], self.errors[kind]) for kind in sorted(self.latencies)}
+        everything = [l for kind in self.latencies for l in self.latencies[kind]]
+        return {"routes": routes, "total": summary(everything, sum(self.errors.values()))}
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def parse_mix(mix):
+    """
+    Parse a request mix like `search=3,autocomplete=4`
+    """
+    if not mix:
+        return dict(DEFAULT_MIX)
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in DEFAULT_MIX:
+            raise ValueError("Unknown kind of request: {}".format(kind))
+        weights[kind.strip()] = float(weight or 1)
+    return weights
+
+
+def git_version():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, previous):
+    """
+    Print the change in throughput and latency from a previous run
+    """
+    print("{:<16} {:>12} {:>12} {:>12}".format("route", "rps", "p50 ms", "p95 ms"))
+    for kind, stats in sorted(result["routes"].items()) + [("total", result["total"])]:
+        before = previous["total"] if kind == "total" else previous["routes"].get(kind)
+        if not before:
+            continue
+        print("{:<16} {:>12} {:>12} {:>12}".format(kind, *[
+            "{:+.1f}%".format(100 * (stats[key] - before[key]) / before[key]) if before.get(key) else "-"
+            for key in ["rps", "p50_ms", "p95_ms"]
+        ]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the server with a mix of requests')
+    parser.add_argument('data', help='gzipped JSON lines file of records (eg data/output/all.jsonl.gz)')
+    parser.add_argument('--sqlite', help='SQLite database to use, built from the data file if it doesn\'t exist (default: next to the data file)')
+    parser.add_argument('--url', help='test a server that is already running instead of starting one (eg http://localhost:8080)')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=4, help='gunicorn threads per worker')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of requests to make at the same time')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run the test for')
+    parser.add_argument('--requests', type=int, help='stop after this many requests')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of requests to make before recording')
+    parser.add_argument('--mix', help='relative number of each kind of request, eg "search=3,autocomplete=4" (kinds: {})'.format(
+        ", ".join(DEFAULT_MIX)))
+    parser.add_argument('--batch-size', type=int, default=10, help='number of queries in each reconciliation batch')
+    parser.add_argument('--sample-size', type=int, default=5000, help='number of records to make requests from')
+    parser.add_argument('--seed', type=int, help='random seed, so the same requests are made each run')
+    parser.add_argument('--output', help='file to write the results to as JSON (default: print them)')
+    parser.add_argument('--compare', help='results of a previous run to compare with')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    mix = parse_mix(args.mix)
+    maker = RequestMaker(load_sample(args.data, args.sample_size), batch_size=args.batch_size)
+
+    process = None
+    if args.url:
+        url = urllib.parse.urlparse(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        database = args.sqlite or os.path.join(os.path.dirname(args.data), "benchmark.sqlite")
+        if not os.path.exists(database):
+            build_database(args.data, database)
+        host, port = "127.0.0.1", free_port()
+        process = start_server(database, port, args.workers, args.threads)
+
+    try:
+        test = LoadTest(host, port, maker, mix, concurrency=args.concurrency)
+        if args.warmup:
+            print("[benchmark] warming up for {} seconds".format(args.warmup), file=sys.stderr)
+            test.run(args.warmup, recording=False)
+        print("[benchmark] running for {} seconds with concurrency {}".format(
+            args.duration, args.concurrency), file=sys.stderr)
+        elapsed = test.run(args.duration, args.requests)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    result = test.report(elapsed)
+    result["config"] = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "version": git_version(),
+        "url": args.url,
+        "workers": None if args.url else args.workers,
+        "threads": None if args.url else args.threads,
+        "concurrency": args.concurrency,
+        "seconds": round(elapsed, 2),
+        "mix": mix,
+        "batch_size": args.batch_size,
+        "seed": args.seed,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as output:
+            json.dump(result, output, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+    if args.compare:
+        with open(args.compare, encoding="utf8") as previous:
+            compare(result, json.load(previous))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+"""
+Parallel bulk indexing for elasticsearch
+
+`BulkIndexer` sends documents in bulk requests from several worker threads.
+The number of documents in each request is adjusted so that requests take
+around `target_seconds`, without going over `max_chunk_bytes`. Documents
+rejected because the cluster is busy (429 or `es_rejected_execution`) are
+sent again after an exponential backoff. Anything that still fails is
+written to a dead letter JSON lines file, which can be sent again with:
+
+    python data_import/bulk_indexer.py data/bulk_failures.jsonl
+"""
+import argparse
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionTimeout, ConnectionError as ESConnectionError, TransportError
+from elasticsearch.helpers import expand_action
+
+# response codes that mean the cluster is too busy and the request should be sent again later
+RETRY_STATUS = (429, 502, 503, 504)
+
+
+def is_rejection(item):
+    """
+    Whether the result for one document in a bulk response means it should be sent again
+    """
+    error = item.get("error")
+    if item.get("status") in RETRY_STATUS:
+        return True
+    return isinstance(error, dict) and error.get("type") == "es_rejected_execution_exception"
+
+
+class BulkIndexer:
+    """
+    Index documents with bulk requests from `workers` threads
+
+    Requests start with `chunk_size` documents, which is doubled or halved
+    (within `min_chunk_size` and `max_chunk_size`) depending on whether a
+    request took much less or more than `target_seconds`, and halved when
+    the cluster rejects documents. Chunks are queued for the workers in a
+    bounded queue, so documents aren't read faster than they can be sent.
+    """
+
+    def __init__(self, es, workers=4, chunk_size=500, min_chunk_size=50, max_chunk_size=5000,
+                 max_chunk_bytes=10 * 1024 * 1024, target_seconds=2.0, max_retries=5,
+                 initial_backoff=1, max_backoff=60, request_timeout=60, dead_letter=None,
+                 report_every=5, label="elasticsearch"):
+        self.es = es
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.target_seconds = target_seconds
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.request_timeout = request_timeout
+        self.dead_letter = dead_letter
+        self.report_every = report_every
+        self.label = label
+
+        self.lock = threading.Lock()
+        self.dead_letter_file = None
+        self.failed_ids = set()
+        self.stats = {
+            "indexed": 0,
+            "failed": 0,
+            "retried": 0,
+            "requests": 0,
+            "bytes": 0,
+        }
+
+    def index(self, actions):
+        """
+        Send the documents, and wait until they have all been sent
+
+        `actions` are documents in the format used by `elasticsearch.helpers.bulk`.
+        Returns a dictionary of counts. The dead letter file is emptied first,
+        so it only holds the documents that failed in this run.
+        """
+        if self.dead_letter and os.path.exists(self.dead_letter):
+            os.remove(self.dead_letter)
+
+        chunks = queue.Queue(maxsize=self.workers * 2)
+        threads = [threading.Thread(target=self._worker, args=(chunks,), daemon=True)
+                   for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        self.start = time.perf_counter()
+        last_report = self.start
+        serializer = self.es.transport.serializer
+        chunk = []
+        chunk_bytes = 0
+        try:
+            for action in actions:
+                action, data = expand_action(action)
+                lines = [serializer.dumps(action)]
+                if data is not None:
+                    lines.append(serializer.dumps(data))
+                size = sum(len(line.encode("utf8")) + 1 for line in lines)
+                if chunk and (len(chunk) >= self.chunk_size or chunk_bytes + size > self.max_chunk_bytes):
+                    chunks.put(chunk)
+                    chunk = []
+                    chunk_bytes = 0
+                chunk.append(lines)
+                chunk_bytes += size
+
+                if time.perf_counter() - last_report > self.report_every:
+                    self.report(end='')
+                    last_report = time.perf_counter()
+            if chunk:
+                chunks.put(chunk)
+        finally:
+            for _ in threads:
+                chunks.put(None)
+            for thread in threads:
+                thread.join()
+            if self.dead_letter_file:
+                self.dead_letter_file.close()
+                self.dead_letter_file = None
+
+        self.report()
+        if self.stats["failed"] and self.dead_letter:
+            print('\r', "[{}] documents that failed are in {}".format(self.label, self.dead_letter))
+        self.stats["seconds"] = round(time.perf_counter() - self.start, 2)
+        return self.stats
+
+    def report(self, end='\n'):
+        """
+        Print the number of documents sent and the rate they are being sent at
+        """
+        elapsed = max(time.perf_counter() - self.start, 0.001)
+        print('\r', "[{}] {} documents indexed, {} failed ({:.0f} docs/s, {:.2f} MB/s, {} per request)".format(
+            self.label, self.stats["indexed"], self.stats["failed"],
+            self.stats["indexed"] / elapsed, self.stats["bytes"] / elapsed / 1024 / 1024,
+            self.chunk_size), end=end)
+
+    def _worker(self, chunks):
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            try:
+                self._send(chunk)
+            except Exception as error:
+                # keep the worker going, or the queue would fill up and stop the import
+                self._failed(chunk, repr(error))
+
+    def _send(self, chunk):
+        """
+        Send a chunk of documents, sending rejected documents again until they succeed or run out of retries
+        """
+        attempt = 0
+        while chunk:
+            body = "".join(line + "\n" for lines in chunk for line in lines)
+            start = time.perf_counter()
+            try:
+                res = self.es.bulk(body=body, request_timeout=self.request_timeout)
+            except (ConnectionTimeout, ESConnectionError, TransportError) as error:
+                status = getattr(error, "status_code", None)
+                retry = isinstance(error, (ConnectionTimeout, ESConnectionError)) or status in RETRY_STATUS
+                if not retry or attempt >= self.max_retries:
+                    self._failed(chunk, repr(error))
+                    return
+                self._resize(busy=True)
+                attempt = self._backoff(attempt, len(chunk))
+                continue
+
+            elapsed = time.perf_counter() - start
+            retry = []
+            indexed = 0
+            for lines, item in zip(chunk, res["items"]):
+                result = list(item.values())[0]
+                if result.get("status", 500) < 300 or (result.get("status") == 404 and "delete" in item):
+                    indexed += 1
+                elif is_rejection(result) and attempt < self.max_retries:
+                    retry.append(lines)
+                else:
+                    self._failed([lines], result.get("error") or result.get("status"))
+
+            with self.lock:
+                self.stats["indexed"] += indexed
+                self.stats["requests"] += 1
+                self.stats["bytes"] += len(body.encode("utf8"))
+            self._resize(busy=bool(retry), elapsed=elapsed)
+            chunk = retry
+            if chunk:
+                attempt = self._backoff(attempt, len(chunk))
+
+    def _backoff(self, attempt, count):
+        with self.lock:
+            self.stats["retried"] += count
+        time.sleep(min(self.max_backoff, self.initial_backoff * 2 ** attempt) * random.uniform(0.5, 1))
+        return attempt + 1
+
+    def _resize(self, busy=False, elapsed=None):
+        """
+        Make the chunks smaller if the cluster is busy or slow, or bigger if it is quick
+        """
+        with self.lock:
+            if busy or (elapsed is not None and elapsed > self.target_seconds * 1.5):
+                self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+            elif elapsed is not None and elapsed < self.target_seconds / 2:
+                self.chunk_size = min(self.max_chunk_size, self.chunk_size * 2)
+
+    def _failed(self, chunk, error):
+        """
+        Write documents that couldn't be indexed to the dead letter file
+        """
+        actions = [json.loads(lines[0]) for lines in chunk]
+        with self.lock:
+            self.stats["failed"] += len(chunk)
+            self.failed_ids.update(list(action.values())[0].get("_id") for action in actions)
+            if not self.dead_letter:
+                return
+            if self.dead_letter_file is None:
+                self.dead_letter_file = open(self.dead_letter, "a", encoding="utf8")
+            for action, lines in zip(actions, chunk):
+                self.dead_letter_file.write(json.dumps({
+                    "action": action,
+                    "source": json.loads(lines[1]) if len(lines) > 1 else None,
+                    "error": error,
+                }) + "\n")
+
+
+def read_dead_letter(filename):
+    """
+    Read the documents in a dead letter file, in the format used by `elasticsearch.helpers.bulk`
+    """
+    with open(filename, encoding="utf8") as dead_letter:
+        for line in dead_letter:
+            if not line.strip():
+                continue
+            failure = json.loads(line)
+            op_type, meta = list(failure["action"].items())[0]
+            action = dict(meta, _op_type=op_type)
+            if failure.get("source") is not None:
+                action["_source"] = failure["source"]
+            yield action
+
+
+def main():
+    """
+    Send the documents in a dead letter file to elasticsearch again
+    """
+    parser = argparse.ArgumentParser(description='Send documents that failed to index to elasticsearch again')
+    parser.add_argument('dead_letter', help='dead letter file written by the import')
+
+    # elasticsearch options
+    parser.add_argument('--es-host', default="localhost", help='host for the elasticsearch instance')
+    parser.add_argument('--es-port', default=9200, help='port for the elasticsearch instance')
+    parser.add_argument('--es-url-prefix', default='', help='Elasticsearch url prefix')
+    parser.add_argument('--es-use-ssl', action='store_true', help='Use ssl to connect to elasticsearch')
+    parser.add_argument('--bulk-workers', type=int, default=4, help='Number of bulk requests to send at the same time')
+    parser.add_argument('--chunk-size', type=int, default=500, help='Number of documents to start sending in each request')
+
+    args = parser.parse_args()
+
+    es = Elasticsearch(host=args.es_host, port=args.es_port, url_prefix=args.es_url_prefix, use_ssl=args.es_use_ssl)
+
+    potential_env_vars = [
+        "ELASTICSEARCH_URL",
+        "ES_URL",
+        "BONSAI_URL"
+    ]
+    for e_v in potential_env_vars:
+        if os.environ.get(e_v):
+            es = Elasticsearch(os.environ.get(e_v))
+            break
+
+    # documents that fail again are written to a new file, so the old one can be read safely
+    retry_file = args.dead_letter + ".retry"
+    if os.path.exists(retry_file):
+        os.remove(retry_file)
+    indexer = BulkIndexer(es, workers=args.bulk_workers, chunk_size=args.chunk_size, dead_letter=retry_file)
+    stats = indexer.index(read_dead_letter(args.dead_letter))
+    if stats["failed"]:
+        os.replace(retry_file, args.dead_letter)
+        print("[elasticsearch] {} documents failed again and are in {}".format(stats["failed"], args.dead_letter))
+    else:
+        os.remove(args.dead_letter)
+        print("[elasticsearch] all documents indexed, {} removed".format(args.dead_letter))
+
+
+if __name__ == '__main__':
+    main()
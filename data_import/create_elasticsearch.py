@@ -1,7 +1,15 @@
 import argparse
+import datetime
+import re
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import NotFoundError, RequestError
 import os
 
+# settings used while an index is being built, and the ones given to it once it has
+# been loaded if there isn't already a live index to copy them from
+BUILD_SETTINGS = {"number_of_replicas": 0, "refresh_interval": "-1"}
+LIVE_SETTINGS = {"number_of_replicas": 1, "refresh_interval": "1s"}
+
 
 INDEXES = [
     {
@@ -26,6 +34,13 @@ INDEXES = [
                     },
                     "complete_names": {
                         "type": "completion"
+                    },
+                    # org-ids are looked up exactly, using the keyword field
+                    "org-ids": {
+                        "type": "string",
+                        "fields": {
+                            "keyword": {"type": "keyword"}
+                        }
                     }
                 }
             }
@@ -34,12 +49,180 @@ INDEXES = [
 ]
 
 
+def set_mapping(es, index, es_type):
+    """
+    Put the charity mapping on an index
+    """
+    mapping = INDEXES[0]["mapping"][1]
+    es.indices.put_mapping(es_type, mapping, index=index)
+    print("[elasticsearch] set mapping on %s index" % index)
+
+
+def alias_indexes(es, alias):
+    """
+    Names of the indexes an alias points to
+    """
+    try:
+        return sorted(es.indices.get_alias(name=alias).keys())
+    except NotFoundError:
+        return []
+
+
+def generations(es, alias):
+    """
+    Names of the indexes built for an alias, oldest first
+    """
+    try:
+        indexes = es.indices.get(index=alias + "_*").keys()
+    except NotFoundError:
+        return []
+    # the names end in a timestamp, so sort in the order they were built
+    return sorted(i for i in indexes if re.match(re.escape(alias) + r"_\d{14}$", i))
+
+
+def live_settings(es, alias, exclude=None):
+    """
+    The replicas and refresh interval of the index `alias` searches now
+
+    `exclude` is an index to ignore (the one being published). Falls back to
+    `LIVE_SETTINGS` if there isn't a live index, or for settings it doesn't have.
+    """
+    current = [i for i in alias_indexes(es, alias) if i != exclude]
+    if current:
+        index = current[-1]
+    elif alias != exclude and es.indices.exists(alias) and not es.indices.exists_alias(name=alias):
+        index = alias
+    else:
+        return dict(LIVE_SETTINGS)
+    settings = es.indices.get_settings(index=index)[index]["settings"]["index"]
+    return {k: settings.get(k, v) for k, v in LIVE_SETTINGS.items()}
+
+
+def create_build_index(es, alias="charitysearch", es_type="charity"):
+    """
+    Create a new index for `alias`, with settings for loading it quickly
+
+    The index is named after the alias and the current time, and has no
+    replicas and no refreshes until `publish_index` is used.
+    """
+    index = "{}_{}".format(alias, datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S"))
+    print("[elasticsearch] creating '%s' index..." % index)
+    es.indices.create(index=index, body={"settings": BUILD_SETTINGS})
+    set_mapping(es, index, es_type)
+    return index
+
+
+def publish_index(es, index, alias="charitysearch", keep=2, replicas=None, replace_index=False):
+    """
+    Make a built index ready for searching and move `alias` onto it
+
+    The index gets the replicas and refresh interval of the index the alias
+    points to now (see `live_settings`), or `replicas` if it is given, and is
+    force merged before the alias is moved in one request. The newest `keep`
+    previous indexes are kept for `rollback`, and older ones are deleted.
+
+    If there is an ordinary index with the alias's name (from before aliases
+    were used) it is replaced by the alias in the same request. Versions of
+    elasticsearch that can't do that need `replace_index`, which deletes the
+    index first, leaving a moment with no index.
+    """
+    settings = live_settings(es, alias, exclude=index)
+    if replicas is not None:
+        settings["number_of_replicas"] = replicas
+    print("[elasticsearch] restoring settings on '%s' index" % index)
+    es.indices.put_settings(index=index, body={"index": settings})
+    es.indices.refresh(index=index)
+    print("[elasticsearch] force merging '%s' index" % index)
+    es.indices.forcemerge(index=index, max_num_segments=1, request_timeout=600)
+    es.cluster.health(index=index, wait_for_status="yellow", timeout="600s", request_timeout=600)
+
+    if es.indices.exists(alias) and not es.indices.exists_alias(name=alias):
+        replace_with_alias(es, alias, index, replace_index)
+    else:
+        swap_alias(es, alias, index)
+    prune_generations(es, alias, keep)
+
+
+def replace_with_alias(es, alias, index, replace_index=False):
+    """
+    Replace the ordinary index named `alias` with an alias pointing at `index`
+    """
+    try:
+        es.indices.update_aliases(body={"actions": [
+            {"remove_index": {"index": alias}},
+            {"add": {"index": index, "alias": alias}},
+        ]})
+        print("[elasticsearch] replaced '%s' index with an alias pointing to '%s' index" % (alias, index))
+        return
+    except RequestError:
+        # remove_index isn't supported by this version of elasticsearch
+        if not replace_index:
+            raise ValueError(
+                "'{alias}' is an index rather than an alias, and can't be replaced in one step. "
+                "To delete it and create the alias (leaving a moment with no index), run once: "
+                "python data_import/create_elasticsearch.py --publish {index} --replace-index".format(
+                    alias=alias, index=index))
+    print("[elasticsearch] deleting '%s' index so it can be used as an alias" % alias)
+    es.indices.delete(index=alias)
+    swap_alias(es, alias, index)
+
+
+def swap_alias(es, alias, index):
+    """
+    Point `alias` at `index` instead of the indexes it currently points to, in one request
+    """
+    actions = [{"remove": {"index": i, "alias": alias}} for i in alias_indexes(es, alias) if i != index]
+    actions.append({"add": {"index": index, "alias": alias}})
+    es.indices.update_aliases(body={"actions": actions})
+    print("[elasticsearch] '%s' now points to '%s' index" % (alias, index))
+
+
+def prune_generations(es, alias, keep=2):
+    """
+    Delete the indexes built for `alias` apart from the current one and the newest `keep` before it
+    """
+    current = set(alias_indexes(es, alias))
+    previous = [i for i in generations(es, alias) if i not in current]
+    old = previous[:-keep] if keep > 0 else previous
+    for index in old:
+        print("[elasticsearch] deleting old '%s' index" % index)
+        es.indices.delete(index=index)
+    return old
+
+
+def rollback(es, alias="charitysearch"):
+    """
+    Point `alias` back at the index built before the one it points to now
+    """
+    current = alias_indexes(es, alias)
+    built = generations(es, alias)
+    previous = [i for i in built if current and i < min(current)]
+    if not previous:
+        raise ValueError("No earlier index to roll '%s' back to" % alias)
+    swap_alias(es, alias, previous[-1])
+    return previous[-1]
+
+
 def main():
 
     parser = argparse.ArgumentParser(description='Setup elasticsearch indexes.')
     parser.add_argument('--reset', action='store_true',
                         help='If set, any existing indexes will be deleted and recreated.')
 
+    # versioned indexes behind an alias
+    parser.add_argument('--build', action='store_true',
+                        help='Create a new index to import into, to be published with --publish')
+    parser.add_argument('--publish', default=None, metavar='INDEX',
+                        help='Get a built index ready for searching and point the alias at it')
+    parser.add_argument('--rollback', action='store_true',
+                        help='Point the alias back at the index built before the current one')
+    parser.add_argument('--keep', type=int, default=2,
+                        help='Number of previous indexes to keep for rolling back')
+    parser.add_argument('--replace-index', action='store_true',
+                        help='With --publish, delete an ordinary index with the alias\'s name if it can\'t be replaced in one step')
+    parser.add_argument('--replicas', type=int, default=None,
+                        help='Number of replicas for a published index (default: the same as the index it replaces)')
+
     # elasticsearch options
     parser.add_argument('--es-host', default="localhost", help='host for the elasticsearch instance')
     parser.add_argument('--es-port', default=9200, help='port for the elasticsearch instance')
@@ -62,10 +245,25 @@ def main():
             es = Elasticsearch(os.environ.get(e_v))
             break
 
+    if args.build:
+        index = create_build_index(es, args.es_index, args.es_type)
+        print("[elasticsearch] import into '%s' index then run with --publish %s" % (index, index))
+        return
+    if args.publish:
+        publish_index(es, args.publish, args.es_index, keep=args.keep, replicas=args.replicas,
+                      replace_index=args.replace_index)
+        return
+    if args.rollback:
+        rollback(es, args.es_index)
+        return
+
     INDEXES[0]["name"] = args.es_index
     INDEXES[0]["mapping"][0] = args.es_type
 
     for i in INDEXES:
+        if args.reset and es.indices.exists_alias(name=i["name"]):
+            # deleting an alias would delete every index it points to
+            raise ValueError("'%s' is an alias, use --build to replace the index behind it" % i["name"])
         if es.indices.exists(i["name"]) and args.reset:
             print("[elasticsearch] deleting '%s' index..." % (i["name"]))
             res = es.indices.delete(index=i["name"])
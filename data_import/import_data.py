@@ -4,7 +4,7 @@ import gzip
 import io
 import json
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk, scan
+from elasticsearch.helpers import scan
 from elasticsearch.exceptions import NotFoundError
 import validators
 from urllib.parse import urlparse
@@ -13,8 +13,18 @@ import os
 import titlecase
 import datetime
 import math
+import itertools
+import shutil
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import xlsxwriter
 
+from spill_store import SpillStore
+from bulk_indexer import BulkIndexer
+from record_hashes import HashStore
+from create_elasticsearch import create_build_index, publish_index
+
 
 def title_exceptions(word, **kwargs):
 
@@ -121,24 +131,108 @@ def parse_postcode(postcode):
     return "%s %s" % ("".join(first_part), "".join(last_part))
 
 
+POSTCODE_AREAS = ["hro", "wz11", "bua11", "pct", "lsoa11", "nuts", "msoa11", "laua",
+                  "oa11", "ccg", "ward", "teclec", "gor", "ttwa", "pfa", "pcon",
+                  "lep1", "cty", "eer", "ctry", "park", "lep2", "hlthau", "buasd11"]
+
+
+def postcode_result(res):
+    """
+    Location and areas from a postcode document, or None if it wasn't found
+    """
+    if res.get('found'):
+        return (res['_source'].get("location"),
+                {k: res['_source'].get(k) for
+                 k in res['_source'] if k in POSTCODE_AREAS})
+
+
 def fetch_postcode(postcode, es, es_index="postcode", es_type="postcode"):
     if postcode is None:
         return None
 
-    areas = ["hro", "wz11", "bua11", "pct", "lsoa11", "nuts", "msoa11", "laua",
-             "oa11", "ccg", "ward", "teclec", "gor", "ttwa", "pfa", "pcon",
-             "lep1", "cty", "eer", "ctry", "park", "lep2", "hlthau", "buasd11"]
     try:
         res = es.get(index=es_index, doc_type=es_type,
                      id=postcode, ignore=[404])
-        if res['found']:
-            return (res['_source'].get("location"),
-                    {k: res['_source'].get(k) for
-                     k in res['_source'] if k in areas})
+        return postcode_result(res)
     except (NotFoundError, ValueError):
         return None
 
 
+def fetch_postcodes(postcodes, es, es_index="postcode", es_type="postcode"):
+    """
+    Look up several postcodes with one request, returning a dictionary of postcode -> location and areas
+    """
+    try:
+        res = es.mget(index=es_index, doc_type=es_type, body={"ids": postcodes})
+    except NotFoundError:
+        return {p: None for p in postcodes}
+    return {doc["_id"]: postcode_result(doc) for doc in res["docs"]}
+
+
+class PostcodeLookup:
+    """
+    Looks up postcodes in batches, remembering the `cache_size` most recently used
+
+    Each batch of postcodes is split into `mget_size` postcodes per request,
+    and `workers` requests are sent at the same time.
+    """
+
+    def __init__(self, es, es_index="postcode", es_type="postcode", cache_size=50000, mget_size=500, workers=4):
+        self.es = es
+        self.es_index = es_index
+        self.es_type = es_type
+        self.cache_size = cache_size
+        self.mget_size = mget_size
+        self.workers = workers
+        self.cache = OrderedDict()
+        self.stats = {"lookups": 0, "hits": 0, "found": 0, "requests": 0, "seconds": 0.0}
+
+    def lookup(self, postcodes):
+        """
+        Location and areas of each postcode, as a dictionary
+        """
+        postcodes = [p for p in postcodes if p]
+        self.stats["lookups"] += len(postcodes)
+        results = {}
+        missing = []
+        for p in postcodes:
+            if p in results:
+                self.stats["hits"] += 1
+            elif p in self.cache:
+                self.stats["hits"] += 1
+                self.cache.move_to_end(p)
+                results[p] = self.cache[p]
+            else:
+                # placeholder so repeats within the batch count as hits
+                results[p] = None
+                missing.append(p)
+
+        if missing:
+            start = time.perf_counter()
+            batches = [missing[i:i + self.mget_size] for i in range(0, len(missing), self.mget_size)]
+            with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(batches)))) as executor:
+                for found in executor.map(
+                        lambda b: fetch_postcodes(b, self.es, self.es_index, self.es_type), batches):
+                    results.update(found)
+            self.stats["requests"] += len(batches)
+            self.stats["seconds"] += time.perf_counter() - start
+            for p in missing:
+                if results.get(p):
+                    self.stats["found"] += 1
+                self.cache[p] = results.get(p)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return results
+
+    def report(self):
+        lookups = max(self.stats["lookups"], 1)
+        unique = max(self.stats["lookups"] - self.stats["hits"], 1)
+        print('\r', "[Geo] {} postcodes looked up, {:.0%} from cache, {:.0%} of the rest found, "
+                    "in {} requests taking {:.1f} seconds".format(
+                        self.stats["lookups"], self.stats["hits"] / lookups, self.stats["found"] / unique,
+                        self.stats["requests"], self.stats["seconds"]))
+
+
 def parse_company_number(coyno):
     coyno = coyno.strip()
     if coyno == "":
@@ -677,27 +771,44 @@ def import_ccni(chars={},
     return chars
 
 
-def clean_chars(chars={}, pc_es=None, es_pc_index="postcode", es_pc_type="postcode"):
-
+def clean_chars(chars):
+    """
+    Prepare each record for indexing, one at a time
+    """
     ccount = 0
-    geocount = 0
-    for c in chars:
-        if pc_es:
-            geo_data = fetch_postcode(chars[c]["geo"]["postcode"], pc_es, es_pc_index, es_pc_type)
-            if geo_data:
-                chars[c]["geo"]["location"] = geo_data[0]
-                chars[c]["geo"]["areas"] = geo_data[1]
-                geocount += 1
-
-        chars[c] = clean_char(chars[c])
+    for char in chars:
+        yield clean_char(char)
 
         ccount += 1
         if ccount % 10000 == 0:
             print('\r', "[Prepare] %s charites prepared for indexing" % ccount, end='')
     print('\r', "[Prepare] %s charites prepared for indexing" % ccount)
-    print('\r', "[Geo] %s charites added location details" % geocount)
 
-    return chars
+
+def geocode_chars(chars, pc_es, es_pc_index="postcode", es_pc_type="postcode", chunk_size=2000,
+                  cache_size=50000, workers=4):
+    """
+    Add the location and areas of each record's postcode, `chunk_size` records at a time
+
+    The postcodes in each chunk are looked up together, using `PostcodeLookup`.
+    """
+    lookup = PostcodeLookup(pc_es, es_pc_index, es_pc_type, cache_size=cache_size, workers=workers)
+    geocount = 0
+    chars = iter(chars)
+    while True:
+        chunk = list(itertools.islice(chars, chunk_size))
+        if not chunk:
+            break
+        geo_data = lookup.lookup([char["geo"]["postcode"] for char in chunk])
+        for char in chunk:
+            char_geo = geo_data.get(char["geo"]["postcode"])
+            if char_geo:
+                char["geo"]["location"] = char_geo[0]
+                char["geo"]["areas"] = char_geo[1]
+                geocount += 1
+            yield char
+    print('\r', "[Geo] %s charites added location details" % geocount)
+    lookup.report()
 
 def clean_char(char):
     
@@ -708,7 +819,8 @@ def clean_char(char):
     if not char["known_as"]:
         char["known_as"] = char["names"][0]["name"]
 
-    names = list(set([n["name"] for n in char["names"]
+    # sorted so the record is the same each time it is imported
+    names = sorted(set([n["name"] for n in char["names"]
                 if n["name"] != char["known_as"] and n["name"]]))
 
     char["alt_names"] = names
@@ -724,7 +836,7 @@ def clean_char(char):
     except ValueError:
         weight = 1
     char["complete_names"] = {
-        "input": list(words),
+        "input": sorted(words),
         "weight": weight,
     }
 
@@ -735,13 +847,23 @@ def clean_char(char):
     return char
 
 
-def save_to_elasticsearch(chars, es, es_index):
+def save_to_elasticsearch(chars, es, es_index, total=None, chunk_size=500, workers=4,
+                          max_chunk_bytes=10 * 1024 * 1024, dead_letter=None):
+    """
+    Index the records as they are produced, in bulk requests sent from `workers` threads
 
-    print('\r', "[elasticsearch] %s charities to save" % len(chars))
-    print('\r', "[elasticsearch] saving %s charities to %s index" % (len(chars), es_index))
-    results = bulk(es, list(chars.values()), raise_on_error=False, request_timeout=60)
-    print('\r', "[elasticsearch] saved %s charities to %s index" % (results[0], es_index))
-    print('\r', "[elasticsearch] %s errors reported" % len(results[1]))
+    Records that can't be indexed are written to the `dead_letter` file.
+    """
+    if total is not None:
+        print('\r', "[elasticsearch] %s charities to save" % total)
+    print('\r', "[elasticsearch] saving charities to %s index" % es_index)
+    indexer = BulkIndexer(es, workers=workers, chunk_size=chunk_size,
+                          max_chunk_bytes=max_chunk_bytes, dead_letter=dead_letter)
+    results = indexer.index(chars)
+    results["failed_ids"] = indexer.failed_ids
+    print('\r', "[elasticsearch] saved %s charities to %s index" % (results["indexed"], es_index))
+    print('\r', "[elasticsearch] %s errors reported" % results["failed"])
+    return results
 
 
 def create_outputs(es,
@@ -772,7 +894,8 @@ def create_outputs(es,
         )
     outputs["xlsx"] = xlsxwriter.Workbook(
         os.path.join(data_folder, "output", "all.xlsx"),
-        {'strings_to_urls': False}
+        # rows are written in order, so they don't all need to be kept in memory
+        {'strings_to_urls': False, 'constant_memory': True}
     )
 
     headers = ["id", "ccew_number", "oscr_number", "ccni_number", "known_as", "active",
@@ -786,7 +909,8 @@ def create_outputs(es,
     worksheet.write_row(0, 0, headers)
     xl_row = 1
 
-    chars = []
+    # the JSON array is written one record at a time, the same as the JSON lines file
+    outputs["json"].write('{"charities": [')
     for ccount, i in enumerate(res):
         i["_source"]["id"] = i["_id"]
         flat_i = {}
@@ -798,7 +922,9 @@ def create_outputs(es,
             else:
                 flat_i[h] = i["_source"].get(h)
 
-        chars.append(i["_source"])
+        if ccount:
+            outputs["json"].write(', ')
+        json.dump(i["_source"], outputs["json"])
 
         json.dump(i["_source"], outputs["jsonl"])
         outputs["jsonl"].write('\n')
@@ -813,7 +939,7 @@ def create_outputs(es,
     
     print('\r', "[Output] %s records written to output files" % ccount)
 
-    json.dump({"charities": chars}, outputs["json"])
+    outputs["json"].write(']}')
 
     for i, f in outputs.items():
         print("[Output] Records saved to {}".format(getattr(f, "name", getattr(f, "filename", i))))
@@ -848,6 +974,8 @@ def main():
     parser.add_argument('--es-pc-use-ssl', action='store_true', help='Use ssl to connect to postcode elasticsearch')
     parser.add_argument('--es-pc-index', default='postcode', help='index used to store postcode data')
     parser.add_argument('--es-pc-type', default='postcode', help='type used to store postcode data')
+    parser.add_argument('--geo-workers', type=int, default=4, help='Number of postcode requests to send at the same time')
+    parser.add_argument('--geo-cache-size', type=int, default=50000, help='Number of postcodes to remember while importing')
 
     # add args to turn on or off the various data sources
     add_bool_arg(parser, 'oscr', default=True, help='Fetch data from Office of the Scottish Charity Regulator')
@@ -855,6 +983,33 @@ def main():
     add_bool_arg(parser, 'ccni', default=True, help='fetch data from Charity Commission for Northern Ireland')
     add_bool_arg(parser, 'output', default=False, help='Create output files containing the whole dataset')
 
+    # memory use
+    parser.add_argument('--in-memory', action='store_true',
+                        help='Keep all the records in memory while importing, rather than in a temporary file')
+    parser.add_argument('--cache-size', type=int, default=10000,
+                        help='Number of records to keep in memory while importing (unless --in-memory is used)')
+    parser.add_argument('--chunk-size', type=int, default=500,
+                        help='Number of records to start sending to elasticsearch at a time (adjusted as the import runs)')
+    parser.add_argument('--max-chunk-bytes', type=int, default=10 * 1024 * 1024,
+                        help='Largest size of each request sent to elasticsearch')
+    parser.add_argument('--bulk-workers', type=int, default=4, help='Number of requests to send to elasticsearch at the same time')
+    parser.add_argument('--dead-letter', default=None,
+                        help='File to save records that could not be indexed to (default: bulk_failures.jsonl in the data folder)')
+
+    # import into a new index and point the alias (--es-index) at it when it's finished
+    parser.add_argument('--build', action='store_true',
+                        help='Import into a new index, then point --es-index at it as an alias')
+    parser.add_argument('--keep', type=int, default=2,
+                        help='Number of previous indexes to keep for rolling back (with --build)')
+    parser.add_argument('--replicas', type=int, default=None,
+                        help='Number of replicas for the new index (with --build, default: the same as the index it replaces)')
+
+    # only send the records that have changed since the last import
+    parser.add_argument('--delta', action='store_true',
+                        help='Only send new, changed and deleted records to elasticsearch')
+    parser.add_argument('--hash-file', default=None,
+                        help='File to keep the hashes of imported records in (default: import_hashes.sqlite in the data folder)')
+
     parser.add_argument('--debug', action='store_true', help='Only load first 10000 rows for ccew')
 
     args = parser.parse_args()
@@ -891,9 +1046,16 @@ def main():
         "ccni_extra_names": os.path.join(args.folder, "ccni_extra_names.csv"),
     }
 
-    chars = {}
+    if args.build and args.delta:
+        raise ValueError("--delta can't be used with --build, which imports every record into a new index")
+    es_index = args.es_index
+    if args.build:
+        es_index = create_build_index(es, args.es_index, args.es_type)
+
+    # only the ids of the records are kept in memory, the records are kept in a temporary file
+    chars = {} if args.in_memory else SpillStore(cache_size=args.cache_size, folder=args.folder)
     if args.ccew:
-        chars = import_extract_charity(chars, datafile=data_files["extract_charity"], es_index=args.es_index, es_type=args.es_type, debug=args.debug)
+        chars = import_extract_charity(chars, datafile=data_files["extract_charity"], es_index=es_index, es_type=args.es_type, debug=args.debug)
         chars = import_extract_main(chars, datafile=data_files["extract_main"], debug=args.debug)
         chars = import_extract_name(chars, datafile=data_files["extract_names"], debug=args.debug)
         chars = import_extract_registration(chars, datafile=data_files["extract_registration"], debug=args.debug)
@@ -902,11 +1064,10 @@ def main():
     if os.path.isfile(data_files["dual_registration"]):
         dual = import_dual_reg(data_files["dual_registration"])
     if args.oscr:
-        chars = import_oscr(chars, dual=dual, datafile=data_files["oscr"], es_index=args.es_index, es_type=args.es_type, debug=args.debug)
+        chars = import_oscr(chars, dual=dual, datafile=data_files["oscr"], es_index=es_index, es_type=args.es_type, debug=args.debug)
     if args.ccni:
-        chars = import_ccni(chars, dual=dual, datafile=data_files["ccni"], extra_names=data_files["ccni_extra_names"], es_index=args.es_index, es_type=args.es_type, debug=args.debug)
+        chars = import_ccni(chars, dual=dual, datafile=data_files["ccni"], extra_names=data_files["ccni_extra_names"], es_index=es_index, es_type=args.es_type, debug=args.debug)
     # @TODO include charity commission register of mergers
-    chars = clean_chars(chars, pc_es, args.es_pc_index, args.es_pc_type)
 
     if args.debug:
         import random
@@ -914,8 +1075,63 @@ def main():
         random_keys = random.choices(list(chars.keys()), k=10)
         for r in random_keys:
             print(r, chars[r])
-    
-    save_to_elasticsearch(chars, es, args.es_index)
+
+    hash_file = args.hash_file or os.path.join(args.folder, "import_hashes.sqlite")
+    if args.build:
+        # the hashes only describe the live index once the build has been published,
+        # so a copy is updated and only replaces them then
+        build_hash_file = hash_file + ".build"
+        if os.path.exists(hash_file):
+            shutil.copyfile(hash_file, build_hash_file)
+        elif os.path.exists(build_hash_file):
+            os.remove(build_hash_file)
+        hashes = HashStore(build_hash_file)
+    else:
+        hashes = HashStore(hash_file)
+    delta = args.delta
+    if delta:
+        # if the index has been emptied or recreated the hashes don't match what's in it
+        try:
+            indexed = es.count(index=args.es_index)["count"]
+        except NotFoundError:
+            indexed = 0
+        if indexed != len(hashes):
+            print('\r', "[hashes] %s charities in %s index but %s hashes, sending all charities" % (
+                indexed, args.es_index, len(hashes)))
+            delta = False
+    # records are only deleted by a delta import, and only if every source was imported
+    delete = args.delta and args.ccew and args.oscr and args.ccni and not args.debug
+
+    # the records are cleaned, geocoded and indexed one chunk at a time
+    records = clean_chars(chars.values())
+    if pc_es:
+        records = geocode_chars(records, pc_es, args.es_pc_index, args.es_pc_type,
+                                cache_size=args.geo_cache_size, workers=args.geo_workers)
+    records = hashes.changes(records, delta=delta)
+    if delete:
+        records = itertools.chain(records, hashes.deletions(es_index, args.es_type))
+    results = save_to_elasticsearch(records, es, es_index, total=None if delta else len(chars),
+                                    chunk_size=args.chunk_size, workers=args.bulk_workers,
+                                    max_chunk_bytes=args.max_chunk_bytes,
+                                    dead_letter=args.dead_letter or os.path.join(args.folder, "bulk_failures.jsonl"))
+    # a new index only has the records from this import in it
+    hashes.commit(results["failed_ids"], deleted=delete or args.build)
+    hashes.close()
+    if not args.in_memory:
+        chars.close()
+
+    if args.build:
+        # a build with a lot of failures is left for checking rather than replacing the live index
+        if results["failed"] > results["indexed"] * 0.01:
+            print('\r', "[elasticsearch] too many errors, '%s' index not published" % es_index)
+            os.remove(build_hash_file)
+        else:
+            try:
+                publish_index(es, es_index, args.es_index, keep=args.keep, replicas=args.replicas)
+            except ValueError:
+                os.remove(build_hash_file)
+                raise
+            os.replace(build_hash_file, hash_file)
 
     if args.output:
         create_outputs(es, args.folder, args.es_index, args.es_type)
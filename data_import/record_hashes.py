@@ -0,0 +1,139 @@
+"""
+Hashes of the records sent to elasticsearch by previous imports
+
+Each record's content is hashed after it has been cleaned, leaving out the
+fields that are worked out again on every run (`last_modified` and
+`complete_names`). The hashes are kept in an SQLite file in the data folder,
+along with the `last_modified` date of each record, so the next import can
+tell which records are new, which have changed and which have disappeared.
+Records that haven't changed keep their old `last_modified` date.
+"""
+import datetime
+import hashlib
+import itertools
+import json
+import sqlite3
+
+# fields that aren't part of a record's content
+IGNORED_FIELDS = {"_index", "_type", "_op_type", "last_modified", "complete_names"}
+
+
+def _default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def record_hash(record):
+    """
+    Stable hash of the content of a record
+    """
+    content = {k: v for k, v in record.items() if k not in IGNORED_FIELDS}
+    return hashlib.sha1(
+        json.dumps(content, sort_keys=True, default=_default, ensure_ascii=False).encode("utf8")
+    ).hexdigest()
+
+
+class HashStore:
+    """
+    Hashes and `last_modified` dates of the records imported before, kept in `filename`
+
+    Use `changes` to go through the records from this import, then
+    `deletions` for the records that weren't in it, and `commit` once they
+    have been sent. New hashes are only saved by `commit`, and only for the
+    records that were indexed, so if the import stops part way through the
+    records are sent again next time.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS hashes (
+            id TEXT PRIMARY KEY,
+            hash TEXT,
+            last_modified TEXT,
+            seen INTEGER DEFAULT 0
+        )""")
+        self.db.execute("UPDATE hashes SET seen = 0")
+        # hashes of new and changed records, waiting to be committed
+        self.db.execute("CREATE TEMP TABLE staged (id TEXT PRIMARY KEY, hash TEXT, last_modified TEXT)")
+        self.db.execute("CREATE TEMP TABLE failed (id TEXT PRIMARY KEY)")
+        self.db.commit()
+        self.stats = {"new": 0, "changed": 0, "unchanged": 0, "deleted": 0}
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+
+    def changes(self, records, delta=True, batch_size=1000):
+        """
+        Compare each record with its previous hash, `batch_size` records at a time
+
+        Records that haven't changed get their previous `last_modified` date,
+        and are left out if `delta` is true.
+        """
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            ids = [record["_id"] for record in batch]
+            previous = {
+                row[0]: row[1:] for row in self.db.execute(
+                    "SELECT id, hash, last_modified FROM hashes WHERE id IN ({})".format(
+                        ", ".join("?" * len(ids))), ids)
+            }
+            self.db.executemany("UPDATE hashes SET seen = 1 WHERE id = ?", ((i,) for i in previous))
+            staged = []
+            to_send = []
+            for record in batch:
+                new_hash = record_hash(record)
+                old = previous.get(record["_id"])
+                if old and old[0] == new_hash:
+                    self.stats["unchanged"] += 1
+                    record["last_modified"] = old[1]
+                    if delta:
+                        continue
+                else:
+                    self.stats["changed" if old else "new"] += 1
+                    staged.append((record["_id"], new_hash, _default(record["last_modified"])))
+                to_send.append(record)
+            self.db.executemany(
+                "INSERT OR REPLACE INTO staged (id, hash, last_modified) VALUES (?, ?, ?)", staged)
+            self.db.commit()
+            for record in to_send:
+                yield record
+        print('\r', "[hashes] {new} new, {changed} changed and {unchanged} unchanged charities".format(**self.stats))
+
+    def deletions(self, es_index, es_type):
+        """
+        Delete actions for the records imported before that weren't in this import
+        """
+        for (record_id,) in self.db.execute("SELECT id FROM hashes WHERE seen = 0").fetchall():
+            self.stats["deleted"] += 1
+            yield {
+                "_op_type": "delete",
+                "_index": es_index,
+                "_type": es_type,
+                "_id": record_id,
+            }
+        print('\r', "[hashes] {deleted} charities to delete".format(**self.stats))
+
+    def commit(self, failed_ids=(), deleted=True):
+        """
+        Save the hashes of the records that were indexed, and forget the records that were deleted
+
+        Records that failed to index keep their old hash (or none), so they
+        are sent again next time. Records whose delete failed are kept, so
+        they are deleted again next time.
+        """
+        self.db.execute("DELETE FROM failed")
+        self.db.executemany("INSERT OR IGNORE INTO failed (id) VALUES (?)", ((i,) for i in failed_ids))
+        self.db.execute("""INSERT OR REPLACE INTO hashes (id, hash, last_modified, seen)
+            SELECT id, hash, last_modified, 1 FROM staged WHERE id NOT IN (SELECT id FROM failed)""")
+        self.db.execute("DELETE FROM staged")
+        if deleted:
+            self.db.execute("DELETE FROM hashes WHERE seen = 0 AND id NOT IN (SELECT id FROM failed)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,122 @@
+"""
+Store for the charity records while they are being imported
+
+Only the ids of the records are kept in memory, so sources can still be
+joined on them. The records themselves are pickled into a temporary SQLite
+file, and the most recently used ones are kept in memory. The import
+functions update records in place, so records are written back when they
+leave the cache rather than when they are changed.
+"""
+import os
+import pickle
+import sqlite3
+import tempfile
+from collections import OrderedDict
+
+
+class SpillStore:
+    """
+    Dictionary of records that keeps at most `cache_size` of them in memory
+
+    The rest are kept in an SQLite file, `filename`, or a temporary file
+    that is removed when the store is closed.
+    """
+
+    def __init__(self, filename=None, cache_size=10000, folder=None):
+        self.temporary = filename is None
+        if self.temporary:
+            handle, filename = tempfile.mkstemp(suffix=".sqlite", prefix="import_", dir=folder)
+            os.close(handle)
+        self.filename = filename
+        self.cache_size = cache_size
+        self.ids = set()
+        self.cache = OrderedDict()
+
+        self.db = sqlite3.connect(filename)
+        # the file is only needed while the import is running
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("DROP TABLE IF EXISTS records")
+        self.db.execute("CREATE TABLE records (id TEXT PRIMARY KEY, record BLOB)")
+
+    def __contains__(self, key):
+        return key in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(list(self.ids))
+
+    def keys(self):
+        return list(self.ids)
+
+    def __getitem__(self, key):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if key not in self.ids:
+            raise KeyError(key)
+        row = self.db.execute("SELECT record FROM records WHERE id = ?", (key,)).fetchone()
+        record = pickle.loads(row[0])
+        self.cache[key] = record
+        self._evict()
+        return record
+
+    def get(self, key, default=None):
+        if key not in self.ids:
+            return default
+        return self[key]
+
+    def __setitem__(self, key, value):
+        self.ids.add(key)
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        """
+        Write the least recently used half of the cache to the file once it is full
+        """
+        if len(self.cache) <= self.cache_size:
+            return
+        to_write = []
+        while len(self.cache) > self.cache_size // 2:
+            to_write.append(self.cache.popitem(last=False))
+        self._write(to_write)
+
+    def _write(self, items):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO records (id, record) VALUES (?, ?)",
+            ((key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) for key, value in items)
+        )
+        self.db.commit()
+
+    def flush(self):
+        """
+        Write all the cached records to the file
+        """
+        self._write(list(self.cache.items()))
+        self.cache.clear()
+
+    def values(self):
+        """
+        Iterate through the records, reading them from the file one at a time
+        """
+        self.flush()
+        for row in self.db.execute("SELECT record FROM records"):
+            yield pickle.loads(row[0])
+
+    def items(self):
+        self.flush()
+        for key, record in self.db.execute("SELECT id, record FROM records"):
+            yield key, pickle.loads(record)
+
+    def close(self):
+        """
+        Close the file, and remove it if it was temporary
+        """
+        self.db.close()
+        self.cache.clear()
+        if self.temporary and os.path.exists(self.filename):
+            os.remove(self.filename)
@@ -0,0 +1,574 @@
+"""
+Run the find that charity server on asyncio
+
+This serves the main routes of `server.py` (search, reconciliation, charity
+records and previews, org-ids, autocomplete and feeds) with aiohttp, using
+the same URLs, templates, caches and response shapes. Elasticsearch is
+queried through an asynchronous connection pool, so a slow reconciliation
+batch or feed refresh doesn't hold up a whole worker, and the queries in a
+reconciliation batch are run at the same time (up to `RECONCILE_CONCURRENCY`).
+
+Run it on its own with:
+
+    python server/async_server.py
+
+or with gunicorn:
+
+    gunicorn --pythonpath server async_server:app --worker-class aiohttp.GunicornWebWorker --keep-alive 75
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from aiohttp import web
+import bottle
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, TransportError
+
+from server import app as bottle_app, POTENTIAL_ENV_VARS, ROUTE_TIMEOUTS, RECORD_MAX_AGE, \
+    FEED_MAX_AGE, DOWNLOAD_MAX_AGE, CORS_HEADERS, AUTOCOMPLETE_SIZE, BATCH_LIMIT, render_record, search_hits, \
+    record_etag, not_modified, feed_body
+from queries import search_query, recon_query, service_spec, recon_response, templates, \
+    propose_properties, extend_fields, extend_response
+from records import clean_regno, orgid_to_id, MGET_CHUNK_SIZE
+from es_client import parse_hosts, CircuitOpenError
+from async_storage import AsyncElasticsearchStorage
+from metrics import registry, REQUEST_SECONDS, RESPONSE_BYTES, RESPONSES, BATCH_SIZE
+
+# the settings, caches and feeds are shared with the bottle app
+config = bottle_app.config
+
+# number of queries from one reconciliation batch that are run at the same time
+RECONCILE_CONCURRENCY = 10
+
+routes = web.RouteTableDef()
+
+
+def json_response(data, headers=None):
+    return web.Response(text=json.dumps(data), content_type="application/json", headers=headers)
+
+
+def html_response(text, headers=None):
+    return web.Response(text=text, content_type="text/html", headers=headers)
+
+
+def not_found(message):
+    return web.HTTPNotFound(text=message)
+
+
+async def in_thread(func, *args, **kwargs):
+    """
+    Run blocking work (rendering templates or searching local data) in the default thread pool
+    """
+    return await asyncio.get_event_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+def cache_headers(request, etag, last_modified, max_age):
+    """
+    Caching headers for a response, and whether the client already has this version
+    """
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age={}".format(max_age),
+    }
+    if last_modified:
+        headers["Last-Modified"] = bottle.http_date(last_modified)
+    return headers, not_modified(etag, last_modified, request.headers)
+
+
+async def get_record(request, record_id, route, source_exclude=None):
+    """
+    Fetch a record, from the local record store if there is one
+
+    `route` is the name used to find the timeout in `ROUTE_TIMEOUTS`.
+    """
+    local = config.get("storage")
+    if hasattr(local, "store"):
+        local.check()
+        source = local.store.get(record_id)
+        if source is not None:
+            return {"_id": record_id, "found": True, "_source": source}
+    return await request.app["storage"].get(
+        record_id, source_exclude=source_exclude, timeout=ROUTE_TIMEOUTS.get(route))
+
+
+@routes.get('/', name="home")
+async def home(request):
+    """
+    Get the index page for the site
+    """
+    term = request.query.get('q')
+    if not term:
+        return html_response(bottle.template('index', term=''))
+
+    query = search_query(term)
+    cache = config["result_cache"]
+    cache_key = templates.cache_key("search", query["params"]["name"])
+    res = cache.get(cache_key)
+    if res is None:
+        res = search_hits(await request.app["storage"].search_template(
+            query, timeout=ROUTE_TIMEOUTS.get("home")))
+        cache.set(cache_key, res)
+    return html_response(await in_thread(bottle.template, 'search', res=res, term=query["params"]["name"]))
+
+
+async def recon_result(request, query):
+    """
+    Get the reconciliation results for one query, using the result cache
+    """
+    cache = config["result_cache"]
+    cache_key = templates.cache_key("recon", query["params"]["name"])
+    result = cache.get(cache_key)
+    if result is None:
+        res = await request.app["storage"].search_template(query, timeout=ROUTE_TIMEOUTS.get("reconcile"))
+        result = recon_response(res, query)
+        cache.set(cache_key, result)
+    return result
+
+
+async def recon_results(request, queries):
+    """
+    Run a batch of reconciliation queries at the same time
+
+    As with `esdoc_orresponses`, a query that fails gets an empty result
+    list rather than failing the whole batch, unless every query in the batch
+    failed because elasticsearch couldn't be reached.
+    """
+    semaphore = request.app["reconcile_semaphore"]
+
+    async def run(query):
+        async with semaphore:
+            try:
+                return {"result": (await recon_result(request, query))["result"]}
+            except ESConnectionError:
+                raise
+            except (TransportError, KeyError):
+                return {"result": []}
+
+    # the other queries carry on if one of them fails
+    results = await asyncio.gather(*[run(query) for _, query in queries], return_exceptions=True)
+    errors = [r for r in results if isinstance(r, Exception)]
+    for error in errors:
+        if not isinstance(error, (ESConnectionError, CircuitOpenError)) or len(errors) == len(results):
+            raise error
+    return OrderedDict(zip(
+        [query_id for query_id, _ in queries],
+        [{"result": []} if isinstance(r, Exception) else r for r in results],
+    ))
+
+
+@routes.route('*', '/reconcile', name="reconcile")
+async def reconcile(request):
+    """
+    Reconciliation API, see `server.reconcile`
+    """
+    params = request.query.copy()
+    if request.method == "POST":
+        params.extend(await request.post())
+
+    service_url = "{}://{}".format(request.scheme, request.host)
+    response = service_spec(bottle_app, service_url)
+
+    if request.query.get("query"):
+        response = await recon_result(request, recon_query(request.query["query"]))
+
+    if params.get("queries"):
+        queries_dict = json.loads(params["queries"], object_pairs_hook=OrderedDict)
+        BATCH_SIZE.observe(len(queries_dict), "/reconcile")
+        response = await recon_results(request, [
+            (query_id, recon_query(q["query"])) for query_id, q in queries_dict.items()
+        ])
+
+    if params.get("extend"):
+        try:
+            extend = json.loads(params["extend"])
+        except ValueError:
+            raise web.HTTPBadRequest(text='"extend" must be JSON')
+        if not isinstance(extend, dict) or not isinstance(extend.get("ids", []), list):
+            raise web.HTTPBadRequest(text='"extend" must contain a list of "ids"')
+        if len(extend.get("ids", [])) > BATCH_LIMIT:
+            raise web.HTTPBadRequest(text='No more than {} ids can be extended at once'.format(BATCH_LIMIT))
+        BATCH_SIZE.observe(len(extend.get("ids", [])), "/reconcile")
+        records = await fetch_records(request, [str(i) for i in extend.get("ids", [])],
+                                      extend_fields(extend) or ["known_as"])
+        response = extend_response(extend, records)
+
+    return recon_return(request, response)
+
+
+@routes.get('/reconcile/propose_properties', name="reconcile_propose_properties")
+async def reconcile_propose_properties(request):
+    """
+    Properties that can be added to reconciled records with the data extension API
+    """
+    limit = request.query.get("limit", "")
+    return recon_return(request, propose_properties(bottle_app, int(limit) if limit.isdigit() else None))
+
+
+def recon_return(request, response):
+    """
+    Return a reconciliation API response, as JSONP if a callback is given
+    """
+    if request.query.get("callback"):
+        return web.Response(text="%s(%s);" % (request.query["callback"], json.dumps(response)),
+                            content_type="application/javascript")
+    # add headers for CORS support, as the bottle app does
+    return json_response(response, headers=CORS_HEADERS)
+
+
+async def fetch_records(request, regnos, fields):
+    """
+    Fetch some fields of the records for a list of registration numbers, as with `records.fetch_records`
+
+    The chunks of ids are fetched at the same time.
+    """
+    cleaned = OrderedDict((regno, clean_regno(regno)) for regno in regnos)
+    to_fetch = list(OrderedDict.fromkeys(c for c in cleaned.values() if c))
+    responses = await asyncio.gather(*[
+        request.app["storage"].mget(to_fetch[i:i + MGET_CHUNK_SIZE], source_include=fields,
+                                    timeout=ROUTE_TIMEOUTS.get("reconcile"))
+        for i in range(0, len(to_fetch), MGET_CHUNK_SIZE)
+    ])
+    found = {
+        doc["_id"]: doc.get("_source", {})
+        for res in responses for doc in res.get("docs", []) if doc.get("found")
+    }
+    return OrderedDict((regno, found.get(regno_cleaned)) for regno, regno_cleaned in cleaned.items())
+
+
+@routes.get('/charity/all.{filetype}', name="charity_download")
+async def charity_download(request):
+    """
+    Return all charity records
+    """
+    filetype = request.match_info["filetype"]
+    if filetype in ["csv", "json", "jsonl"]:
+        filename = os.path.join("output", "all.{}.gz".format(filetype))
+    elif filetype in ["xlsx"]:
+        filename = os.path.join("output", "all.xlsx")
+    else:
+        raise not_found('File download in {} not available'.format(filetype))
+
+    path = os.path.join(config.get("folder", "data"), filename)
+    if not os.path.exists(path):
+        raise not_found("File does not exist.")
+    # FileResponse deals with If-Modified-Since and Range requests
+    return web.FileResponse(path, headers={"Cache-Control": "public, max-age={}".format(DOWNLOAD_MAX_AGE)})
+
+
+@routes.get(r'/charity/{regno:[^/.]+}', name="charity")
+@routes.get(r'/charity/{regno:[^/.]+}.{filetype}', name="charity_filetype")
+async def charity(request):
+    """
+    Return a single charity record
+    """
+    regno = request.match_info["regno"]
+    filetype = request.match_info.get("filetype", "html")
+    regno_cleaned = clean_regno(regno)
+    if regno_cleaned == "":
+        raise not_found('Charity {} not found.'.format(regno))
+
+    res = await get_record(request, regno_cleaned, "charity")
+    if "_source" not in res:
+        raise not_found('Charity {} not found.'.format(regno))
+
+    headers = None
+    etag, last_modified = record_etag(res["_id"], res["_source"], filetype)
+    if etag:
+        headers, is_current = cache_headers(request, etag, last_modified, RECORD_MAX_AGE)
+        if is_current:
+            return web.Response(status=304, headers=headers)
+    if filetype == "html":
+        return html_response(await in_thread(render_record, 'charity', res), headers)
+    return json_response(res["_source"], headers)
+
+
+@routes.get(r'/preview/charity/{regno:[^/.]+}', name="charity_preview")
+@routes.get(r'/preview/charity/{regno:[^/.]+}.html', name="charity_preview_html")
+async def charity_preview(request):
+    """
+    Small version of charity record
+    """
+    regno = request.match_info["regno"]
+    res = await get_record(request, regno, "charity_preview")
+    if "_source" not in res:
+        raise not_found('Charity {} not found.'.format(regno))
+
+    hide_title = "hide_title" in request.query
+    headers = None
+    etag, last_modified = record_etag(res["_id"], res["_source"], "preview-hide_title" if hide_title else "preview")
+    if etag:
+        headers, is_current = cache_headers(request, etag, last_modified, RECORD_MAX_AGE)
+        if is_current:
+            return web.Response(status=304, headers=headers)
+    return html_response(await in_thread(render_record, 'preview', res, hide_title=hide_title), headers)
+
+
+async def fetch_orgid(request, orgid):
+    """
+    Find the record for an org-id, as with `records.fetch_orgids`
+    """
+    orgid = orgid.strip().upper()
+    record_id = orgid_to_id(orgid)
+    if record_id:
+        res = await get_record(request, record_id, "orgid_json", source_exclude=["complete_names"])
+        if orgid in res.get("_source", {}).get("org-ids", []):
+            return dict(res["_source"], id=res["_id"])
+
+    hits = await request.app["storage"].find_orgids([orgid], timeout=ROUTE_TIMEOUTS.get("orgid_json"))
+    for hit in hits[0] if hits else []:
+        if orgid in hit["_source"].get("org-ids", []):
+            return dict(hit["_source"], id=hit["_id"])
+    return None
+
+
+@routes.get('/orgid/{orgid}.json', name="orgid_json")
+async def orgid_json(request):
+    """
+    Fetch json representation based on a org-id for a record
+    """
+    orgid = request.match_info["orgid"]
+    org = await fetch_orgid(request, orgid)
+    if not org:
+        raise not_found('Orgid {} not found.'.format(orgid))
+
+    headers = None
+    etag, last_modified = record_etag(org["id"], org, "json")
+    if etag:
+        headers, is_current = cache_headers(request, etag, last_modified, RECORD_MAX_AGE)
+        if is_current:
+            return web.Response(status=304, headers=headers)
+    return json_response(org, headers)
+
+
+@routes.get('/orgid/{orgid}.html', name="orgid_html")
+@routes.get('/orgid/{orgid}', name="orgid_redirect")
+async def orgid_html(request):
+    """
+    Redirect to a record based on the org-id
+    """
+    orgid = request.match_info["orgid"]
+    org = await fetch_orgid(request, orgid)
+    if not org:
+        raise not_found('Orgid {} not found.'.format(orgid))
+    raise web.HTTPFound('/charity/{}'.format(org["id"]))
+
+
+@routes.get('/feeds/ccew.{filetype}', name="ccew_rss")
+async def ccew_rss(request):
+    """
+    Get a feed based on when data is uploaded by the Charity Commission
+    """
+    filetype = request.match_info["filetype"]
+    feed = config["ccew_feed"]
+    items = feed.get_items()
+    if not feed.loaded:
+        raise web.HTTPServiceUnavailable(
+            text="The feed hasn't been fetched yet", headers={"Retry-After": str(feed.retry)})
+    updated = feed.updated or datetime.now().replace(tzinfo=timezone.utc)
+
+    etag = '"{}-{}"'.format(feed.version, filetype)
+    headers, is_current = cache_headers(request, etag, updated, FEED_MAX_AGE)
+    if is_current and feed.version:
+        return web.Response(status=304, headers=headers)
+
+    content_type, body = feed_body(feed, items, updated, filetype, str(request.url))
+    if isinstance(body, dict):
+        return json_response(body, headers)
+    return web.Response(text=body, content_type=content_type, headers=headers)
+
+
+@routes.get('/autocomplete', name="autocomplete")
+async def autocomplete(request):
+    """
+    Endpoint for autocomplete queries
+    """
+    search = request.query.get("q", "")
+    if config.get("autocomplete"):
+        results = await in_thread(config["autocomplete"].search, search, size=AUTOCOMPLETE_SIZE)
+    else:
+        results = await request.app["storage"].completion(
+            search, size=AUTOCOMPLETE_SIZE, timeout=ROUTE_TIMEOUTS.get("autocomplete"))
+    return json_response({"results": [
+        {
+            "label": label,
+            "value": record_id
+        } for record_id, label in results
+    ]})
+
+
+@routes.get('/about', name="about")
+async def about(request):
+    """About page
+    """
+    return html_response(bottle.template('about', this_year=datetime.now().year))
+
+
+@routes.get('/metrics', name="metrics")
+async def metrics(request):
+    """
+    Request and cache metrics, for this worker or all of them if `METRICS_DIR` is set
+    """
+    shared = config.get("shared_metrics")
+    return web.Response(text=shared.render() if shared else registry.render(), content_type="text/plain",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+@web.middleware
+async def record_metrics(request, handler):
+    """
+    Record the time taken, size and status of each response
+
+    Unlike the bottle app, the time isn't split into storage and rendering
+    time, as requests share a thread.
+    """
+    start = time.perf_counter()
+    route = request.match_info.route.resource
+    rule = route.canonical if route is not None else "none"
+    status = 500
+    size = 0
+    try:
+        response = await handler(request)
+        status = response.status
+        size = response.content_length or 0
+        return response
+    except web.HTTPException as error:
+        status = error.status
+        raise
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, rule, request.method)
+        RESPONSE_BYTES.observe(size, rule)
+        RESPONSES.inc(rule, str(status))
+        if config.get("shared_metrics"):
+            config["shared_metrics"].save_if_due()
+
+
+@web.middleware
+async def circuit_breaker(request, handler):
+    """
+    Fail quickly while elasticsearch is unavailable
+    """
+    try:
+        return await handler(request)
+    except CircuitOpenError:
+        breaker = config.get("breaker")
+        return web.Response(
+            status=503,
+            text="Search is temporarily unavailable, please try again shortly.",
+            headers={"Retry-After": str(breaker.retry_after() if breaker else 30)},
+        )
+
+
+async def watch_index(app):
+    """
+    Invalidate cached data when the index changes
+    """
+    watcher = config["index_watcher"]
+    while True:
+        await asyncio.sleep(watcher.interval)
+        try:
+            version = await app["storage"].index_version()
+        except Exception:
+            continue
+        watcher.update(version)
+
+
+async def on_startup(app):
+    await app["storage"].start()
+    app["reconcile_semaphore"] = asyncio.Semaphore(app["reconcile_concurrency"])
+    app["index_watch"] = asyncio.ensure_future(watch_index(app))
+
+
+async def on_cleanup(app):
+    app["index_watch"].cancel()
+    await app["storage"].close()
+
+
+def create_app(hosts=None, es_index="charitysearch", es_type="charity", timeout=10, maxsize=10,
+               max_retries=3, reconcile_concurrency=RECONCILE_CONCURRENCY):
+    """
+    Create the aiohttp application
+
+    If `hosts` isn't given then the elasticsearch urls are taken from the
+    same environment variables as `server.py`.
+    """
+    if hosts is None:
+        hosts = ["http://localhost:9200"]
+        for e_v in POTENTIAL_ENV_VARS:
+            if os.environ.get(e_v):
+                hosts = parse_hosts(os.environ.get(e_v))
+                break
+
+    config["es_index"] = es_index
+    config["es_type"] = es_type
+
+    app = web.Application(middlewares=[record_metrics, circuit_breaker])
+    app["storage"] = AsyncElasticsearchStorage(
+        hosts, es_index, es_type,
+        timeout=timeout,
+        maxsize=maxsize,
+        max_retries=max_retries,
+        dead_timeout=int(os.environ.get("ES_DEAD_TIMEOUT", 60)),
+        breaker=config.get("breaker"),
+    )
+    app["reconcile_concurrency"] = reconcile_concurrency
+    app.add_routes(routes)
+    app.router.add_static('/static', 'static')
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+app = create_app(
+    timeout=int(os.environ.get("ES_TIMEOUT", 10)),
+    maxsize=int(os.environ.get("ES_MAXSIZE", 10)),
+    max_retries=int(os.environ.get("ES_MAX_RETRIES", 3)),
+    reconcile_concurrency=int(os.environ.get("RECONCILE_CONCURRENCY", RECONCILE_CONCURRENCY)),
+)
+
+
+def main():
+    """
+    Run the asyncio server (command line version)
+    """
+    parser_args = argparse.ArgumentParser(description='Run the find that charity server on asyncio')
+
+    parser_args.add_argument('-host', '--host', default="localhost", help='host for the server')
+    parser_args.add_argument('-p', '--port', type=int, default=8080, help='port for the server')
+    parser_args.add_argument('--folder', type=str, default='data', help='Root path of the data folder.')
+    parser_args.add_argument('--keep-alive', type=int, default=75, help='Seconds to keep idle connections open')
+
+    parser_args.add_argument('--es-url', help='url for elasticsearch (separate several nodes with commas)')
+    parser_args.add_argument('--es-index', default='charitysearch', help='index used to store charity data')
+    parser_args.add_argument('--es-type', default='charity', help='type used to store charity data')
+    parser_args.add_argument('--es-timeout', type=int, default=10, help='Default seconds allowed for each elasticsearch request')
+    parser_args.add_argument('--es-maxsize', type=int, default=10, help='Number of connections kept open to each elasticsearch node')
+    parser_args.add_argument('--es-max-retries', type=int, default=3, help='Number of times to retry a failed elasticsearch request')
+    parser_args.add_argument('--reconcile-concurrency', type=int, default=RECONCILE_CONCURRENCY,
+                             help='Number of queries from one reconciliation batch to run at the same time')
+
+    args = parser_args.parse_args()
+
+    config["folder"] = args.folder
+    web.run_app(
+        create_app(
+            parse_hosts(args.es_url) if args.es_url else None,
+            es_index=args.es_index,
+            es_type=args.es_type,
+            timeout=args.es_timeout,
+            maxsize=args.es_maxsize,
+            max_retries=args.es_max_retries,
+            reconcile_concurrency=args.reconcile_concurrency,
+        ),
+        host=args.host,
+        port=args.port,
+        keepalive_timeout=args.keep_alive,
+    )
+
+
+if __name__ == '__main__':
+    main()
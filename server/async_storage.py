@@ -0,0 +1,231 @@
+"""
+Asynchronous elasticsearch storage for the asyncio server
+
+This talks to the elasticsearch REST API directly with aiohttp, and has
+the same methods as `storage.ElasticsearchStorage` (as coroutines), so the
+same responses come back from both servers. Only the requests the server
+makes are supported.
+"""
+import asyncio
+import json
+import time
+
+import aiohttp
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, \
+    ConnectionTimeout, TransportError, HTTP_EXCEPTIONS
+
+from es_client import RETRY_ON_STATUS, CircuitOpenError
+
+
+class AsyncElasticsearchStorage:
+    """
+    Storage using an elasticsearch index, through an asyncio connection pool
+
+    Requests are spread across `hosts` in turn. A node that can't be
+    reached is left out for `dead_timeout` seconds, and failed requests are
+    retried on the next node up to `max_retries` times. If a `breaker` is
+    given then requests fail straight away while it is open.
+    """
+
+    def __init__(self, hosts, es_index="charitysearch", es_type="charity", timeout=10,
+                 maxsize=10, max_retries=3, dead_timeout=60, breaker=None):
+        self.hosts = [h.rstrip("/") for h in hosts]
+        self.es_index = es_index
+        self.es_type = es_type
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.max_retries = max_retries
+        self.dead_timeout = dead_timeout
+        self.breaker = breaker
+        self.dead = {}
+        self.next_host = 0
+        self.session = None
+
+    async def start(self):
+        """
+        Open the connection pool
+        """
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=self.maxsize),
+        )
+
+    async def close(self):
+        """
+        Close the connection pool
+        """
+        if self.session is not None:
+            await self.session.close()
+
+    def _pick_host(self):
+        now = time.monotonic()
+        live = [h for h in self.hosts if self.dead.get(h, 0) <= now] or self.hosts
+        self.next_host = (self.next_host + 1) % len(live)
+        return live[self.next_host]
+
+    def _path(self, *parts):
+        return "/" + "/".join([self.es_index, self.es_type] + list(parts))
+
+    async def request(self, method, path, body=None, params=None, timeout=None, ignore=()):
+        """
+        Make a request to elasticsearch and return the decoded response
+
+        A list `body` is sent as newline delimited JSON, as used by the
+        multi search endpoints.
+        """
+        if self.breaker is not None and not self.breaker.allow():
+            raise CircuitOpenError("elasticsearch is unavailable")
+
+        headers = {}
+        data = None
+        if isinstance(body, list):
+            data = "".join(json.dumps(b) + "\n" for b in body)
+            headers["Content-Type"] = "application/x-ndjson"
+        elif body is not None:
+            data = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        params = {
+            k: ",".join(v) if isinstance(v, (list, tuple)) else str(v)
+            for k, v in (params or {}).items()
+        }
+
+        error = None
+        for _ in range(self.max_retries + 1):
+            host = self._pick_host()
+            try:
+                async with self.session.request(
+                        method, host + path, data=data, params=params, headers=headers,
+                        timeout=aiohttp.ClientTimeout(total=timeout or self.timeout)) as res:
+                    text = await res.text()
+                    if res.status in RETRY_ON_STATUS:
+                        error = TransportError(res.status, text)
+                        continue
+                    if res.status >= 400 and res.status not in ignore:
+                        error = HTTP_EXCEPTIONS.get(res.status, TransportError)(res.status, text)
+                        if res.status >= 500:
+                            continue
+                        self._record(success=True)
+                        raise error
+                    self._record(success=True)
+                    return json.loads(text) if text else {}
+            except asyncio.TimeoutError as e:
+                error = ConnectionTimeout('TIMEOUT', str(e), e)
+            except aiohttp.ClientError as e:
+                error = ESConnectionError('N/A', str(e), e)
+                self.dead[host] = time.monotonic() + self.dead_timeout
+
+        self._record(success=False)
+        raise error
+
+    def _record(self, success):
+        if self.breaker is None:
+            return
+        if success:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    async def ping(self):
+        """
+        Check the index can be reached
+        """
+        try:
+            await self.request("GET", "/")
+            return True
+        except (TransportError, CircuitOpenError):
+            return False
+
+    async def get(self, record_id, source_exclude=None, timeout=None):
+        """
+        Fetch one record
+        """
+        params = {"_source_exclude": source_exclude} if source_exclude else None
+        return await self.request("GET", self._path(record_id), params=params,
+                                  timeout=timeout, ignore=(404,))
+
+    async def mget(self, ids, source_include=None, source_exclude=None, timeout=None):
+        """
+        Fetch a list of records
+        """
+        params = {}
+        if source_include:
+            params["_source_include"] = source_include
+        if source_exclude:
+            params["_source_exclude"] = source_exclude
+        return await self.request("POST", self._path("_mget"), body={"ids": ids},
+                                  params=params, timeout=timeout)
+
+    async def search_template(self, query, timeout=None):
+        """
+        Run a search template query
+        """
+        return await self.request("POST", self._path("_search", "template"), body=query,
+                                  timeout=timeout, ignore=(404,))
+
+    async def msearch_template(self, queries, timeout=None):
+        """
+        Run a list of search template queries in one request
+        """
+        body = []
+        for query in queries:
+            body.append({})
+            body.append(query)
+        return await self.request("POST", self._path("_msearch", "template"), body=body,
+                                  timeout=timeout)
+
+    async def find_orgids(self, orgids, timeout=None):
+        """
+        Search for the records with a list of org-ids
+
+        Returns a list of search hits for each org-id, as with
+        `ElasticsearchStorage.find_orgids`.
+        """
+        body = []
+        for orgid in orgids:
+            body.append({})
+            body.append({
+                "size": 5,
+                "query": {"match": {"org-ids": {"query": orgid, "operator": "and"}}},
+                "_source": {"excludes": ["complete_names"]},
+            })
+        res = await self.request("POST", self._path("_msearch"), body=body, timeout=timeout)
+        return [
+            sub_res.get("hits", {}).get("hits", [])
+            for sub_res in res.get("responses", [])
+        ]
+
+    async def completion(self, prefix, size=5, timeout=None):
+        """
+        Suggest records whose names start with a prefix
+
+        Returns a list of (id, name) tuples.
+        """
+        doc = {
+            "suggest": {
+                "suggest-1": {
+                    "prefix": prefix,
+                    "completion": {
+                        "field": "complete_names",
+                        "size": size,
+                        "fuzzy": {"fuzziness": 1},
+                    }
+                }
+            }
+        }
+        res = await self.request("POST", self._path("_search"), body=doc,
+                                 params={"_source_include": ["known_as"]}, timeout=timeout)
+        return [
+            (x["_id"], x["_source"]["known_as"])
+            for x in res.get("suggest", {}).get("suggest-1", [{}])[0].get("options", [])
+        ]
+
+    async def index_version(self):
+        """
+        Something that changes whenever records in the index are changed
+        """
+        stats = await self.request("GET", "/{}/_stats/indexing".format(self.es_index))
+        indexing = stats["_all"]["primaries"]["indexing"]
+        return (
+            tuple(sorted(stats.get("indices", {}).keys())),
+            indexing.get("index_total"),
+            indexing.get("delete_total"),
+        )
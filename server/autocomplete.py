@@ -0,0 +1,321 @@
+"""
+Local autocomplete index built from the output files
+
+Instead of asking elasticsearch for completions on every keystroke, the
+names from `output/all.jsonl.gz` can be built into a file of sorted name
+prefixes. Workers memory-map the file, so it loads instantly and is shared
+between processes through the page cache.
+
+To build the file run:
+
+    python server/autocomplete.py data/output/all.jsonl.gz
+"""
+import argparse
+import array
+import bisect
+import gzip
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+MAGIC = b"FTCAUTO1"
+HEADER = struct.Struct("<8sII")
+
+# ranges of matching names bigger than this are ranked once and remembered
+LARGE_RANGE = 2000
+
+
+def normalise_name(name):
+    """
+    Normalise a name the same way for indexing and querying
+    """
+    return re.sub(r'[^0-9a-z]+', ' ', name.lower()).strip()
+
+
+def record_weight(record):
+    """
+    Weight for ranking a record, the same as used in `clean_char`
+    """
+    try:
+        return max(1, math.ceil(math.log1p((record.get("latest_income", 0) or 0))))
+    except ValueError:
+        return 1
+
+
+def record_phrases(record):
+    """
+    All the phrases a record can be completed from
+
+    As with the `complete_names` field this is every name, starting from
+    each word in the name.
+    """
+    names = [record.get("known_as")] + (record.get("alt_names") or [])
+    phrases = set()
+    for name in names:
+        if not name:
+            continue
+        words = normalise_name(name).split()
+        phrases.update([" ".join(words[r:]) for r in range(len(words))])
+    return phrases
+
+
+def build_index(source, target):
+    """
+    Create an autocomplete index file from a gzipped JSON lines file of records
+    """
+    ids = []
+    labels = []
+    weights = array.array('B')
+    entries = []
+    with gzip.open(source, 'rt', encoding='utf8') as records:
+        for line in records:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record_index = len(ids)
+            ids.append(record["id"])
+            labels.append(record.get("known_as") or "")
+            weights.append(min(255, record_weight(record)))
+            entries.extend((phrase, record_index) for phrase in record_phrases(record))
+
+    entries.sort()
+
+    key_offsets = array.array('I', [0])
+    key_records = array.array('I')
+    key_blob = bytearray()
+    for phrase, record_index in entries:
+        key_blob.extend(phrase.encode("utf8"))
+        key_offsets.append(len(key_blob))
+        key_records.append(record_index)
+
+    record_offsets = array.array('I', [0])
+    record_blob = bytearray()
+    for record_id, label in zip(ids, labels):
+        record_blob.extend("{}\t{}".format(record_id, label).encode("utf8"))
+        record_offsets.append(len(record_blob))
+
+    tmp_target = "{}.{}.tmp".format(target, os.getpid())
+    with open(tmp_target, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(ids), len(entries)))
+        for section in (key_offsets, key_records, record_offsets):
+            f.write(section.tobytes())
+        f.write(weights.tobytes())
+        f.write(b"\0" * (-len(weights) % 4))
+        f.write(bytes(key_blob))
+        f.write(bytes(record_blob))
+    os.replace(tmp_target, target)
+    return len(ids), len(entries)
+
+
+class _Keys:
+    """
+    Sequence of the phrases in the index, decoded as they're needed by `bisect`
+    """
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], "utf8")
+
+
+class AutocompleteIndex:
+    """
+    Memory-mapped autocomplete index file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mtime = os.path.getmtime(filename)
+        with open(filename, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mmap)
+
+        magic, n_records, n_keys = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError("{} is not an autocomplete index".format(filename))
+
+        pos = HEADER.size
+        key_offsets = view[pos:pos + (n_keys + 1) * 4].cast('I')
+        pos += (n_keys + 1) * 4
+        self.key_records = view[pos:pos + n_keys * 4].cast('I')
+        pos += n_keys * 4
+        self.record_offsets = view[pos:pos + (n_records + 1) * 4].cast('I')
+        pos += (n_records + 1) * 4
+        self.weights = view[pos:pos + n_records]
+        pos += n_records + (-n_records % 4)
+        self.keys = _Keys(key_offsets, view[pos:pos + key_offsets[n_keys]])
+        pos += key_offsets[n_keys]
+        self.record_blob = view[pos:]
+
+        self.large_ranges = {}
+
+    def record(self, record_index):
+        """
+        Get the id and name of a record
+        """
+        start = self.record_offsets[record_index]
+        end = self.record_offsets[record_index + 1]
+        record_id, _, label = str(self.record_blob[start:end], "utf8").partition("\t")
+        return record_id, label
+
+    def prefix_range(self, prefix, lo=0, hi=None):
+        """
+        Find the range of phrases that start with a prefix
+        """
+        if hi is None:
+            hi = len(self.keys)
+        start = bisect.bisect_left(self.keys, prefix, lo, hi)
+        end = bisect.bisect_left(self.keys, prefix + "\U0010ffff", start, hi)
+        return start, end
+
+    def top_records(self, start, end, size):
+        """
+        Records with the highest weight among a range of phrases
+        """
+        if end - start > LARGE_RANGE:
+            if (start, end) not in self.large_ranges:
+                self.large_ranges[(start, end)] = self._top_records(start, end, 50)
+            return self.large_ranges[(start, end)][:size]
+        return self._top_records(start, end, size)
+
+    def _top_records(self, start, end, size):
+        return heapq.nlargest(
+            size, set(self.key_records[start:end]), key=self.weights.__getitem__
+        )
+
+    def next_characters(self, head, lo, hi):
+        """
+        Characters that follow `head` in the phrases between `lo` and `hi`,
+        with the range of phrases starting with `head` plus each character
+        """
+        n = len(head)
+        while lo < hi:
+            key = self.keys[lo]
+            if len(key) <= n:
+                lo += 1
+                continue
+            c_range = self.prefix_range(key[:n + 1], lo, hi)
+            yield key[n], c_range
+            lo = c_range[1]
+
+    def fuzzy_ranges(self, prefix):
+        """
+        Ranges of phrases that start with something one edit away from the query
+
+        As with elasticsearch's fuzzy completion the first character must
+        match exactly. Each edit is only looked for within the range of
+        phrases that share the unedited start of the query, which keeps the
+        number of comparisons small.
+        """
+        head_range = self.prefix_range(prefix[:1])
+        for i in range(1, len(prefix) + 1):
+            if head_range[0] == head_range[1]:
+                return
+            head, tail = prefix[:i], prefix[i:]
+            if tail:
+                # deletion
+                yield self.prefix_range(head + tail[1:], *head_range)
+            if len(tail) > 1:
+                # transposition
+                yield self.prefix_range(head + tail[1] + tail[0] + tail[2:], *head_range)
+            for c, c_range in self.next_characters(head, *head_range):
+                if tail and c != tail[0]:
+                    # substitution
+                    yield self.prefix_range(head + c + tail[1:], *c_range)
+                # insertion
+                yield self.prefix_range(head + c + tail, *c_range)
+            if tail:
+                head_range = self.prefix_range(head + tail[0], *head_range)
+
+    def search(self, query, size=10, fuzzy=True):
+        """
+        Find the records that best complete a query
+
+        Records matching the query exactly come first, followed by those
+        matching with one edit, each ordered by weight.
+        """
+        prefix = normalise_name(query)
+        if not prefix:
+            return []
+
+        results = self.top_records(*self.prefix_range(prefix), size)
+        if fuzzy and len(results) < size:
+            fuzzy_results = set()
+            for start, end in self.fuzzy_ranges(prefix):
+                if end > start:
+                    fuzzy_results.update(self.top_records(start, end, size))
+            fuzzy_results.difference_update(results)
+            results += sorted(fuzzy_results, key=lambda r: -self.weights[r])[:size - len(results)]
+
+        return [self.record(r) for r in results]
+
+
+class LocalAutocomplete:
+    """
+    Keeps an autocomplete index up to date with the output files
+
+    The index file is built from the records file if it doesn't exist or is
+    older than the records. The records file is checked for changes at most
+    once every `interval` seconds.
+    """
+
+    def __init__(self, source, target=None, interval=60):
+        self.source = source
+        self.target = target or re.sub(r'\.jsonl\.gz$', '', source) + ".autocomplete"
+        self.interval = interval
+        self.index = None
+        self.last_checked = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """
+        Open the index file, building it first if needed
+        """
+        if not os.path.exists(self.target) or \
+                os.path.getmtime(self.target) < os.path.getmtime(self.source):
+            build_index(self.source, self.target)
+        self.index = AutocompleteIndex(self.target)
+        self.last_checked = time.monotonic()
+
+    def search(self, query, size=10, fuzzy=True):
+        """
+        Find the records that best complete a query
+        """
+        if time.monotonic() - self.last_checked > self.interval:
+            with self.lock:
+                self.last_checked = time.monotonic()
+                if os.path.getmtime(self.source) > self.index.mtime:
+                    self.load()
+        return self.index.search(query, size=size, fuzzy=fuzzy)
+
+
+def main():
+    """
+    Build an autocomplete index from the command line
+    """
+    parser = argparse.ArgumentParser(description='Build a local autocomplete index from the output files')
+    parser.add_argument('source', help='gzipped JSON lines file of records (eg data/output/all.jsonl.gz)')
+    parser.add_argument('--target', help='file to save the index to')
+    args = parser.parse_args()
+
+    target = args.target or re.sub(r'\.jsonl\.gz$', '', args.source) + ".autocomplete"
+    start = time.perf_counter()
+    n_records, n_keys = build_index(args.source, target)
+    print("[autocomplete] {} names for {} records saved to {} in {:.1f} seconds".format(
+        n_keys, n_records, target, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""
+In-process caches for the server
+"""
+import copy
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalise_term(term):
+    """
+    Normalise a query term so that trivially different queries share a cache entry
+    """
+    return re.sub(r'\s+', ' ', str(term)).strip().lower()
+
+
+class ResultCache:
+    """
+    Bounded least-recently-used cache where entries expire after `ttl` seconds
+
+    A `maxsize` of 0 turns the cache off. If `maxbytes` is given then the
+    cache is also limited by the memory used by the values it holds. With
+    `copy` values are copied going into and out of the cache, so callers can
+    change the values they are given without changing the cached ones.
+    """
+
+    def __init__(self, maxsize=10000, ttl=3600, maxbytes=None, copy=False):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.copy = copy
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, key):
+        _, value, size = self.data.pop(key)
+        self.bytes -= size
+        return value
+
+    def get(self, key):
+        """
+        Fetch a value from the cache, or None if it isn't there
+        """
+        if not self.maxsize:
+            return None
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires, value, _ = item
+            if expires < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(value) if self.copy else value
+
+    def set(self, key, value):
+        """
+        Add a value to the cache, evicting the least recently used entries if needed
+        """
+        if not self.maxsize:
+            return
+        if self.copy:
+            value = copy.deepcopy(value)
+        size = sys.getsizeof(value) if self.maxbytes else 0
+        if self.maxbytes and size > self.maxbytes:
+            return
+        with self.lock:
+            if key in self.data:
+                self._remove(key)
+            self.data[key] = (time.monotonic() + self.ttl, value, size)
+            self.bytes += size
+            while len(self.data) > self.maxsize or \
+                    (self.maxbytes and self.bytes > self.maxbytes):
+                self._remove(next(iter(self.data)))
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Remove everything from the cache
+        """
+        with self.lock:
+            self.data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        Counters describing how the cache has been used
+        """
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "bytes": self.bytes,
+            "maxbytes": self.maxbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class IndexWatcher:
+    """
+    Notice when the index has changed and tell anyone who is interested
+
+    The version of the index (eg its indexing counters) is checked at most
+    once every `interval` seconds. A change means an import has landed, so
+    the registered callbacks are run to invalidate anything derived from
+    the old data.
+    """
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.callbacks = []
+        self.version = None
+        self.last_checked = 0
+        self.lock = threading.Lock()
+
+    def on_change(self, callback):
+        """
+        Register a function to be called when the index changes
+        """
+        self.callbacks.append(callback)
+        return callback
+
+    def check(self, storage):
+        """
+        Check the index for changes if enough time has passed since the last check
+        """
+        now = time.monotonic()
+        if now - self.last_checked < self.interval:
+            return False
+        with self.lock:
+            if now - self.last_checked < self.interval:
+                return False
+            self.last_checked = now
+        try:
+            version = storage.index_version()
+        except Exception:
+            return False
+        return self.update(version)
+
+    def update(self, version):
+        """
+        Record the current version of the index, running the callbacks if it has changed
+        """
+        changed = self.version is not None and version != self.version
+        self.version = version
+        if changed:
+            for callback in self.callbacks:
+                callback()
+        return changed
@@ -1,7 +1,25 @@
+import csv
+import io
+import itertools
+import sqlite3
+
 import bottle
+from elasticsearch.exceptions import TransportError
+
+from es_client import CircuitOpenError
+from records import fetch_records
 
 csv_app = bottle.Bottle()
 
+# number of rows to look up in elasticsearch at a time
+ENRICH_BATCH_SIZE = 500
+
+# fields that are added to a CSV file if none are asked for
+DEFAULT_ENRICH_FIELDS = ["known_as", "geo.postcode", "latest_income"]
+
+# errors that stop a file part way through, once the response has started
+STREAM_ERRORS = (UnicodeDecodeError, csv.Error, CircuitOpenError, TransportError, sqlite3.Error)
+
 
 @csv_app.get('/adddata')
 def uploadcsv():
@@ -9,3 +27,137 @@ def uploadcsv():
     Form for uploading CSV
     """
     return bottle.template('csv_tool', error=None)
+
+
+@csv_app.post('/adddata')
+@csv_app.post('/adddata.csv')
+def enrichcsv():
+    """
+    Add charity data to an uploaded CSV file
+
+    The file can be uploaded as the `csvfile` field of a form, or sent as the
+    body of the request. `charity_number_field` gives the name of the column
+    containing charity numbers and `fields` (which can be repeated) the fields
+    to add to each row.
+
+    The file is read and returned a batch of rows at a time, so it can be
+    as large as needed. The first batch is done before the response starts,
+    so a file that can't be read or a search that isn't available gives an
+    error response rather than an empty file.
+    """
+    # only parse the request as a form if it is one, otherwise bottle would
+    # try to read the whole body into memory
+    if bottle.request.content_type.startswith('multipart/form-data'):
+        params = bottle.request.params
+        upload = bottle.request.files.get('csvfile')
+        if not upload:
+            return bottle.abort(400, 'No file uploaded')
+        csvfile = upload.file
+        filename = upload.raw_filename
+    else:
+        params = bottle.request.query
+        csvfile = bottle.request.body
+        filename = "data.csv"
+
+    charity_number_field = params.get('charity_number_field')
+    if not charity_number_field:
+        return bottle.abort(400, 'No charity number field given')
+    fields = params.getall('fields') or DEFAULT_ENRICH_FIELDS
+
+    reader = csv.reader(io.TextIOWrapper(csvfile, encoding='utf-8-sig', newline=''))
+    try:
+        header = next(reader)
+        if charity_number_field not in header:
+            return bottle.abort(400, 'Column "{}" not found in file'.format(charity_number_field))
+        rows = enrich_rows(reader, header, header.index(charity_number_field), fields)
+        first = next(rows)
+    except StopIteration:
+        return bottle.abort(400, 'Uploaded file is empty')
+    except (UnicodeDecodeError, csv.Error) as error:
+        return bottle.abort(400, 'Could not read file, it should be a UTF-8 encoded CSV file ({})'.format(error))
+
+    bottle.response.content_type = 'text/csv; charset=utf-8'
+    bottle.response.headers['Content-Disposition'] = 'attachment; filename="{}"'.format(
+        filename.rsplit(".", 1)[0] + "_findthatcharity.csv"
+    )
+    return itertools.chain([first], rows)
+
+
+def enrich_rows(reader, header, regno_column, fields, batch_size=ENRICH_BATCH_SIZE):
+    """
+    Generator that adds charity data to rows of a CSV file
+
+    Yields the resulting CSV a batch of rows at a time, starting with the
+    header and the first batch. Errors in the first batch are raised, but
+    after that an error ends the file with a row describing it, as the
+    response has already started.
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(header + ["findthatcharity_" + f for f in fields])
+    batches = row_batches(reader, batch_size)
+    batch = next(batches, [])
+    write_batch(writer, batch, regno_column, fields)
+    written = len(batch)
+    yield pop_output(output)
+
+    try:
+        for batch in batches:
+            write_batch(writer, batch, regno_column, fields)
+            written += len(batch)
+            yield pop_output(output)
+    except STREAM_ERRORS as error:
+        pop_output(output)
+        writer.writerow(["ERROR: the file stopped after {} rows ({})".format(written, error)])
+        yield pop_output(output)
+
+
+def row_batches(reader, batch_size):
+    """
+    Split the rows of a CSV file into lists of `batch_size` rows
+    """
+    while True:
+        batch = list(itertools.islice(reader, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def write_batch(writer, batch, regno_column, fields):
+    """
+    Look up the charities in a batch of rows and write the rows with the extra fields
+    """
+    regnos = [row[regno_column] for row in batch if len(row) > regno_column]
+    records = fetch_records(regnos, csv_app, fields=fields)
+    for row in batch:
+        record = records.get(row[regno_column]) if len(row) > regno_column else None
+        writer.writerow(row + [field_value(record, f) for f in fields])
+
+
+def field_value(record, field):
+    """
+    Get a value from a record for writing to a CSV file
+
+    Dotted field names (eg `geo.postcode`) are looked up in nested records, and
+    lists are joined with semicolons.
+    """
+    value = record
+    for part in field.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    if isinstance(value, list):
+        return "; ".join(
+            str(v.get("number") or v.get("name")) if isinstance(v, dict) else str(v) for v in value
+        )
+    return value
+
+
+def pop_output(output):
+    """
+    Get the contents of a buffer and empty it
+    """
+    value = output.getvalue()
+    output.seek(0)
+    output.truncate(0)
+    return value
@@ -0,0 +1,276 @@
+"""
+Elasticsearch connections for the server
+
+- `create_client` sets up a client with a bounded connection pool, retries
+  and round-robin over several nodes, with nodes that fail being left out
+  for a while
+- `CircuitBreaker` and `BreakerStorage` stop the server from queueing up
+  requests on a cluster that is failing
+- `RequestBudget` is a bottle plugin that gives each route its own
+  elasticsearch timeout, and turns an open circuit into a quick 503
+"""
+import threading
+import time
+from collections.abc import Iterator
+
+import bottle
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, TransportError
+
+# response codes from elasticsearch that mean the request is worth retrying
+RETRY_ON_STATUS = (429, 502, 503, 504)
+
+
+def parse_hosts(hosts):
+    """
+    Split a comma separated list of elasticsearch urls
+    """
+    if isinstance(hosts, str):
+        hosts = hosts.split(",")
+    return [h.strip() for h in hosts if h and h.strip()]
+
+
+def create_client(hosts, timeout=10, maxsize=10, max_retries=3,
+                  retry_on_status=RETRY_ON_STATUS, retry_on_timeout=False, dead_timeout=60):
+    """
+    Create an elasticsearch client
+
+    `hosts` is a list of urls or host dictionaries. Requests are spread
+    across them in turn, and a node that fails is left out for `dead_timeout`
+    seconds (doubling each time it fails again). `maxsize` is the number of
+    connections kept open to each node, `timeout` the default time allowed
+    for each request, and failed requests are retried on another node up to
+    `max_retries` times. Requests that time out are only retried if
+    `retry_on_timeout` is true, as each retry gets the whole `timeout` again.
+    """
+    return Elasticsearch(
+        hosts,
+        timeout=timeout,
+        maxsize=maxsize,
+        max_retries=max_retries,
+        retry_on_status=tuple(retry_on_status),
+        retry_on_timeout=retry_on_timeout,
+        dead_timeout=dead_timeout,
+    )
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of making a request while the circuit breaker is open
+    """
+
+
+def is_failure(error):
+    """
+    Whether an error means the cluster is struggling, rather than a bad request
+    """
+    if isinstance(error, (ESConnectionError, CircuitOpenError)):
+        return True
+    if isinstance(error, TransportError):
+        return error.status_code == 'N/A' or error.status_code in RETRY_ON_STATUS or \
+            (isinstance(error.status_code, int) and error.status_code >= 500)
+    return False
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing service for a while
+
+    After `threshold` failures in a row the circuit opens and calls fail
+    straight away. After `reset_timeout` seconds one call is let through to
+    test the service: if it works the circuit closes again, otherwise it
+    stays open for another `reset_timeout` seconds.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def retry_after(self):
+        """
+        Seconds until a call will be let through again
+        """
+        if self.opened is None:
+            return 0
+        return max(0, int(self.reset_timeout - (time.monotonic() - self.opened)) + 1)
+
+    def allow(self):
+        """
+        Whether a call can be made now
+        """
+        if not self.threshold:
+            return True
+        with self.lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.threshold:
+                if self.opened is None or self.trial_running:
+                    self.trips += 1
+                self.opened = time.monotonic()
+            self.trial_running = False
+
+    def stats(self):
+        """
+        Counters describing the state of the breaker
+        """
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
+
+
+class BreakerStorage:
+    """
+    Storage that passes calls through a circuit breaker
+
+    While the breaker is open calls raise `CircuitOpenError` without
+    touching the wrapped storage, so anything that can fall back to local or
+    cached data (eg `LocalRecordStorage`) does so straight away.
+    """
+
+    # methods that don't talk to the cluster
+    LOCAL_METHODS = {"reopen", "set_request_timeout"}
+    # methods returning a generator, which makes its requests as it is iterated over
+    GENERATOR_METHODS = {"scan"}
+
+    def __init__(self, storage, breaker):
+        self.storage = storage
+        self.breaker = breaker
+
+    def __getattr__(self, name):
+        if name in ("storage", "breaker"):
+            raise AttributeError(name)
+        attr = getattr(self.storage, name)
+        if not callable(attr) or name in self.LOCAL_METHODS:
+            return attr
+        if name in self.GENERATOR_METHODS:
+            return lambda *args, **kwargs: self._iterate(attr, *args, **kwargs)
+
+        def call(*args, **kwargs):
+            if not self.breaker.allow():
+                raise CircuitOpenError("elasticsearch is unavailable")
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as error:
+                self._record(error)
+                raise
+            self.breaker.record_success()
+            return result
+
+        return call
+
+    def _iterate(self, method, *args, **kwargs):
+        """
+        Go through a generator from the wrapped storage, recording the outcome once it has run
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError("elasticsearch is unavailable")
+        try:
+            for item in method(*args, **kwargs):
+                yield item
+        except GeneratorExit:
+            # stopped early, but the requests made so far worked
+            self.breaker.record_success()
+            raise
+        except Exception as error:
+            self._record(error)
+            raise
+        self.breaker.record_success()
+
+    def _record(self, error):
+        if is_failure(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+
+class RequestBudget:
+    """
+    Bottle plugin giving each route a time limit for its elasticsearch requests
+
+    `timeouts` maps the names of route functions to seconds, other routes
+    use the client's default timeout. A route that fails because the circuit
+    breaker is open gets a 503 response. Routes that stream their response
+    (by returning a generator) get the time limit again while each part of
+    the response is made.
+    """
+    name = "request_budget"
+    api = 2
+
+    def __init__(self, timeouts=None):
+        self.timeouts = timeouts or {}
+
+    def apply(self, callback, route):
+        timeout = self.timeouts.get(route.callback.__name__)
+
+        def wrapper(*args, **kwargs):
+            storage = route.app.config.get("storage")
+            set_timeout = getattr(storage, "set_request_timeout", None)
+            if set_timeout and timeout:
+                set_timeout(timeout)
+            try:
+                result = callback(*args, **kwargs)
+                if set_timeout and timeout and isinstance(result, Iterator):
+                    return budgeted(result, set_timeout, timeout)
+                return result
+            except CircuitOpenError:
+                breaker = route.app.config.get("breaker")
+                retry_after = breaker.retry_after() if breaker else 30
+                raise bottle.HTTPError(503, "Search is temporarily unavailable, please try again shortly.",
+                                       **{"Retry-After": str(retry_after)})
+            finally:
+                if set_timeout and timeout:
+                    set_timeout(None)
+
+        return wrapper
+
+
+def budgeted(parts, set_timeout, timeout):
+    """
+    Generator that sets the request timeout while each part of a streamed response is made
+    """
+    while True:
+        set_timeout(timeout)
+        try:
+            part = next(parts)
+        except StopIteration:
+            return
+        finally:
+            set_timeout(None)
+        yield part
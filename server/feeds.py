@@ -0,0 +1,126 @@
+"""
+Feeds of data released by the regulators
+"""
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timezone
+
+from dateutil import parser
+import requests
+from bs4 import BeautifulSoup
+
+CCEW_URL = 'http://data.charitycommission.gov.uk/'
+
+
+class CCEWFeed:
+    """
+    Downloads listed on the Charity Commission data page
+
+    The page is fetched again in a background thread once the cached copy is
+    older than `ttl` seconds, using a conditional GET so an unchanged page
+    isn't downloaded again. Until the refresh finishes, and if it fails, the
+    last good copy is used. Until the page has been fetched once there are
+    no items (`loaded` is false), and fetching is tried again every `retry`
+    seconds.
+    """
+
+    def __init__(self, url=CCEW_URL, ttl=3600, timeout=30, retry=60):
+        self.url = url
+        self.ttl = ttl
+        self.retry = retry
+        self.timeout = timeout
+        self.items = None
+        self.version = None
+        self.updated = None
+        self.etag = None
+        self.last_modified = None
+        self.fetched = 0
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def get_items(self):
+        """
+        Get the feed items, refreshing them in the background if they're out of date
+
+        Returns an empty list until the page has been fetched.
+        """
+        age = time.monotonic() - self.fetched
+        if (self.items is None and (not self.fetched or age > self.retry)) or age > self.ttl:
+            self.refresh_async()
+        return self.items or []
+
+    @property
+    def loaded(self):
+        return self.items is not None
+
+    def refresh_async(self):
+        """
+        Refresh the feed in a background thread
+        """
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self.refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def refresh(self):
+        """
+        Fetch the page if it has changed since it was last fetched
+        """
+        headers = {}
+        if self.items is not None:
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
+        try:
+            res = requests.get(self.url, headers=headers, timeout=self.timeout)
+            if res.status_code == 304:
+                self.fetched = time.monotonic()
+                return
+            res.raise_for_status()
+            items = self.parse(res.text)
+        except (requests.RequestException, ValueError, AttributeError, IndexError):
+            # keep the last good copy and try again after the ttl
+            self.fetched = time.monotonic()
+            return
+
+        version = hashlib.sha1(
+            json.dumps(items, default=str, sort_keys=True).encode("utf8")
+        ).hexdigest()[:16]
+        if version != self.version:
+            self.items = items
+            self.version = version
+            self.updated = datetime.now().replace(tzinfo=timezone.utc, microsecond=0)
+        self.etag = res.headers.get("ETag")
+        self.last_modified = res.headers.get("Last-Modified")
+        self.fetched = time.monotonic()
+
+    def parse(self, html):
+        """
+        Get the list of downloads from the page
+        """
+        soup = BeautifulSoup(html, 'html.parser')
+        items = []
+        for i in soup.find_all('blockquote'):
+            links = i.find_all('a')
+            idate = parser.parse(
+                i.h4.string.split(", ")[1],
+                default=datetime(2018, 1, 12, 0, 0)
+            ).replace(tzinfo=timezone.utc)
+            items.append({
+                "name": i.h4.string,
+                "date": idate,
+                "link": links[0].get('href'),
+                "author": "Charity Commission for England and Wales",
+            })
+        return items
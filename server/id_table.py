@@ -0,0 +1,108 @@
+"""
+Tables of record ids used for picking a random record
+"""
+import array
+import logging
+import random
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class IdTable:
+    """
+    Compact list of ids
+
+    The ids are stored end to end in one bytes object with an array of
+    offsets, rather than as a list of python strings.
+    """
+
+    def __init__(self, ids=()):
+        offsets = array.array('I', [0])
+        blob = bytearray()
+        for record_id in ids:
+            blob.extend(record_id.encode("utf8"))
+            offsets.append(len(blob))
+        self.offsets = offsets
+        self.blob = bytes(blob)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].decode("utf8")
+
+    def random_id(self):
+        """
+        Pick an id at random
+        """
+        if not len(self):
+            return None
+        return self[random.randrange(len(self))]
+
+
+class RandomIds:
+    """
+    Tables of all ids and of active ids in the index
+
+    The tables are filled in a background thread, and refilled when
+    `refresh` is called (eg when the index changes). A refresh asked for
+    while one is running is run once that one finishes. Until the first
+    fill has finished `random_id` returns None.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.all_ids = None
+        self.active_ids = None
+        self.refreshing = False
+        self.pending = False
+        self.lock = threading.Lock()
+
+    def fetch(self):
+        """
+        Fetch every id in the index and rebuild the tables
+        """
+        all_ids = []
+        active_ids = []
+        for doc in self.storage.scan(source_include=["active"]):
+            all_ids.append(doc["_id"])
+            if doc.get("_source", {}).get("active"):
+                active_ids.append(doc["_id"])
+        self.all_ids = IdTable(all_ids)
+        self.active_ids = IdTable(active_ids)
+
+    def refresh(self):
+        """
+        Rebuild the tables in a background thread
+        """
+        with self.lock:
+            if self.refreshing:
+                # the running refresh may have read the index before it changed
+                self.pending = True
+                return
+            self.refreshing = True
+
+        def run():
+            while True:
+                try:
+                    self.fetch()
+                except Exception:
+                    logger.exception("Refreshing the random id tables failed")
+                with self.lock:
+                    if not self.pending:
+                        self.refreshing = False
+                        return
+                    self.pending = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def random_id(self, active=False):
+        """
+        Pick a random id from the index, or None if the tables aren't ready yet
+        """
+        if self.all_ids is None:
+            self.refresh()
+            return None
+        table = self.active_ids if active else self.all_ids
+        return table.random_id()
@@ -0,0 +1,475 @@
+"""
+Request metrics for the server, in the Prometheus text format
+
+`MetricsMiddleware` wraps the WSGI app and records how long each route
+takes, how big its responses are and the status codes it returns. Within a
+request, time spent waiting for the storage (elasticsearch) and rendering
+templates is added up with `timed`, so the total can be split into storage,
+rendering and python time. `TimedStorage` times every storage call and
+records the `took` time reported by elasticsearch.
+
+Everything is kept in memory in each worker and exposed at `/metrics`. When
+the server runs several worker processes, `SharedMetrics` saves each
+worker's metrics to a shared folder so `/metrics` can add them all up.
+"""
+import atexit
+import bisect
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+# upper bounds of the buckets used for timings, in seconds
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# upper bounds of the buckets used for response sizes, in bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# upper bounds of the buckets used for the number of queries in a batch
+BATCH_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for n, v in zip(names, values)
+    ) + "}"
+
+
+class Counter:
+    """
+    Count of things that have happened, by label
+    """
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] += amount
+
+    def empty(self):
+        return Counter(self.name, self.help, self.labels)
+
+    def export(self):
+        with self.lock:
+            return [[list(k), v] for k, v in self.values.items()]
+
+    def add(self, values):
+        """
+        Add values from `export` (eg from another worker)
+        """
+        with self.lock:
+            for label_values, value in values:
+                self.values[tuple(label_values)] += value
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        for label_values, value in sorted(items):
+            yield self.name + _labels(self.labels, label_values), value
+
+
+class Histogram:
+    """
+    Distribution of observed values, by label
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                # one count per bucket, then +Inf, then the sum
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def empty(self):
+        return Histogram(self.name, self.help, self.labels, self.buckets)
+
+    def export(self):
+        with self.lock:
+            return [[list(k), list(v)] for k, v in self.values.items()]
+
+    def add(self, values):
+        """
+        Add values from `export` (eg from another worker)
+        """
+        with self.lock:
+            for label_values, counts in values:
+                current = self.values.setdefault(tuple(label_values), [0] * (len(self.buckets) + 1) + [0.0])
+                for i, count in enumerate(counts):
+                    current[i] += count
+
+    def samples(self):
+        with self.lock:
+            items = [(k, list(v)) for k, v in self.values.items()]
+        labels = self.labels + ("le",)
+        for label_values, counts in sorted(items):
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                yield self.name + "_bucket" + _labels(labels, label_values + (bound,)), total
+            yield self.name + "_sum" + _labels(self.labels, label_values), counts[-1]
+            yield self.name + "_count" + _labels(self.labels, label_values), total
+
+
+class Registry:
+    """
+    Collection of metrics, and of functions that report values when scraped
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=TIME_BUCKETS):
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def collector(self, func):
+        """
+        Register a function returning `(name, kind, help, [(labels, value)])` tuples
+        """
+        self.collectors.append(func)
+        return func
+
+    def render(self):
+        """
+        All the metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            lines.extend("{} {}".format(name, _format(value)) for name, value in metric.samples())
+        for func in self.collectors:
+            for name, kind, help_text, samples in func():
+                lines.append("# HELP {} {}".format(name, help_text))
+                lines.append("# TYPE {} {}".format(name, kind))
+                for labels, value in samples:
+                    lines.append("{}{} {}".format(
+                        name, _labels(tuple(labels.keys()), tuple(labels.values())), _format(value)))
+        return "\n".join(lines) + "\n"
+
+
+class SharedMetrics:
+    """
+    Metrics from all the worker processes of a server, shared through files in `folder`
+
+    Each worker saves its metrics (and the values reported by the registry's
+    collectors) to `<folder>/<pid>.json` when it exits, and after a request
+    if it hasn't for `interval` seconds (`save_if_due`). `render` adds up the
+    files from every worker. Workers that have stopped still count towards
+    the counters and histograms, but not the gauges. The folder should be
+    emptied when the server is started.
+    """
+
+    def __init__(self, registry, folder, interval=5):
+        self.registry = registry
+        self.folder = folder
+        self.interval = interval
+        self.last_saved = None
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        atexit.register(self.save)
+
+    def save(self):
+        """
+        Save this worker's metrics
+        """
+        snapshot = {
+            "metrics": {metric.name: metric.export() for metric in self.registry.metrics},
+            "collected": [
+                [name, kind, help_text, [[labels, value] for labels, value in samples]]
+                for func in self.registry.collectors for name, kind, help_text, samples in func()
+            ],
+        }
+        with self.lock:
+            path = os.path.join(self.folder, "{}.json".format(os.getpid()))
+            with open(path + ".tmp", "w") as f:
+                json.dump(snapshot, f)
+            os.replace(path + ".tmp", path)
+            self.last_saved = time.monotonic()
+
+    def save_if_due(self):
+        if self.last_saved is None or time.monotonic() - self.last_saved >= self.interval:
+            self.save()
+
+    def snapshots(self):
+        """
+        The metrics saved by each worker, as (pid, snapshot) tuples
+        """
+        for filename in sorted(os.listdir(self.folder)):
+            name, ext = os.path.splitext(filename)
+            if ext != ".json" or not name.isdigit():
+                continue
+            try:
+                with open(os.path.join(self.folder, filename)) as f:
+                    yield int(name), json.load(f)
+            except (OSError, ValueError):
+                continue
+
+    def render(self):
+        """
+        The metrics of all the workers added up, in the Prometheus text format
+        """
+        self.save()
+        merged = Registry()
+        metrics = {metric.name: merged.register(metric.empty()) for metric in self.registry.metrics}
+        collected = OrderedDict()
+        for pid, snapshot in self.snapshots():
+            running = _running(pid)
+            for name, values in snapshot.get("metrics", {}).items():
+                if name in metrics:
+                    metrics[name].add(values)
+            for name, kind, help_text, samples in snapshot.get("collected", []):
+                if kind == "gauge" and not running:
+                    continue
+                _, _, values = collected.setdefault(name, (kind, help_text, OrderedDict()))
+                for labels, value in samples:
+                    key = tuple(sorted(labels.items()))
+                    values[key] = values.get(key, 0) + value
+        merged.collector(lambda: [
+            (name, kind, help_text, [(OrderedDict(key), value) for key, value in values.items()])
+            for name, (kind, help_text, values) in collected.items()
+        ])
+        return merged.render()
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _format(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    "ftc_request_seconds", "Time taken to respond to a request", ("route", "method"))
+STORAGE_SECONDS = registry.histogram(
+    "ftc_request_storage_seconds", "Time spent waiting for the storage during a request", ("route",))
+RENDER_SECONDS = registry.histogram(
+    "ftc_request_render_seconds", "Time spent rendering templates during a request", ("route",))
+PYTHON_SECONDS = registry.histogram(
+    "ftc_request_python_seconds", "Time spent in the rest of the python code during a request", ("route",))
+ES_TOOK_SECONDS = registry.histogram(
+    "ftc_es_took_seconds", "Time elasticsearch reported it took to run the queries in a request", ("route",))
+RESPONSE_BYTES = registry.histogram(
+    "ftc_response_bytes", "Size of response bodies", ("route",), buckets=SIZE_BUCKETS)
+RESPONSES = registry.counter(
+    "ftc_responses_total", "Number of responses sent", ("route", "status"))
+STORAGE_CALLS = registry.histogram(
+    "ftc_storage_call_seconds", "Time taken by each call to the storage", ("method",))
+STORAGE_ERRORS = registry.counter(
+    "ftc_storage_errors_total", "Number of calls to the storage that failed", ("method", "error"))
+BATCH_SIZE = registry.histogram(
+    "ftc_batch_size", "Number of queries or records asked for in one batch request", ("route",),
+    buckets=BATCH_BUCKETS)
+
+
+class RequestTimings(threading.local):
+    """
+    Time spent on each part of the request being handled by this thread
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.storage = 0.0
+        self.render = 0.0
+        self.took = 0.0
+
+
+timings = RequestTimings()
+
+
+@contextmanager
+def timed(part):
+    """
+    Add the time taken to a part (`storage` or `render`) of the current request
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        setattr(timings, part, getattr(timings, part) + time.perf_counter() - start)
+
+
+def es_took(res):
+    """
+    Seconds elasticsearch reports that it took to run the queries in a response
+
+    Multi search queries run in parallel, so the longest of them is used.
+    """
+    if not isinstance(res, dict):
+        return 0.0
+    if "took" in res:
+        return res["took"] / 1000
+    return max([r.get("took", 0) for r in res.get("responses", [])] or [0]) / 1000
+
+
+class TimedStorage:
+    """
+    Storage that times each call to the storage it wraps
+    """
+
+    # methods that don't talk to the storage, or that are run outside requests
+    UNTIMED_METHODS = {"reopen", "set_request_timeout", "scan", "bulk", "index_version"}
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, name):
+        if name == "storage":
+            raise AttributeError(name)
+        attr = getattr(self.storage, name)
+        if not callable(attr) or name in self.UNTIMED_METHODS:
+            return attr
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                res = attr(*args, **kwargs)
+            except Exception as error:
+                STORAGE_ERRORS.inc(name, type(error).__name__)
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                STORAGE_CALLS.observe(elapsed, name)
+                timings.storage += elapsed
+            timings.took += es_took(res)
+            return res
+
+        return call
+
+
+class MetricsMiddleware:
+    """
+    WSGI middleware recording the time taken, size and status of each response
+
+    Routes are labelled by their rule (eg `/charity/<regno>`), so the number
+    of labels stays small. If `shared` (a `SharedMetrics`) is given the
+    metrics are saved for the other workers after each request, when due.
+    """
+
+    def __init__(self, app, shared=None):
+        self.app = app
+        self.shared = shared
+
+    def __call__(self, environ, start_response):
+        timings.reset()
+        start = time.perf_counter()
+        status = []
+
+        def _start_response(status_line, headers, exc_info=None):
+            status.append(status_line.split(" ", 1)[0])
+            return start_response(status_line, headers, exc_info)
+
+        body = self.app(environ, _start_response)
+        return _CountedBody(body, environ, status, start, self.shared)
+
+
+class _CountedBody:
+    """
+    Response body that records the request's metrics once it has been sent
+    """
+
+    def __init__(self, body, environ, status, start, shared=None):
+        self.body = body
+        self.environ = environ
+        self.status = status
+        self.start = start
+        self.shared = shared
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        if hasattr(self.body, "close"):
+            self.body.close()
+        route = self.environ.get("bottle.route")
+        rule = route.rule if route is not None else "none"
+        total = time.perf_counter() - self.start
+        storage = timings.storage
+        render = timings.render
+        REQUEST_SECONDS.observe(total, rule, self.environ.get("REQUEST_METHOD"))
+        STORAGE_SECONDS.observe(storage, rule)
+        RENDER_SECONDS.observe(render, rule)
+        PYTHON_SECONDS.observe(max(0.0, total - storage - render), rule)
+        if timings.took:
+            ES_TOOK_SECONDS.observe(timings.took, rule)
+        RESPONSE_BYTES.observe(self.size, rule)
+        RESPONSES.inc(rule, self.status[0] if self.status else "none")
+        if self.shared:
+            self.shared.save_if_due()
+
+
+def percentile(values, pct):
+    """
+    Value below which `pct` percent of the values fall (nearest rank), or None if there are none
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, int(math.ceil(pct / 100 * len(values))))
+    return values[rank - 1]
+
+
+def cache_collector(caches):
+    """
+    Create a collector reporting the stats of `ResultCache`s, given as a dictionary of name -> cache
+    """
+    def collect():
+        stats = {name: cache.stats() for name, cache in caches().items()}
+        for key, kind, help_text in [
+                ("hits", "counter", "Number of lookups found in the cache"),
+                ("misses", "counter", "Number of lookups not found in the cache"),
+                ("evictions", "counter", "Number of entries removed to make space"),
+                ("expirations", "counter", "Number of entries removed because they were too old"),
+                ("size", "gauge", "Number of entries in the cache"),
+                ("bytes", "gauge", "Memory used by the values in the cache, if it is limited by size")]:
+            suffix = "_total" if kind == "counter" else ""
+            yield ("ftc_cache_{}{}".format(key, suffix), kind, help_text,
+                   [({"cache": name}, s.get(key) or 0) for name, s in stats.items()])
+    return collect
@@ -2,28 +2,164 @@
 Useful functions for creating queries
 """
 import json
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
 import yaml
 
+from cache import normalise_term
+
+
+class QueryTemplate:
+    """
+    A search template parsed from a yaml file
+
+    The file is only read again if its modification time changes.
+    """
+
+    def __init__(self, name, filename):
+        self.name = name
+        self.filename = filename
+        self.source = None
+        self.params = []
+        self.mtime = None
+        self.version = None
+        self.stored_id = None
+        self.load()
+
+    def load(self):
+        """
+        Parse the yaml file and note when it was last modified
+        """
+        mtime = os.path.getmtime(self.filename)
+        with open(self.filename, 'rb') as yaml_file:
+            json_q = yaml.safe_load(yaml_file)
+        self.source = json_q["inline"]
+        self.params = list(json_q["params"].keys())
+        self.mtime = mtime
+        self.version = hashlib.sha1(json.dumps(self.source, sort_keys=True).encode("utf8")).hexdigest()[:10]
+        self.stored_id = None
+
+    def is_stale(self):
+        """
+        Check whether the file has changed since it was loaded
+        """
+        try:
+            return os.path.getmtime(self.filename) != self.mtime
+        except OSError:
+            return False
+
+    @property
+    def template_id(self):
+        """
+        Identifier for this version of the template
+
+        Includes a hash of the template contents so that a changed template
+        is stored under a new id rather than overwriting one that other
+        workers may still be using.
+        """
+        return "findthatcharity-{}-{}".format(self.name, self.version)
+
+    def store(self, es):
+        """
+        Register the template as a stored search template in elasticsearch
+        """
+        template_id = self.template_id
+        es.put_template(id=template_id, body={"template": self.source})
+        self.stored_id = template_id
+
+    def cache_key(self, term):
+        """
+        Key used to cache the results of this template for a query term
+        """
+        return (self.name, self.version, normalise_term(term))
+
+    def render(self, term):
+        """
+        Create the body of a search template request for a query term
+        """
+        params = {param: term for param in self.params}
+        if self.stored_id:
+            return {"id": self.stored_id, "params": params}
+        return {"inline": self.source, "params": params}
+
+
+class TemplateRegistry:
+    """
+    Holds the query templates used by the server
+
+    Templates are parsed once when registered and reloaded when their file
+    changes. If `use_stored` is set they are also stored in elasticsearch,
+    so only the template id and parameters are sent with each search.
+    """
+
+    def __init__(self):
+        self.templates = {}
+        self.es = None
+        self.lock = threading.Lock()
+
+    def register(self, name, filename):
+        """
+        Add a template from a yaml file
+        """
+        self.templates[name] = QueryTemplate(name, filename)
+        if self.es:
+            self.templates[name].store(self.es)
+        return self.templates[name]
+
+    def use_stored(self, es):
+        """
+        Store all templates in elasticsearch and use them by id
+        """
+        self.es = es
+        for template in self.templates.values():
+            template.store(es)
+
+    def get(self, name):
+        """
+        Fetch a template, reloading it if the file has changed
+        """
+        template = self.templates[name]
+        if template.is_stale():
+            with self.lock:
+                if template.is_stale():
+                    template.load()
+                    if self.es:
+                        template.store(self.es)
+        return template
+
+    def render(self, name, term):
+        """
+        Create a search template request body for a query term
+        """
+        return self.get(name).render(term)
+
+    def cache_key(self, name, term):
+        """
+        Key used to cache the results of a template for a query term
+        """
+        return self.get(name).cache_key(term)
+
+
+templates = TemplateRegistry()
+templates.register("search", './es_config.yml')
+templates.register("recon", './recon_config.yml')
+
+
 def search_query(term):
     """
     Fetch the search query and insert the query term
     """
-    with open('./es_config.yml', 'rb') as yaml_file:
-        json_q = yaml.load(yaml_file)
-        for param in json_q["params"]:
-            json_q["params"][param] = term
-        return json.dumps(json_q)
+    return templates.render("search", term)
 
 
 def recon_query(term):
     """
     Fetch the reconciliation query and insert the query term
     """
-    with open('./recon_config.yml', 'rb') as yaml_file:
-        json_q = yaml.load(yaml_file)
-        for param in json_q["params"]:
-            json_q["params"][param] = term
-        return json.dumps(json_q)
+    return templates.render("recon", term)
 
 
 def esdoc_orresponse(query, app):
@@ -31,12 +167,63 @@ def esdoc_orresponse(query, app):
 
     Specification found here: https://github.com/OpenRefine/OpenRefine/wiki/Reconciliation-Service-API#service-metadata
     """
-    res = app.config["es"].search_template(
-        index=app.config["es_index"],
-        doc_type=app.config["es_type"],
-        body=query,
-        ignore=[404]
-    )
+    cache = app.config.get("result_cache")
+    cache_key = templates.cache_key("recon", query["params"]["name"])
+    if cache is not None:
+        result = cache.get(cache_key)
+        if result is not None:
+            return result
+
+    res = app.config["storage"].search_template(query)
+    result = recon_response(res, query)
+    if cache is not None:
+        cache.set(cache_key, result)
+    return result
+
+
+def esdoc_orresponses(queries, app):
+    """Run a batch of reconciliation queries in one multi search template request
+
+    `queries` is a list of `(query_id, query)` pairs. The results are returned as
+    a dictionary keyed by the query id, in the same order as the queries. A query
+    that fails on the elasticsearch side gets an empty result list rather than
+    failing the whole batch. Results already in the result cache are not
+    fetched again.
+    """
+    results = OrderedDict((query_id, None) for query_id, _ in queries)
+    cache = app.config.get("result_cache")
+    to_fetch = []
+    for query_id, query in queries:
+        cache_key = templates.cache_key("recon", query["params"]["name"])
+        result = cache.get(cache_key) if cache is not None else None
+        if result is not None:
+            results[query_id] = {"result": result["result"]}
+        else:
+            to_fetch.append((query_id, query, cache_key))
+
+    if not to_fetch:
+        return results
+
+    res = app.config["storage"].msearch_template([query for _, query, _ in to_fetch])
+
+    for (query_id, query, cache_key), sub_res in zip(to_fetch, res.get("responses", [])):
+        if "error" in sub_res or "hits" not in sub_res:
+            results[query_id] = {"result": []}
+            continue
+        result = recon_response(sub_res, query)
+        if cache is not None:
+            cache.set(cache_key, result)
+        results[query_id] = {"result": result["result"]}
+
+    for query_id in results:
+        if results[query_id] is None:
+            results[query_id] = {"result": []}
+    return results
+
+
+def recon_response(res, query):
+    """Turn an elasticsearch search response into reconciliation results
+    """
     res["hits"]["result"] = res["hits"].pop("hits")
     for i in res["hits"]["result"]:
         i["id"] = i.pop("_id")
@@ -47,7 +234,9 @@ def esdoc_orresponse(query, app):
         i["name"] = i["source"]["known_as"] + " (" + i["id"] + ")"
         if not i["source"]["active"]:
             i["name"] += " [INACTIVE]"
-        if i["source"]["known_as"].lower() == json.loads(query)["params"]["name"].lower() and i["score"] == res["hits"]["max_score"]:
+        # the same normalised term as the result cache key, so cached results match in the same way
+        if normalise_term(i["source"]["known_as"]) == normalise_term(query["params"]["name"]) and \
+                i["score"] == res["hits"]["max_score"]:
             i["match"] = True
         else:
             i["match"] = False
@@ -74,5 +263,111 @@ def service_spec(app, service_url):
         "defaultTypes": [{
             "id": "/" + app.config["es_type"],
             "name": app.config["es_type"]
-        }]
+        }],
+        "extend": {
+            "propose_properties": {
+                "service_url": service_url,
+                "service_path": "/reconcile/propose_properties"
+            },
+            "property_settings": []
+        }
+    }
+
+
+# properties that can be added to reconciled records with the data extension API,
+# as id -> (name, field in the record, type of value)
+EXTEND_PROPERTIES = OrderedDict([
+    ("known_as", ("Name", "known_as", "str")),
+    ("postcode", ("Postcode", "geo.postcode", "str")),
+    ("latest_income", ("Latest income", "latest_income", "float")),
+    ("company_number", ("Company number", "company_number", "str")),
+    ("org-ids", ("Org IDs", "org-ids", "str")),
+    ("ccew_number", ("Charity Commission for England and Wales number", "ccew_number", "str")),
+    ("oscr_number", ("Office of the Scottish Charity Regulator number", "oscr_number", "str")),
+    ("ccni_number", ("Charity Commission for Northern Ireland number", "ccni_number", "str")),
+    ("date_registered", ("Date registered", "date_registered", "date")),
+    ("date_removed", ("Date removed", "date_removed", "date")),
+    ("active", ("Active", "active", "bool")),
+    ("url", ("Website", "url", "str")),
+])
+
+
+def propose_properties(app, limit=None):
+    """Return the properties that can be added to reconciled records
+
+    Specification found here: https://github.com/OpenRefine/OpenRefine/wiki/Data-Extension-API
+    """
+    properties = [
+        {"id": prop_id, "name": name}
+        for prop_id, (name, _, _) in EXTEND_PROPERTIES.items()
+    ]
+    return {
+        "type": app.config["es_type"],
+        "properties": properties[:limit] if limit else properties,
+    }
+
+
+def extend_fields(extend):
+    """
+    The record fields needed for a data extension request
+    """
+    return list(OrderedDict.fromkeys(
+        EXTEND_PROPERTIES[p["id"]][1] for p in extend.get("properties", [])
+        if p.get("id") in EXTEND_PROPERTIES
+    ))
+
+
+def extend_response(extend, records):
+    """Create the response to a data extension request
+
+    `extend` is the request, like `{"ids": ["123456"], "properties": [{"id": "postcode"}]}`,
+    and `records` a dictionary of the records for those ids (with `None` for
+    any that weren't found), containing at least the fields from `extend_fields`.
+    """
+    properties = [p["id"] for p in extend.get("properties", []) if p.get("id")]
+    rows = OrderedDict()
+    for record_id in extend.get("ids", []):
+        # ids may be sent as numbers, but the records are keyed by strings
+        record_id = str(record_id)
+        record = records.get(record_id)
+        rows[record_id] = OrderedDict(
+            (prop_id, extend_values(record, prop_id)) for prop_id in properties
+        )
+    return {
+        "meta": [
+            {"id": prop_id, "name": EXTEND_PROPERTIES.get(prop_id, (prop_id,))[0]}
+            for prop_id in properties
+        ],
+        "rows": rows,
     }
+
+
+def extend_values(record, prop_id):
+    """
+    Get the values of a property from a record, in the form used by the data extension API
+    """
+    if not record or prop_id not in EXTEND_PROPERTIES:
+        return []
+    _, field, value_type = EXTEND_PROPERTIES[prop_id]
+    value = record
+    for part in field.split("."):
+        if not isinstance(value, dict):
+            return []
+        value = value.get(part)
+    values = value if isinstance(value, list) else [value]
+    cells = []
+    for value in values:
+        if isinstance(value, dict):
+            value = value.get("number") or value.get("name")
+        if value is None or value == "":
+            continue
+        if value_type == "float":
+            value = float(value)
+        elif value_type == "bool":
+            value = bool(value)
+        elif value_type == "date" and hasattr(value, "isoformat"):
+            value = value.isoformat()
+        else:
+            value = str(value)
+        cells.append({value_type: value})
+    return cells
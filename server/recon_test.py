@@ -1,7 +1,31 @@
+"""
+Check how well reconciliation queries find the right charity, and how quickly
+
+Each query is run for the names in a sample of grants from GrantNav that
+give the recipient's charity number, and the top result is compared with
+that number. Any of the `recon_test_*` queries below, the templates used by
+the server (`recon`, `search`) or a template in a yaml file can be checked,
+and several can be compared in one run:
+
+    python server/recon_test.py run data/grantnav_test_sample.csv --query recon --query 7 --query my_template.yml --concurrency 8
+
+The sample is made from a GrantNav CSV download with:
+
+    python server/recon_test.py sample data/grantnav.csv data/grantnav_test_sample.csv
+
+Run it from the root of the repository, as the server's templates are read from there.
+"""
+import argparse
 import csv
+import json
+import os
+import random
 import time
-from elasticsearch import Elasticsearch
-es = Elasticsearch()
+from concurrent.futures import ThreadPoolExecutor
+
+from es_client import create_client, parse_hosts
+from metrics import percentile
+from queries import QueryTemplate, templates
 
 TEST_FILE = "data/grantnav_test_sample.csv"
 MISMATCH_FILE = "data/test_mismatches.csv"
@@ -9,10 +33,12 @@ ES_INDEX = "charitysearch"
 ES_TYPE = "charity"
 
 
-def get_test_set():
-
-    with open("data/grantnav.csv", encoding="utf-8") as grantnav:
-        with open("data/grantnav_test.csv", "w", encoding="utf-8") as test_file:
+def get_test_set(grantnav_file="data/grantnav.csv", test_set_file="data/grantnav_test.csv"):
+    """
+    Get the grants to charities with a charity number from a GrantNav CSV download
+    """
+    with open(grantnav_file, encoding="utf-8") as grantnav:
+        with open(test_set_file, "w", encoding="utf-8") as test_file:
             reader = csv.DictReader(grantnav)
             writer = csv.writer(test_file, lineterminator='\r')
             writer.writerow(["charitynumber", "name", "company_number"])
@@ -28,14 +54,16 @@ def get_test_set():
                     writer.writerow([charitynumber, grant["Recipient Org:Name"].encode("utf-8").decode("utf-8"), grant["Recipient Org:Company Number"].strip()])
 
 
-def get_test_sample(sample_size=10000):
-    import random
-    with open("data/grantnav_test.csv", encoding="utf-8") as test_file:
-        with open(TEST_FILE, "w", encoding="utf-8") as sample_file:
+def get_test_sample(sample_size=10000, test_set_file="data/grantnav_test.csv", sample_file_name=TEST_FILE):
+    """
+    Pick a random sample of the grants in the test set
+    """
+    with open(test_set_file, encoding="utf-8") as test_file:
+        with open(sample_file_name, "w", encoding="utf-8") as sample_file:
             rows = test_file.readlines()
             sample_file.write(rows[0])
             rows = rows[1:]
-            rows = random.sample(rows, sample_size)
+            rows = random.sample(rows, min(sample_size, len(rows)))
             for r in rows:
                 sample_file.write(r)
 
@@ -49,9 +77,7 @@ def safe_q(q):
 
 def recon_test_1(name):
     name = safe_q(name)
-    res = es.search(index=ES_INDEX, doc_type=ES_TYPE, q=name, ignore=[404])
-    if res["hits"]["total"] > 0:
-        return res["hits"]["hits"][0]
+    return "search", {"q": name}
     # 10000 grants checked
     # Successful matches: 5829 [58%]
     # Mismatches: 4112 [41%]
@@ -61,9 +87,7 @@ def recon_test_1(name):
 
 def recon_test_2(name):
     name = safe_q(name)
-    res = es.search(index=ES_INDEX, doc_type=ES_TYPE, body={"query": {"query_string": {"query": name}}}, ignore=[404])
-    if res["hits"]["total"] > 0:
-        return res["hits"]["hits"][0]
+    return "search", {"body": {"query": {"query_string": {"query": name}}}}
     # 10000 grants checked
     # Successful matches: 5829 [58%]
     # Mismatches: 4112 [41%]
@@ -73,9 +97,7 @@ def recon_test_2(name):
 
 def recon_test_3(name):
     name = safe_q(name)
-    res = es.search(index=ES_INDEX, doc_type=ES_TYPE, body={"query": {"match": {"known_as": name}}}, ignore=[404])
-    if res["hits"]["total"] > 0:
-        return res["hits"]["hits"][0]
+    return "search", {"body": {"query": {"match": {"known_as": name}}}}
     # 10000 grants checked
     # Successful matches: 7234 [72%]
     # Mismatches: 2636 [26%]
@@ -102,9 +124,7 @@ def recon_test_4(name):
             }
         }
     }
-    res = es.search(index=ES_INDEX, doc_type=ES_TYPE, body=query, ignore=[404])
-    if res["hits"]["total"] > 0:
-        return res["hits"]["hits"][0]
+    return "search", {"body": query}
     # 10000 grants checked
     # Successful matches: 6886 [69%]
     # Mismatches: 3055 [31%]
@@ -144,9 +164,7 @@ def recon_test_5(name):
             }
         }
     }
-    res = es.search(index=ES_INDEX, doc_type=ES_TYPE, body=query, ignore=[404])
-    if res["hits"]["total"] > 0:
-        return res["hits"]["hits"][0]
+    return "search", {"body": query}
     # 10000 grants checked
     # Successful matches: 6579 [66%]
     # Mismatches: 3362 [34%]
@@ -190,9 +208,7 @@ def recon_test_6(name):
             }
         }
     }
-    res = es.search(index=ES_INDEX, doc_type=ES_TYPE, body=query, ignore=[404])
-    if res["hits"]["total"] > 0:
-        return res["hits"]["hits"][0]
+    return "search", {"body": query}
     # 10000 grants checked
     # Successful matches: 6531 [65%]
     # Mismatches: 3410 [34%]
@@ -264,9 +280,7 @@ def recon_test_7(name):
             "domain_name": None
         }
     }
-    res = es.search_template(index=ES_INDEX, doc_type=ES_TYPE, body=query, ignore=[404])
-    if res["hits"]["total"] > 0:
-        return res["hits"]["hits"][0]
+    return "search_template", {"body": query}
     # 9534 grants checked
     # Successful matches: 7950 [83%]
     # Mismatches: 1525 [16%]
@@ -276,59 +290,232 @@ def recon_test_7(name):
     # Took 160.2 seconds
 
 
-def recon_test(*args):
-    return recon_test_7(*args)
+# queries that can be checked, by name
+TEST_QUERIES = {
+    "1": recon_test_1,
+    "2": recon_test_2,
+    "3": recon_test_3,
+    "4": recon_test_4,
+    "5": recon_test_5,
+    "6": recon_test_6,
+    "7": recon_test_7,
+}
+
+
+def template_query(template):
+    """
+    Create a query function from a `QueryTemplate`
+    """
+    def query(name):
+        return "search_template", {"body": {"inline": template.source, "params": {p: name for p in template.params}}}
+    return query
+
+
+def get_query(name):
+    """
+    Find a query by name: one of `TEST_QUERIES`, a template used by the
+    server (eg `recon`) or the path to a template yaml file
+    """
+    if name in TEST_QUERIES:
+        return TEST_QUERIES[name]
+    if name in templates.templates:
+        return template_query(templates.get(name))
+    if os.path.exists(name):
+        return template_query(QueryTemplate(os.path.basename(name), name))
+    raise ValueError("Unknown query {}: use one of {} or a template file".format(
+        name, ", ".join(list(TEST_QUERIES) + list(templates.templates))))
+
+
+def clean_charity_number(charitynumber):
+    return charitynumber.replace(" ", "").upper().replace("SCO", "SC0")
+
+
+def read_sample(filename, limit=None):
+    """
+    Read the names and charity numbers from a test sample file
+    """
+    with open(filename, encoding="utf-8") as sample_file:
+        grants = [
+            {"name": g["name"], "charitynumber": clean_charity_number(g["charitynumber"])}
+            for g in csv.DictReader(sample_file)
+        ]
+    return grants[:limit] if limit else grants
+
+
+def existing_charities(es, charity_numbers, es_index=ES_INDEX, es_type=ES_TYPE, chunk_size=1000):
+    """
+    Find which of the charity numbers are in the index
+
+    Grants to charities that aren't in the index can't be matched, so they
+    are left out of the results.
+    """
+    charity_numbers = list(set(charity_numbers))
+    found = set()
+    for i in range(0, len(charity_numbers), chunk_size):
+        res = es.mget(index=es_index, doc_type=es_type, body={"ids": charity_numbers[i:i + chunk_size]}, _source=False)
+        found.update(d["_id"] for d in res["docs"] if d.get("found"))
+    return found
+
+
+def run_query(es, query, name, es_index=ES_INDEX, es_type=ES_TYPE):
+    """
+    Run a query for a name
+
+    Returns the top hit (or None) and the seconds taken.
+    """
+    method, kwargs = query(name)
+    start = time.perf_counter()
+    res = getattr(es, method)(index=es_index, doc_type=es_type, ignore=[404], **kwargs)
+    elapsed = time.perf_counter() - start
+    hits = res.get("hits", {})
+    if hits.get("total") and hits.get("hits"):
+        return hits["hits"][0], elapsed
+    return None, elapsed
+
+
+def evaluate(es, query, grants, existing, concurrency=4, es_index=ES_INDEX, es_type=ES_TYPE):
+    """
+    Run a query for each grant using a pool of threads, and count how often the top result is right
+
+    Returns a dictionary of results and a list of the grants where the
+    wrong charity was found.
+    """
+    counts = {"match": 0, "mismatch": 0, "not_found": 0, "not_in_index": 0, "errors": 0}
+    scores = {"match": [], "mismatch": []}
+    latencies = []
+    mismatches = []
+
+    def check(grant):
+        try:
+            return grant, run_query(es, query, grant["name"], es_index, es_type)
+        except Exception as error:
+            return grant, error
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i, (grant, result) in enumerate(executor.map(check, grants)):
+            if i % 100 == 0:
+                print("\r{} grants checked".format(i), end='')
+            if isinstance(result, Exception):
+                counts["errors"] += 1
+                continue
+            res, elapsed = result
+            latencies.append(elapsed)
+            if grant["charitynumber"] not in existing:
+                counts["not_in_index"] += 1
+            elif res is None:
+                counts["not_found"] += 1
+            elif res["_id"] == grant["charitynumber"]:
+                counts["match"] += 1
+                scores["match"].append(res["_score"])
+            else:
+                counts["mismatch"] += 1
+                scores["mismatch"].append(res["_score"])
+                mismatches.append([
+                    grant["charitynumber"], grant["name"], res["_id"],
+                    res.get("_source", {}).get("known_as"), res["_score"]
+                ])
+    elapsed = time.perf_counter() - start
+
+    checked = counts["match"] + counts["mismatch"] + counts["not_found"]
+    return {
+        "checked": checked,
+        "counts": counts,
+        "accuracy": {
+            key: round(counts[key] / checked, 4) if checked else None
+            for key in ["match", "mismatch", "not_found"]
+        },
+        "mean_score": {
+            key: round(sum(values) / len(values), 2) if values else None
+            for key, values in scores.items()
+        },
+        "latency_ms": {
+            "p50": _ms(percentile(latencies, 50)),
+            "p95": _ms(percentile(latencies, 95)),
+            "p99": _ms(percentile(latencies, 99)),
+            "max": _ms(max(latencies) if latencies else None),
+        },
+        "qps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "seconds": round(elapsed, 2),
+    }, mismatches
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+def print_result(name, result):
+    print("\r# {}: {} grants checked".format(name, result["checked"]))
+    print("# Successful matches: {} [{:.0%}]".format(result["counts"]["match"], result["accuracy"]["match"] or 0))
+    print("# Mismatches: {} [{:.0%}]".format(result["counts"]["mismatch"], result["accuracy"]["mismatch"] or 0))
+    print("# No charity found: {} [{:.0%}]".format(result["counts"]["not_found"], result["accuracy"]["not_found"] or 0))
+    print("# Mean score of matched: {}".format(result["mean_score"]["match"]))
+    print("# Mean score of unmatched: {}".format(result["mean_score"]["mismatch"]))
+    print("# Latency: p50 {p50}ms, p95 {p95}ms, p99 {p99}ms".format(**result["latency_ms"]))
+    print("# {} queries per second, took {:.1f} seconds".format(result["qps"], result["seconds"]))
 
 
 def main():
+    """
+    Check reconciliation queries against a sample of grants (command line version)
+    """
+    parser = argparse.ArgumentParser(description='Check how well reconciliation queries find the right charity')
+    subparsers = parser.add_subparsers(dest="command")
+
+    sample_parser = subparsers.add_parser("sample", help="Make a test sample from a GrantNav CSV download")
+    sample_parser.add_argument('grantnav', help='GrantNav CSV file')
+    sample_parser.add_argument('target', nargs='?', default=TEST_FILE, help='CSV file to save the sample to')
+    sample_parser.add_argument('--sample-size', type=int, default=10000, help='Number of grants in the sample')
+
+    run_parser = subparsers.add_parser("run", help="Run queries for the names in a test sample")
+    run_parser.add_argument('sample', nargs='?', default=TEST_FILE, help='Test sample CSV file')
+    run_parser.add_argument('--query', action='append',
+                            help='Query to check, can be given more than once: one of {} or a template yaml file (default: recon)'.format(
+                                ", ".join(list(TEST_QUERIES) + list(templates.templates))))
+    run_parser.add_argument('--concurrency', type=int, default=4, help='Number of queries to run at the same time')
+    run_parser.add_argument('--limit', type=int, help='Only check this many grants')
+    run_parser.add_argument('--mismatches', default=MISMATCH_FILE, help='CSV file to save the mismatched grants to')
+    run_parser.add_argument('--output', help='File to save the results to as JSON')
+    run_parser.add_argument('--es-host', default="localhost", help='host for the elasticsearch instance (separate several nodes with commas)')
+    run_parser.add_argument('--es-port', default=9200, help='port for the elasticsearch instance')
+    run_parser.add_argument('--es-url-prefix', default='', help='Elasticsearch url prefix')
+    run_parser.add_argument('--es-use-ssl', action='store_true', help='Use ssl to connect to elasticsearch')
+    run_parser.add_argument('--es-index', default=ES_INDEX, help='index used to store charity data')
+    run_parser.add_argument('--es-type', default=ES_TYPE, help='type used to store charity data')
+    args = parser.parse_args()
+
+    if args.command == "sample":
+        test_set_file = args.target + ".all"
+        get_test_set(args.grantnav, test_set_file)
+        get_test_sample(args.sample_size, test_set_file, args.target)
+        os.remove(test_set_file)
+        return
+    if args.command != "run":
+        parser.print_help()
+        return
+
+    es = create_client(
+        [{"host": host, "port": args.es_port, "url_prefix": args.es_url_prefix, "use_ssl": args.es_use_ssl}
+         for host in parse_hosts(args.es_host)],
+        maxsize=args.concurrency,
+    )
+    grants = read_sample(args.sample, args.limit)
+    existing = existing_charities(es, [g["charitynumber"] for g in grants], args.es_index, args.es_type)
+
+    results = {}
+    with open(args.mismatches, "w", encoding="utf-8") as mismatch_file:
+        writer = csv.writer(mismatch_file, lineterminator='\r')
+        writer.writerow(["query", "ccnum", "name", "match_ccnum", "match_name", "match_score"])
+        for name in args.query or ["recon"]:
+            results[name], mismatches = evaluate(es, get_query(name), grants, existing, args.concurrency,
+                                                 args.es_index, args.es_type)
+            writer.writerows([name] + row for row in mismatches)
+            print_result(name, results[name])
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
 
-    start = time.clock()
-    with open(TEST_FILE, encoding="utf-8") as grantnav:
-        with open(MISMATCH_FILE, "w", encoding="utf-8") as mismatch_file:
-            reader = csv.DictReader(grantnav)
-            writer = csv.writer(mismatch_file, lineterminator='\r')
-            writer.writerow(["ccnum", "name", "match_ccnum",
-                             "match_name", "match_score"])
-            counts = {"match": 0, "blank": 0, "not_match": 0,
-                      "total": 0, "charity_wrong": 0}
-            scores = {"match": [], "not_match": []}
-            for grant in reader:
-                res = recon_test(grant["name"])
-                if counts["total"] % 100 == 0:
-                    print("\r{} grants checked".format(counts["total"]), end='')
-                if res is None:
-                    counts["total"] += 1
-                    counts["blank"] += 1
-                    continue
-
-                grant["charitynumber"] = grant["charitynumber"].replace(" ", "").upper().replace("SCO", "SC0")
-                existing_charity = es.get(index=ES_INDEX, doc_type=ES_TYPE, id=grant["charitynumber"], ignore=[404])
-                ccnum = res["_id"]
-                if ccnum == grant["charitynumber"]:
-                    counts["total"] += 1
-                    counts["match"] += 1
-                    scores["match"].append(res["_score"])
-                elif existing_charity["found"]:
-                    counts["total"] += 1
-                    counts["not_match"] += 1
-                    scores["not_match"].append(res["_score"])
-                    writer.writerow([
-                        grant["charitynumber"],
-                        grant["name"],
-                        res["_id"],
-                        res["_source"]["known_as"],
-                        res["_score"]
-                    ])
-                else:
-                    counts["charity_wrong"] += 1
-
-        print("\r# {} grants checked".format(counts["total"]))
-        print("# Successful matches: {} [{:.0%}]".format(counts["match"], counts["match"] / counts["total"]))
-        print("# Mismatches: {} [{:.0%}]".format(counts["not_match"], counts["not_match"] / counts["total"]))
-        print("# No charity found: {} [{:.0%}]".format(counts["blank"], counts["blank"] / counts["total"]))
-        print("# Mean score of matched: {:.0f}".format(sum(scores["match"]) / len(scores["match"])))
-        print("# Mean score of unmatched: {:.0f}".format(sum(scores["not_match"]) / len(scores["not_match"])))
-        print("# Took {:.1f} seconds".format(time.clock() - start))
 
 if __name__ == '__main__':
     main()
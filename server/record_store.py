@@ -0,0 +1,322 @@
+"""
+Local store of records built from the output files
+
+The records in `output/all.jsonl.gz` are packed into one file, with a
+sorted index of their ids, so that single records can be looked up without
+asking elasticsearch. Workers memory-map the file read-only, so it is shared
+between processes through the page cache.
+
+To build the file run:
+
+    python server/record_store.py data/output/all.jsonl.gz
+"""
+import argparse
+import array
+import bisect
+import gzip
+import json
+import mmap
+import os
+import random
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+from storage import _include_fields
+
+MAGIC = b"FTCRECS1"
+HEADER = struct.Struct("<8sI")
+
+
+def build_store(source, target):
+    """
+    Create a record store file from a gzipped JSON lines file of records
+
+    The records are written in the order they are read, and only their ids,
+    positions and lengths are kept in memory to build the index.
+    """
+    entries = []
+    position = 0
+    with tempfile.TemporaryFile() as record_blob:
+        with gzip.open(source, 'rt', encoding='utf8') as records:
+            for line in records:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                record.pop("complete_names", None)
+                # the output files add the id to each record, which isn't in the elasticsearch source
+                record_id = record.pop("id")
+                data = json.dumps(record, separators=(',', ':')).encode("utf8")
+                record_blob.write(data)
+                entries.append((record_id, position, len(data)))
+                position += len(data)
+
+        entries.sort()
+
+        id_offsets = array.array('I', [0])
+        id_blob = bytearray()
+        positions = array.array('Q')
+        lengths = array.array('I')
+        for record_id, record_position, length in entries:
+            id_blob.extend(record_id.encode("utf8"))
+            id_offsets.append(len(id_blob))
+            positions.append(record_position)
+            lengths.append(length)
+
+        tmp_target = "{}.{}.tmp".format(target, os.getpid())
+        with open(tmp_target, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(entries)))
+            f.write(id_offsets.tobytes())
+            f.write(lengths.tobytes())
+            f.write(b"\0" * (-f.tell() % 8))
+            f.write(positions.tobytes())
+            f.write(bytes(id_blob))
+            record_blob.seek(0)
+            shutil.copyfileobj(record_blob, f)
+        os.replace(tmp_target, target)
+    return len(entries)
+
+
+class _Ids:
+    """
+    Sequence of the ids in the store, decoded as they're needed by `bisect`
+    """
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], "utf8")
+
+
+class RecordStore:
+    """
+    Memory-mapped record store file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        stat = os.stat(filename)
+        self.version = (stat.st_ino, stat.st_mtime)
+        with open(filename, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mmap)
+
+        magic, n_records = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError("{} is not a record store".format(filename))
+
+        pos = HEADER.size
+        id_offsets = view[pos:pos + (n_records + 1) * 4].cast('I')
+        pos += (n_records + 1) * 4
+        self.lengths = view[pos:pos + n_records * 4].cast('I')
+        pos += n_records * 4
+        pos += -pos % 8
+        self.positions = view[pos:pos + n_records * 8].cast('Q')
+        pos += n_records * 8
+        self.ids = _Ids(id_offsets, view[pos:pos + id_offsets[n_records]])
+        pos += id_offsets[n_records]
+        self.record_blob = view[pos:]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _record(self, i):
+        start = self.positions[i]
+        return json.loads(str(self.record_blob[start:start + self.lengths[i]], "utf8"))
+
+    def get(self, record_id):
+        """
+        Get a record by its id, or None if it isn't in the store
+        """
+        i = bisect.bisect_left(self.ids, record_id)
+        if i < len(self.ids) and self.ids[i] == record_id:
+            return self._record(i)
+        return None
+
+    def random_record(self, active=False, tries=20):
+        """
+        Pick a random id and record, or None if no suitable record was found
+        """
+        for _ in range(tries if len(self) else 0):
+            i = random.randrange(len(self))
+            record = self._record(i)
+            if record.get("active") or not active:
+                return self.ids[i], record
+        return None
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.ids[i], self._record(i)
+
+
+class LocalRecordStorage:
+    """
+    Storage that looks up records in a local record store first
+
+    `get` and `mget` are answered from the record store, and only records
+    that aren't in it are fetched from the wrapped storage. If the wrapped
+    storage can't be reached the records are reported as not found, so
+    record pages still work while elasticsearch is down. Everything else is
+    passed through to the wrapped storage.
+
+    The record store is built from the records file if it doesn't exist or
+    is older than the records. The files are checked for changes at most
+    once every `interval` seconds.
+    """
+
+    def __init__(self, storage, source, target=None, interval=60):
+        self.storage = storage
+        self.source = source
+        self.target = target or re.sub(r'\.jsonl\.gz$', '', source) + ".records"
+        self.interval = interval
+        self.store = None
+        self.last_checked = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def __getattr__(self, name):
+        if name == "storage":
+            raise AttributeError(name)
+        return getattr(self.storage, name)
+
+    def load(self):
+        """
+        Open the record store, building it first if needed
+        """
+        if os.path.exists(self.source) and (not os.path.exists(self.target) or
+                                            os.path.getmtime(self.target) < os.path.getmtime(self.source)):
+            build_store(self.source, self.target)
+        self.store = RecordStore(self.target)
+        self.last_checked = time.monotonic()
+
+    def check(self):
+        """
+        Reopen the record store if it or the records file has changed
+        """
+        if time.monotonic() - self.last_checked <= self.interval:
+            return
+        with self.lock:
+            self.last_checked = time.monotonic()
+            try:
+                stat = os.stat(self.target)
+                if (stat.st_ino, stat.st_mtime) != self.store.version or \
+                        os.path.getmtime(self.source) > stat.st_mtime:
+                    self.load()
+            except (OSError, ValueError):
+                # keep using the store that is already open
+                pass
+
+    def reopen(self):
+        """
+        Check the record store for changes, and reopen the wrapped storage
+        """
+        self.last_checked = 0
+        self.check()
+        if hasattr(self.storage, "reopen"):
+            self.storage.reopen()
+
+    def _hit(self, record_id, source, source_include=None, source_exclude=None):
+        if source_include:
+            source = _include_fields(source, source_include)
+        for field in source_exclude or []:
+            source.pop(field, None)
+        return {
+            "_index": self.storage.es_index,
+            "_type": self.storage.es_type,
+            "_id": record_id,
+            "found": True,
+            "_source": source,
+        }
+
+    def _not_found(self, record_id):
+        return {
+            "_index": self.storage.es_index,
+            "_type": self.storage.es_type,
+            "_id": record_id,
+            "found": False,
+        }
+
+    def get(self, record_id, source_exclude=None):
+        """
+        Fetch one record
+        """
+        self.check()
+        source = self.store.get(record_id)
+        if source is not None:
+            return self._hit(record_id, source, source_exclude=source_exclude)
+        try:
+            return self.storage.get(record_id, source_exclude=source_exclude)
+        except Exception:
+            return self._not_found(record_id)
+
+    def mget(self, ids, source_include=None, source_exclude=None):
+        """
+        Fetch a list of records
+        """
+        self.check()
+        docs = {}
+        missing = []
+        for record_id in ids:
+            source = self.store.get(record_id)
+            if source is not None:
+                docs[record_id] = self._hit(record_id, source, source_include, source_exclude)
+            else:
+                missing.append(record_id)
+
+        if missing:
+            try:
+                res = self.storage.mget(missing, source_include=source_include,
+                                        source_exclude=source_exclude)
+                docs.update({doc["_id"]: doc for doc in res.get("docs", [])})
+            except Exception:
+                pass
+
+        return {"docs": [docs.get(record_id, self._not_found(record_id)) for record_id in ids]}
+
+    def random_record(self, active=False):
+        """
+        Pick a random record, from the record store if the wrapped storage can't be reached
+        """
+        try:
+            return self.storage.random_record(active)
+        except Exception:
+            picked = self.store.random_record(active)
+            if picked:
+                return self._hit(*picked)
+            return None
+
+    def scan(self, source_include=None):
+        """
+        Iterate through every record in the record store
+        """
+        self.check()
+        for record_id, source in self.store:
+            yield self._hit(record_id, source, source_include=source_include)
+
+
+def main():
+    """
+    Build a record store from the command line
+    """
+    parser = argparse.ArgumentParser(description='Build a local record store from the output files')
+    parser.add_argument('source', help='gzipped JSON lines file of records (eg data/output/all.jsonl.gz)')
+    parser.add_argument('--target', help='file to save the record store to')
+    args = parser.parse_args()
+
+    target = args.target or re.sub(r'\.jsonl\.gz$', '', args.source) + ".records"
+    start = time.perf_counter()
+    n_records = build_store(args.source, target)
+    print("[records] {} records saved to {} in {:.1f} seconds".format(
+        n_records, target, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
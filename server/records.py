@@ -0,0 +1,136 @@
+"""
+Functions for fetching charity records
+"""
+import re
+from collections import OrderedDict
+
+# number of documents to ask elasticsearch for in each mget request
+MGET_CHUNK_SIZE = 500
+
+
+def clean_regno(regno):
+    """
+    Clean up a charity registration number
+    """
+    regno = str(regno)
+    regno = regno.upper()
+    regno = re.sub(r'^[^0-9SCNI]+|[^0-9]+$', '', regno)
+    return regno
+
+
+def fetch_records(regnos, app, fields=None, chunk_size=MGET_CHUNK_SIZE):
+    """
+    Fetch the records for a list of registration numbers
+
+    The numbers are cleaned with `clean_regno` and looked up using `mget`, in
+    chunks of `chunk_size`. If `fields` is given then only those fields are
+    returned from each record.
+
+    Returns an OrderedDict keyed by the registration number as it was passed in,
+    with `None` for any that weren't found.
+    """
+    cleaned = OrderedDict()
+    for regno in regnos:
+        cleaned[regno] = clean_regno(regno)
+
+    to_fetch = list(OrderedDict.fromkeys(c for c in cleaned.values() if c))
+    found = {}
+    for i in range(0, len(to_fetch), chunk_size):
+        found.update(mget_records(to_fetch[i:i + chunk_size], app, fields))
+
+    return OrderedDict(
+        (regno, found.get(regno_cleaned)) for regno, regno_cleaned in cleaned.items()
+    )
+
+
+def mget_records(ids, app, fields=None):
+    """
+    Get a dictionary of record id -> record for one chunk of ids
+    """
+    if not ids:
+        return {}
+    if fields:
+        res = app.config["storage"].mget(ids, source_include=fields)
+    else:
+        res = app.config["storage"].mget(ids, source_exclude=["complete_names"])
+    return {
+        doc["_id"]: doc.get("_source", {})
+        for doc in res.get("docs", []) if doc.get("found")
+    }
+
+
+# how the id of a record can be worked out from its org-id
+ORGID_PREFIXES = {
+    "GB-CHC-": "",
+    "GB-SC-": "",
+    "GB-NIC-": "NIC",
+}
+
+# number of org-ids to search for in each msearch request
+ORGID_SEARCH_CHUNK_SIZE = 100
+
+
+def orgid_to_id(orgid):
+    """
+    Work out the likely record id for an org-id, or None if it can't be worked out
+
+    Charity org-ids usually contain the id of the record, but dual registered
+    charities and company numbers need a search to find their record.
+    """
+    for prefix, id_prefix in ORGID_PREFIXES.items():
+        if orgid.startswith(prefix):
+            return id_prefix + orgid[len(prefix):]
+    return None
+
+
+def fetch_orgids(orgids, app, chunk_size=MGET_CHUNK_SIZE):
+    """
+    Find the records for a list of org-ids
+
+    Where the record id can be worked out from the org-id the records are
+    fetched directly with mget. The rest are found with an exact search on
+    the `org-ids` field, sent together in one request per chunk. Records are
+    only returned if the org-id is one of their `org-ids`.
+
+    Returns an OrderedDict keyed by the org-id as it was passed in, with
+    `None` for any that weren't found. Each record has its `id` added.
+    """
+    cleaned = OrderedDict()
+    for orgid in orgids:
+        cleaned[orgid] = str(orgid).strip().upper()
+
+    found = {}
+    candidates = {}
+    for orgid in set(cleaned.values()):
+        record_id = orgid_to_id(orgid)
+        if record_id:
+            candidates[orgid] = record_id
+
+    candidate_ids = list(set(candidates.values()))
+    records = {}
+    for i in range(0, len(candidate_ids), chunk_size):
+        records.update(mget_records(candidate_ids[i:i + chunk_size], app))
+    for orgid, record_id in candidates.items():
+        if orgid in records.get(record_id, {}).get("org-ids", []):
+            found[orgid] = dict(records[record_id], id=record_id)
+
+    to_search = [orgid for orgid in set(cleaned.values()) if orgid and orgid not in found]
+    for i in range(0, len(to_search), ORGID_SEARCH_CHUNK_SIZE):
+        found.update(search_orgids(to_search[i:i + ORGID_SEARCH_CHUNK_SIZE], app))
+
+    return OrderedDict(
+        (orgid, found.get(orgid_cleaned)) for orgid, orgid_cleaned in cleaned.items()
+    )
+
+
+def search_orgids(orgids, app):
+    """
+    Search for the records with a list of org-ids, in one request
+    """
+    found = {}
+    for orgid, hits in zip(orgids, app.config["storage"].find_orgids(orgids)):
+        for hit in hits:
+            if orgid in hit["_source"].get("org-ids", []):
+                found[orgid] = dict(hit["_source"], id=hit["_id"])
+                break
+    return found
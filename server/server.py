@@ -4,24 +4,54 @@ Run the find that charity server
 from __future__ import print_function
 import os
 import argparse
+import glob
+import hashlib
 import json
 from collections import OrderedDict
-import time
 from datetime import datetime, timezone
-import re
 
 from dateutil import parser
 import bottle
-from elasticsearch import Elasticsearch
-import requests
-from bs4 import BeautifulSoup
 
-from queries import search_query, recon_query, service_spec, esdoc_orresponse
+from queries import search_query, recon_query, service_spec, esdoc_orresponse, esdoc_orresponses, templates, \
+    propose_properties, extend_fields, extend_response
 from csv_upload import csv_app
+from cache import ResultCache, IndexWatcher
+from records import clean_regno, fetch_records, fetch_orgids
+from autocomplete import LocalAutocomplete
+from id_table import RandomIds
+from feeds import CCEWFeed
+from storage import ElasticsearchStorage, SQLiteStorage
+from es_client import create_client, parse_hosts, CircuitBreaker, BreakerStorage, RequestBudget
+from metrics import registry, timed, TimedStorage, MetricsMiddleware, SharedMetrics, BATCH_SIZE, cache_collector
+from record_store import LocalRecordStorage
+from slowlog import SlowQueryLog, note
 
 app = bottle.default_app()
 app.merge(csv_app)
 
+# seconds allowed for the elasticsearch requests made by each route (others use ES_TIMEOUT)
+ROUTE_TIMEOUTS = {
+    "autocomplete": 2,
+    "charity": 3,
+    "charity_preview": 3,
+    "orgid_json": 5,
+    "orgid_html": 5,
+    "random": 5,
+    "home": 10,
+    "reconcile": 20,
+    "charity_batch": 30,
+    "orgid_batch": 30,
+    "enrichcsv": 30,
+}
+app.install(RequestBudget(ROUTE_TIMEOUTS))
+csv_app.install(RequestBudget(ROUTE_TIMEOUTS))
+
+app.config["breaker"] = CircuitBreaker(
+    threshold=int(os.environ.get("ES_BREAKER_THRESHOLD", 5)),
+    reset_timeout=int(os.environ.get("ES_BREAKER_RESET", 30)),
+)
+
 # everywhere gives a different env var for elasticsearch services...
 POTENTIAL_ENV_VARS = [
     "ELASTICSEARCH_URL",
@@ -30,11 +60,40 @@ POTENTIAL_ENV_VARS = [
 ]
 for e_v in POTENTIAL_ENV_VARS:
     if os.environ.get(e_v):
-        app.config["es"] = Elasticsearch(os.environ.get(e_v))
+        # several nodes can be given, separated by commas
+        app.config["es"] = create_client(
+            parse_hosts(os.environ.get(e_v)),
+            timeout=int(os.environ.get("ES_TIMEOUT", 10)),
+            maxsize=int(os.environ.get("ES_MAXSIZE", 10)),
+            max_retries=int(os.environ.get("ES_MAX_RETRIES", 3)),
+            dead_timeout=int(os.environ.get("ES_DEAD_TIMEOUT", 60)),
+        )
         app.config["es_index"] = 'charitysearch'
         app.config["es_type"] = 'charity'
+        app.config["storage"] = BreakerStorage(ElasticsearchStorage(
+            app.config["es"], app.config["es_index"], app.config["es_type"]), app.config["breaker"])
         break
 
+# use an SQLite database instead of elasticsearch
+if os.environ.get("SQLITE_DB"):
+    app.config["es_type"] = 'charity'
+    app.config["storage"] = SQLiteStorage(os.environ.get("SQLITE_DB"))
+
+# write slow search, reconciliation and autocomplete requests to a log
+if os.environ.get("SLOW_QUERY_LOG"):
+    app.config["slow_query_log"] = app.install(SlowQueryLog(
+        os.environ.get("SLOW_QUERY_LOG"),
+        threshold=float(os.environ.get("SLOW_QUERY_THRESHOLD", 1)),
+        sample=float(os.environ.get("SLOW_QUERY_SAMPLE", 1)),
+    ))
+
+# share the metrics of all the worker processes through files in this folder
+if os.environ.get("METRICS_DIR"):
+    app.config["shared_metrics"] = SharedMetrics(
+        registry, os.environ.get("METRICS_DIR"),
+        interval=int(os.environ.get("METRICS_SAVE_INTERVAL", 5)),
+    )
+
 if os.environ.get("GA_TRACKING_ID"):
     app.config["ga_tracking_id"] = os.environ.get("GA_TRACKING_ID")
 
@@ -44,24 +103,125 @@ if os.environ.get("ADMIN_PASSWORD"):
 if os.environ.get("FOLDER"):
     app.config["folder"] = os.environ.get("FOLDER")
 
+app.config["ccew_feed"] = CCEWFeed(ttl=int(os.environ.get("FEED_CACHE_TTL", 3600)))
+# fetch the feed now so requests don't have to wait for it
+app.config["ccew_feed"].refresh_async()
+
+app.config["result_cache"] = ResultCache(
+    maxsize=int(os.environ.get("RESULT_CACHE_SIZE", 10000)),
+    ttl=int(os.environ.get("RESULT_CACHE_TTL", 3600)),
+    # the results are changed by the routes that use them
+    copy=True,
+)
+app.config["index_watcher"] = IndexWatcher(
+    interval=int(os.environ.get("INDEX_CHECK_INTERVAL", 60)),
+)
+app.config["index_watcher"].on_change(app.config["result_cache"].clear)
+
+app.config["page_cache"] = ResultCache(
+    maxsize=int(os.environ.get("PAGE_CACHE_SIZE", 10000)),
+    ttl=int(os.environ.get("PAGE_CACHE_TTL", 86400)),
+    maxbytes=int(os.environ.get("PAGE_CACHE_BYTES", 64 * 1024 * 1024)),
+)
+app.config["index_watcher"].on_change(app.config["page_cache"].clear)
+
+
+@app.config["index_watcher"].on_change
+def refresh_random_ids():
+    """
+    Rebuild the tables of ids used to pick a random record
+    """
+    if app.config.get("random_ids"):
+        app.config["random_ids"].refresh()
+
+
+@app.config["index_watcher"].on_change
+def reopen_storage():
+    """
+    Connect to the new database if it has been replaced
+    """
+    if hasattr(app.config.get("storage"), "reopen"):
+        app.config["storage"].reopen()
+
+
+# look up single records in a local record store before asking the storage
+if os.environ.get("LOCAL_RECORDS") and app.config.get("storage"):
+    app.config["storage"] = LocalRecordStorage(
+        app.config["storage"],
+        os.path.join(os.environ.get("FOLDER", "data"), "output", "all.jsonl.gz")
+    )
+
+if app.config.get("storage"):
+    app.config["storage"] = TimedStorage(app.config["storage"])
+    app.config["random_ids"] = RandomIds(app.config["storage"])
+
+if os.environ.get("AUTOCOMPLETE_BACKEND") == "local":
+    app.config["autocomplete"] = LocalAutocomplete(
+        os.path.join(os.environ.get("FOLDER", "data"), "output", "all.jsonl.gz")
+    )
+
+if os.environ.get("ES_STORED_TEMPLATES") and app.config.get("es") and not os.environ.get("SQLITE_DB"):
+    templates.use_stored(app.config["es"])
+
 csv_app.config.update(app.config)
 
+# maximum number of records that can be requested from the batch endpoint
+BATCH_LIMIT = 10000
+
+# number of suggestions returned by the autocomplete endpoint
+AUTOCOMPLETE_SIZE = 5
+
+# seconds that feed readers can cache the feeds for
+FEED_MAX_AGE = 600
+
+# seconds that browsers and proxies can cache single records for
+RECORD_MAX_AGE = 3600
+
+# seconds that browsers and proxies can cache the bulk downloads for
+DOWNLOAD_MAX_AGE = 86400
+
+# changes when the templates are changed, so cached pages are sent again
+VIEWS_VERSION = hashlib.sha1("".join(
+    "{}{}".format(f, os.path.getmtime(f))
+    for path in bottle.TEMPLATE_PATH
+    for f in sorted(glob.glob(os.path.join(path, "*.html")))
+).encode("utf8")).hexdigest()[:8]
+
+
+@app.hook('before_request')
+def check_index():
+    """
+    Invalidate cached data if the index has changed since it was last checked
+    """
+    if app.config.get("storage"):
+        app.config["index_watcher"].check(app.config["storage"])
+
 
 def search_return(query):
     """
     Fetch search results and display on a template
     """
-    res = app.config["es"].search_template(
-        index=app.config["es_index"],
-        doc_type=app.config["es_type"],
-        body=query,
-        ignore=[404]
-    )
+    cache = app.config["result_cache"]
+    cache_key = templates.cache_key("search", query["params"]["name"])
+    res = cache.get(cache_key)
+    if res is None:
+        res = search_hits(app.config["storage"].search_template(query))
+        cache.set(cache_key, res)
+    note(template="search", version=templates.get("search").version,
+         params=[query["params"]], results=len(res["hits"]))
+    with timed("render"):
+        return bottle.template('search', res=res, term=query["params"]["name"])
+
+
+def search_hits(res):
+    """
+    Get the hits from a search response, ready for the search template
+    """
     res = res["hits"]
     for result in res["hits"]:
         result["_link"] = "/charity/" + result["_id"]
         result["_source"] = sort_out_date(result["_source"])
-    return bottle.template('search', res=res, term=json.loads(query)["params"]["name"])
+    return res
 
 
 @app.route('/')
@@ -81,34 +241,20 @@ def home():
 def random(filetype="html"):
     """ Get a random charity record
     """
-    query = {
-        "size": 1,
-        "query": {
-            "function_score": {
-                "functions": [
-                    {
-                        "random_score": {
-                            "seed": str(time.time())
-                        }
-                    }
-                ]
-            }
-        }
-    }
+    active = "active" in bottle.request.query
 
-    if "active" in bottle.request.query:
-        query["query"]["function_score"]["query"] = {"match": {"active": True}}
+    random_ids = app.config.get("random_ids")
+    regno = random_ids.random_id(active=active) if random_ids else None
+    if regno and filetype == "html":
+        bottle.redirect("/charity/{}".format(regno))
 
-    res = app.config["es"].search(
-        index=app.config["es_index"],
-        doc_type=app.config["es_type"],
-        body=query,
-        ignore=[404]
-    )
     char = None
-    if "hits" in res:
-        if "hits" in res["hits"]:
-            char = res["hits"]["hits"][0]
+    if regno:
+        res = app.config["storage"].get(regno)
+        if "_source" in res:
+            char = res
+    if not char:
+        char = app.config["storage"].random_record(active)
 
     if char:
         if filetype == "html":
@@ -116,15 +262,16 @@ def random(filetype="html"):
         return char["_source"]
 
 
-
 @app.route('/reconcile')
 @app.post('/reconcile')
 def reconcile():
     """ Index of the server. If ?query or ?queries used then search,
+                if ?extend used then add properties to reconciled records,
                 otherwise return the default response as JSON
     """
     query = recon_query(bottle.request.query.query) or None
     queries = bottle.request.params.queries or None
+    extend = bottle.request.params.extend or None
 
     service_url = "{}://{}".format(
         bottle.request.urlparts.scheme,
@@ -136,28 +283,63 @@ def reconcile():
     # try fetching the query as json data or a string
     if bottle.request.query.query:
         response = esdoc_orresponse(query, app)
+        note(template="recon", version=templates.get("recon").version,
+             params=[query["params"]], results=len(response["result"]))
 
     if queries:
-        queries_json = json.loads(queries)
         queries_dict = json.loads(queries, object_pairs_hook=OrderedDict)
-        results = {}
-        counter = 0
-        for query_id in queries_dict:
-            result = esdoc_orresponse(recon_query(
-                queries_json[query_id]["query"]), app)["result"]
-            results.update({query_id: {"result": result}})
-            counter += 1
-        response = results
+        BATCH_SIZE.observe(len(queries_dict), "/reconcile")
+        batch = [(query_id, recon_query(q["query"])) for query_id, q in queries_dict.items()]
+        response = esdoc_orresponses(batch, app)
+        note(template="recon", version=templates.get("recon").version, batch=True,
+             params=[q["params"] for _, q in batch],
+             results=sum(len(r["result"]) for r in response.values()))
+
+    if extend:
+        try:
+            extend = json.loads(extend)
+        except ValueError:
+            return bottle.abort(400, '"extend" must be JSON')
+        if not isinstance(extend, dict) or not isinstance(extend.get("ids", []), list):
+            return bottle.abort(400, '"extend" must contain a list of "ids"')
+        if len(extend.get("ids", [])) > BATCH_LIMIT:
+            return bottle.abort(400, 'No more than {} ids can be extended at once'.format(BATCH_LIMIT))
+        BATCH_SIZE.observe(len(extend.get("ids", [])), "/reconcile")
+        records = fetch_records([str(i) for i in extend.get("ids", [])], app, fields=extend_fields(extend) or ["known_as"])
+        response = extend_response(extend, records)
+
+    return recon_return(response)
+
+
+@app.route('/reconcile/propose_properties')
+def reconcile_propose_properties():
+    """
+    Properties that can be added to reconciled records with the data extension API
+    """
+    limit = bottle.request.query.limit
+    return recon_return(propose_properties(app, int(limit) if limit.isdigit() else None))
+
+
+# headers added to reconciliation API responses so they can be used from other sites
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+}
+
 
+def recon_return(response):
+    """
+    Return a reconciliation API response, as JSONP if a callback is given
+    """
     # if we're doing a callback request then do that
     if bottle.request.query.callback:
         bottle.response.content_type = "application/javascript"
         return "%s(%s);" % (bottle.request.query.callback, json.dumps(response))
     else:
         # Otherwise, add headers for CORS support
-        bottle.response.headers['Access-Control-Allow-Origin'] = '*'
-        bottle.response.headers['Access-Control-Allow-Headers'] = 'Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token'
-        bottle.response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+        for header, value in CORS_HEADERS.items():
+            bottle.response.headers[header] = value
         return response
 
 
@@ -174,7 +356,28 @@ def charity(filetype='csv'):
         filename = os.path.join("output", "all.{}.gz".format(filetype))
     elif filetype in ["xlsx"]:
         filename = os.path.join("output", "all.xlsx")
-    return bottle.static_file(filename, app.config["folder"])
+
+    # static_file deals with If-Modified-Since and Range requests itself
+    try:
+        stats = os.stat(os.path.join(app.config["folder"], filename))
+    except OSError:
+        return bottle.abort(404, "File does not exist.")
+    etag = '"{:x}-{:x}"'.format(int(stats.st_mtime), stats.st_size)
+    last_modified = datetime.fromtimestamp(int(stats.st_mtime), timezone.utc)
+    if cache_headers(etag, last_modified, DOWNLOAD_MAX_AGE):
+        bottle.response.status = 304
+        return ''
+
+    # only resume a download if the file hasn't changed since it was started
+    if_range = bottle.request.get_header('If-Range')
+    if if_range and if_range != etag and if_range != bottle.http_date(last_modified):
+        bottle.request.environ.pop('HTTP_RANGE', None)
+
+    res = bottle.static_file(filename, app.config["folder"])
+    if res.status_code in (200, 206):
+        res.set_header('ETag', etag)
+        res.set_header('Cache-Control', 'public, max-age={}'.format(DOWNLOAD_MAX_AGE))
+    return res
 
 
 @app.route('/charity/<regno>')
@@ -189,16 +392,46 @@ def charity(regno, filetype='html'):
         return bottle.abort(404, bottle.template(
             'Charity {{regno}} not found.', regno=regno))
 
-    res = app.config["es"].get(index=app.config["es_index"],
-                               doc_type=app.config["es_type"], id=regno_cleaned, ignore=[404])
+    res = app.config["storage"].get(regno_cleaned)
     if "_source" in res:
+        if record_not_modified(res["_id"], res["_source"], filetype):
+            return ''
         if filetype == "html":
-            return bottle.template('charity', charity=sort_out_date(res["_source"]), charity_id=res["_id"])
+            return render_record('charity', res)
         return res["_source"]
     else:
         return bottle.abort(404, bottle.template('Charity {{regno}} not found.', regno=regno))
 
 
+@app.post('/charity/batch')
+@app.post('/charity/batch.json')
+def charity_batch():
+    """
+    Return charity records for a list of registration numbers
+
+    Expects a JSON body like `{"ids": ["123456", "SC012345"], "fields": ["known_as"]}`.
+    `fields` is optional, if given then only those fields are included in each record.
+    """
+    try:
+        body = json.load(bottle.request.body)
+    except ValueError:
+        return bottle.abort(400, 'Request body must be JSON')
+
+    ids = body.get("ids", []) if isinstance(body, dict) else body
+    if not isinstance(ids, list):
+        return bottle.abort(400, '"ids" must be a list')
+    if len(ids) > BATCH_LIMIT:
+        return bottle.abort(400, 'No more than {} ids can be fetched at once'.format(BATCH_LIMIT))
+
+    BATCH_SIZE.observe(len(ids), "/charity/batch")
+    fields = body.get("fields") if isinstance(body, dict) else None
+    records = fetch_records([str(i) for i in ids], app, fields=fields)
+    return {
+        "records": records,
+        "not_found": [regno for regno, record in records.items() if record is None],
+    }
+
+
 @app.route('/preview/charity/<regno>')
 @app.route('/preview/charity/<regno>.html')
 def charity_preview(regno):
@@ -207,9 +440,12 @@ def charity_preview(regno):
 
     Used in reconciliation API
     """
-    res = app.config["es"].get(index=app.config["es_index"], doc_type=app.config["es_type"], id=regno, ignore=[404])
+    res = app.config["storage"].get(regno)
     if "_source" in res:
-        return bottle.template('preview', charity=sort_out_date(res["_source"]), charity_id=res["_id"], hide_title=("hide_title" in bottle.request.params))
+        hide_title = "hide_title" in bottle.request.params
+        if record_not_modified(res["_id"], res["_source"], "preview-hide_title" if hide_title else "preview"):
+            return ''
+        return render_record('preview', res, hide_title=hide_title)
     bottle.abort(404, bottle.template('Charity {{regno}} not found.', regno=regno))
 
 
@@ -218,35 +454,52 @@ def orgid_json(orgid):
     """
     Fetch json representation based on a org-id for a record
     """
-    query = {
-        "query": {
-            "match": {
-                "org-ids": {
-                    "query": orgid,
-                    "operator": "and",
-                }
-            }
-        }
-    }
-    res = app.config["es"].search(index=app.config["es_index"],
-                                  doc_type=app.config["es_type"],
-                                  body=query,
-                                  _source_exclude=["complete_names"],
-                                  ignore=[404])
-    if res.get("hits", {}).get("hits", []):
-        org = res["hits"]["hits"][0]["_source"]
-        org.update({"id": res["hits"]["hits"][0]["_id"]})
+    org = fetch_orgids([orgid], app)[orgid]
+    if org:
+        if record_not_modified(org["id"], org, "json"):
+            return ''
         return org
     bottle.abort(404, bottle.template(
         'Orgid {{orgid}} not found.', orgid=orgid))
 
+
+@app.post('/orgid/batch')
+@app.post('/orgid/batch.json')
+def orgid_batch():
+    """
+    Fetch records for a list of org-ids
+
+    Expects a JSON body like `{"orgids": ["GB-CHC-123456", "GB-SC-SC012345"]}`.
+    """
+    try:
+        body = json.load(bottle.request.body)
+    except ValueError:
+        return bottle.abort(400, 'Request body must be JSON')
+
+    orgids = body.get("orgids", []) if isinstance(body, dict) else body
+    if not isinstance(orgids, list):
+        return bottle.abort(400, '"orgids" must be a list')
+    if len(orgids) > BATCH_LIMIT:
+        return bottle.abort(400, 'No more than {} org-ids can be fetched at once'.format(BATCH_LIMIT))
+
+    BATCH_SIZE.observe(len(orgids), "/orgid/batch")
+    records = fetch_orgids([str(i) for i in orgids], app)
+    return {
+        "records": records,
+        "not_found": [orgid for orgid, record in records.items() if record is None],
+    }
+
+
 @app.route('/orgid/<orgid>')
 @app.route('/orgid/<orgid>.html')
 def orgid_html(orgid):
     """
     Redirect to a record based on the org-id
     """
-    org = orgid_json(orgid)
+    org = fetch_orgids([orgid], app)[orgid]
+    if not org:
+        bottle.abort(404, bottle.template(
+            'Orgid {{orgid}} not found.', orgid=orgid))
     bottle.redirect('/charity/{}'.format(org["id"]))
 
 
@@ -256,38 +509,44 @@ def ccew_rss(filetype):
     Get an RSS feed based on when data is
     uploaded by the Charity Commission
     """
-    ccew_url = 'http://data.charitycommission.gov.uk/'
-    res = requests.get(ccew_url)
-    soup = BeautifulSoup(res.text, 'html.parser')
-    items = []
-    for i in soup.find_all('blockquote'):
-        links = i.find_all('a')
-        idate = parser.parse(
-            i.h4.string.split(", ")[1],
-            default=datetime(2018, 1, 12, 0, 0)
-        ).replace(tzinfo=timezone.utc)
-        items.append({
-            "name": i.h4.string,
-            "date": idate,
-            "link": links[0].get('href'),
-            "author": "Charity Commission for England and Wales",
-        })
+    feed = app.config["ccew_feed"]
+    items = feed.get_items()
+    if not feed.loaded:
+        raise bottle.HTTPError(503, "The feed hasn't been fetched yet", headers={"Retry-After": str(feed.retry)})
+    updated = feed.updated or datetime.now().replace(tzinfo=timezone.utc)
+
+    # let feed readers know if nothing has changed since they last looked
+    etag = '"{}-{}"'.format(feed.version, filetype)
+    if cache_headers(etag, updated, FEED_MAX_AGE) and feed.version:
+        bottle.response.status = 304
+        return ''
+
+    content_type, body = feed_body(feed, items, updated, filetype, bottle.request.url)
+    bottle.response.content_type = content_type
+    return body
+
+
+def feed_body(feed, items, updated, filetype, feed_url):
+    """
+    Create the contents of a feed
 
+    Returns the content type and either a dictionary (for JSON feeds) or the
+    rendered feed.
+    """
     feed_contents = dict(
         items=items,
         title='Charity Commission for England and Wales data downloads',
         description='Downloads available from Charity Commission data downloads page.',
-        url=ccew_url,
-        feed_url=bottle.request.url,
-        updated=datetime.now().replace(tzinfo=timezone.utc),
+        url=feed.url,
+        feed_url=feed_url,
+        updated=updated,
     )
 
     if filetype == 'atom':
-        bottle.response.content_type = 'application/atom+xml'
+        content_type = 'application/atom+xml'
         template = 'atom.xml'
     elif filetype == "json":
-        bottle.response.content_type = 'application/json'
-        return {
+        return 'application/json', {
             "version": "https://jsonfeed.org/version/1",
             "title": feed_contents["title"],
             "home_page_url": feed_contents["url"],
@@ -303,10 +562,81 @@ def ccew_rss(filetype):
             ]
         }
     else:
-        bottle.response.content_type = 'application/rss+xml'
+        content_type = 'application/rss+xml'
         template = 'rss.xml'
 
-    return bottle.template(template, **feed_contents)
+    return content_type, bottle.template(template, **feed_contents)
+
+
+def cache_headers(etag, last_modified, max_age):
+    """
+    Set the caching headers for a response
+
+    Returns True if the client already has this version, so a 304 response
+    can be sent instead.
+    """
+    bottle.response.headers['ETag'] = etag
+    if last_modified:
+        bottle.response.headers['Last-Modified'] = bottle.http_date(last_modified)
+    bottle.response.headers['Cache-Control'] = 'public, max-age={}'.format(max_age)
+    return not_modified(etag, last_modified)
+
+
+def record_not_modified(record_id, record, variant):
+    """
+    Set the caching headers for a single record, and set the status to 304 if
+    the client already has it
+    """
+    etag, last_modified = record_etag(record_id, record, variant)
+    if etag is None:
+        return False
+    if cache_headers(etag, last_modified, RECORD_MAX_AGE):
+        bottle.response.status = 304
+        return True
+    return False
+
+
+def record_etag(record_id, record, variant):
+    """
+    Get the ETag and last modified date for a single record
+
+    The ETag is based on the record's `last_modified` date and the way it is
+    being shown (`variant`), and for HTML pages on the templates too. Returns
+    `(None, None)` if the record doesn't have a `last_modified` date.
+    """
+    last_modified = record.get("last_modified")
+    if isinstance(last_modified, str):
+        try:
+            last_modified = parser.parse(last_modified)
+        except ValueError:
+            last_modified = None
+    if not isinstance(last_modified, datetime):
+        return None, None
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    last_modified = last_modified.replace(microsecond=0)
+
+    if variant != "json":
+        variant = "{}-{}".format(variant, VIEWS_VERSION)
+    etag = '"{}-{:x}-{}"'.format(record_id, int(last_modified.timestamp()), variant)
+    return etag, last_modified
+
+
+def not_modified(etag, last_modified, headers=None):
+    """
+    Check whether the client already has the current version of a resource
+
+    Uses the headers of the current request unless others are given.
+    """
+    if headers is None:
+        headers = bottle.request.headers
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match:
+        return etag in [e.strip() for e in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = bottle.parse_date(headers.get('If-Modified-Since', ''))
+    if if_modified_since and last_modified:
+        return int(last_modified.timestamp()) <= if_modified_since
+    return False
 
 
 @app.route('/about')
@@ -322,30 +652,52 @@ def autocomplete():
     Endpoint for autocomplete queries
     """
     search = bottle.request.params.q
-    doc = {
-        "suggest": {
-            "suggest-1": {
-                "prefix": search,
-                "completion": {
-                    "field": "complete_names",
-                    "fuzzy" : {
-                        "fuzziness" : 1
-                    }
-                }
-            }
-        }
-    }
-    res = app.config["es"].search(
-        index=app.config["es_index"], doc_type="csv_data", body=doc,
-        _source_include=['known_as'])
+    if app.config.get("autocomplete"):
+        results = app.config["autocomplete"].search(search, size=AUTOCOMPLETE_SIZE)
+    else:
+        results = app.config["storage"].completion(search, size=AUTOCOMPLETE_SIZE)
+    note(template="completion", params=[{"prefix": search, "size": AUTOCOMPLETE_SIZE}], results=len(results))
     return {"results": [
         {
-            "label": x["_source"]["known_as"],
-            "value": x["_id"]
-        } for x in res.get("suggest", {}).get("suggest-1", [])[0]["options"]
+            "label": label,
+            "value": record_id
+        } for record_id, label in results
     ]}
 
 
+@app.route('/metrics')
+def metrics():
+    """
+    Request, storage and cache metrics, in the Prometheus text format
+
+    These are for this worker, or for all the workers if `METRICS_DIR` is set.
+    """
+    bottle.response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    if app.config.get("shared_metrics"):
+        return app.config["shared_metrics"].render()
+    return registry.render()
+
+
+registry.collector(cache_collector(lambda: {
+    "result": app.config["result_cache"],
+    "page": app.config["page_cache"],
+}))
+
+
+@registry.collector
+def breaker_metrics():
+    """
+    State of the elasticsearch circuit breaker
+    """
+    stats = app.config["breaker"].stats()
+    yield ("ftc_breaker_open", "gauge", "Whether the circuit breaker is stopping requests to elasticsearch",
+           [({}, 0 if stats["state"] == CircuitBreaker.CLOSED else 1)])
+    yield ("ftc_breaker_trips_total", "counter", "Number of times the circuit breaker has opened",
+           [({}, stats["trips"])])
+    yield ("ftc_breaker_rejected_total", "counter", "Number of requests stopped by the circuit breaker",
+           [({}, stats["rejected"])])
+
+
 @app.route('/static/<filename:path>')
 def send_static(filename):
     """ Fetch static files
@@ -353,6 +705,24 @@ def send_static(filename):
     return bottle.static_file(filename, root='static')
 
 
+def render_record(template, res, **kwargs):
+    """
+    Render the page for a charity record, using the cached copy if there is one
+
+    Pages are cached by record id and `last_modified`, so a changed record
+    is rendered again.
+    """
+    cache = app.config["page_cache"]
+    key = (template, res["_id"], res["_source"].get("last_modified")) + tuple(sorted(kwargs.items()))
+    page = cache.get(key)
+    if page is None:
+        with timed("render"):
+            page = bottle.template(template, charity=sort_out_date(res["_source"]),
+                                   charity_id=res["_id"], **kwargs)
+        cache.set(key, page)
+    return page
+
+
 def sort_out_date(charity_record):
     """
     parse date fields in a charity record
@@ -367,15 +737,6 @@ def sort_out_date(charity_record):
                 pass
     return charity_record
 
-def clean_regno(regno):
-    """
-    Clean up a charity registration number
-    """
-    regno = str(regno)
-    regno = regno.upper()
-    regno = re.sub(r'^[^0-9SCNI]+|[^0-9]+$', '', regno)
-    return regno
-
 
 def main():
     """
@@ -397,36 +758,95 @@ def main():
     parser_args.add_argument('--admin-password', help='Password for accessing admin pages')
 
     # elasticsearch options
-    parser_args.add_argument('--es-host', default="localhost", help='host for the elasticsearch instance')
+    parser_args.add_argument('--es-host', default="localhost", help='host for the elasticsearch instance (separate several nodes with commas)')
     parser_args.add_argument('--es-port', default=9200, help='port for the elasticsearch instance')
     parser_args.add_argument('--es-url-prefix', default='', help='Elasticsearch url prefix')
     parser_args.add_argument('--es-use-ssl', action='store_true', help='Use ssl to connect to elasticsearch')
     parser_args.add_argument('--es-index', default='charitysearch', help='index used to store charity data')
     parser_args.add_argument('--es-type', default='charity', help='type used to store charity data')
+    parser_args.add_argument('--es-timeout', type=int, default=10, help='Default seconds allowed for each elasticsearch request')
+    parser_args.add_argument('--es-maxsize', type=int, default=10, help='Number of connections kept open to each elasticsearch node')
+    parser_args.add_argument('--es-max-retries', type=int, default=3, help='Number of times to retry a failed elasticsearch request')
+    parser_args.add_argument('--es-breaker-threshold', type=int, default=5,
+                             help='Failed elasticsearch requests in a row before requests fail fast for a while (0 to turn off)')
+    parser_args.add_argument('--es-stored-templates', action='store_true', help='Store the query templates in elasticsearch and search using their id')
+
+    # sqlite options
+    parser_args.add_argument('--sqlite', help='SQLite database to use instead of elasticsearch (see server/storage.py)')
+
+    parser_args.add_argument('--local-records', action='store_true',
+                             help='Look up single records in a record store built from the output files in the data folder, falling back to the storage')
 
     parser_args.add_argument('--ga-tracking-id', help='Google Analytics Tracking ID')
 
+    parser_args.add_argument('--autocomplete', default='elasticsearch', choices=['elasticsearch', 'local'],
+                             help='Where autocomplete suggestions come from. "local" uses an index built from the output files in the data folder')
+
+    # caching options
+    parser_args.add_argument('--cache-size', type=int, default=10000, help='Number of search and reconciliation results to cache (0 to turn off)')
+    parser_args.add_argument('--cache-ttl', type=int, default=3600, help='Seconds before a cached result expires')
+    parser_args.add_argument('--page-cache-size', type=int, default=10000, help='Number of rendered charity pages to cache (0 to turn off)')
+    parser_args.add_argument('--page-cache-bytes', type=int, default=64 * 1024 * 1024, help='Maximum memory used by cached charity pages')
+
+    # slow query log
+    parser_args.add_argument('--slow-query-log', help='File to log slow search, reconciliation and autocomplete requests to')
+    parser_args.add_argument('--slow-query-threshold', type=float, default=1, help='Seconds a request takes before it is logged as slow')
+    parser_args.add_argument('--slow-query-sample', type=float, default=1, help='Fraction of slow requests to log')
+
     args = parser_args.parse_args()
 
-    app.config["es"] = Elasticsearch(
-        host=args.es_host,
-        port=args.es_port,
-        url_prefix=args.es_url_prefix,
-        use_ssl=args.es_use_ssl
-    )
     app.config["es_index"] = args.es_index
     app.config["es_type"] = args.es_type
+    if args.sqlite:
+        app.config["storage"] = SQLiteStorage(args.sqlite, args.es_index, args.es_type)
+    else:
+        app.config["es"] = create_client(
+            [{"host": host, "port": args.es_port, "url_prefix": args.es_url_prefix, "use_ssl": args.es_use_ssl}
+             for host in parse_hosts(args.es_host)],
+            timeout=args.es_timeout,
+            maxsize=args.es_maxsize,
+            max_retries=args.es_max_retries,
+        )
+        app.config["breaker"].threshold = args.es_breaker_threshold
+        app.config["storage"] = BreakerStorage(ElasticsearchStorage(
+            app.config["es"], args.es_index, args.es_type), app.config["breaker"])
+    if args.local_records:
+        app.config["storage"] = LocalRecordStorage(
+            app.config["storage"],
+            os.path.join(args.folder, "output", "all.jsonl.gz")
+        )
+    app.config["storage"] = TimedStorage(app.config["storage"])
     app.config["ga_tracking_id"] = args.ga_tracking_id
     app.config["admin_password"] = args.admin_password
     app.config["folder"] = args.folder
+    app.config["result_cache"].maxsize = args.cache_size
+    app.config["result_cache"].ttl = args.cache_ttl
+    app.config["page_cache"].maxsize = args.page_cache_size
+    app.config["page_cache"].maxbytes = args.page_cache_bytes
+    app.config["random_ids"] = RandomIds(app.config["storage"])
+    if args.autocomplete == "local":
+        app.config["autocomplete"] = LocalAutocomplete(
+            os.path.join(args.folder, "output", "all.jsonl.gz")
+        )
+    if args.slow_query_log:
+        if app.config.get("slow_query_log"):
+            app.uninstall(app.config["slow_query_log"])
+        app.config["slow_query_log"] = app.install(SlowQueryLog(
+            args.slow_query_log, threshold=args.slow_query_threshold, sample=args.slow_query_sample))
 
     csv_app.config.update(app.config)
     bottle.debug(args.debug)
 
-    if not app.config["es"].ping():
-        raise ValueError("Elasticsearch connection failed")
+    if not app.config["storage"].ping():
+        raise ValueError("Connection to storage failed")
+
+    if args.es_stored_templates and not args.sqlite:
+        templates.use_stored(app.config["es"])
+
+    bottle.run(application, server=args.server, host=args.host, port=args.port, reloader=args.debug)
 
-    bottle.run(app, server=args.server, host=args.host, port=args.port, reloader=args.debug)
+# the app with request metrics recorded, used by gunicorn
+application = MetricsMiddleware(app, shared=app.config.get("shared_metrics"))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,236 @@
+"""
+Log of slow search, reconciliation and autocomplete requests
+
+`SlowQueryLog` is a bottle plugin. When a request to one of its routes takes
+longer than `threshold` seconds it writes a line of JSON describing it: the
+template and parameters of the queries that were run, the size of the batch,
+the time elasticsearch reported it took, the total time and the number of
+results. Route functions describe their queries with `note`.
+
+A captured log can be run again against an index, for example after the
+mapping or query templates have changed:
+
+    python server/slowlog.py data/slow_queries.jsonl --es-host localhost --concurrency 8
+
+The queries are rendered with the current templates, so run this from the
+folder containing `es_config.yml` and `recon_config.yml`.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from es_client import create_client, parse_hosts
+from metrics import timings, es_took, percentile
+from queries import templates
+from storage import ElasticsearchStorage
+
+
+class RequestNotes(threading.local):
+    """
+    Details of the queries run by the request being handled by this thread
+    """
+
+    def __init__(self):
+        self.details = {}
+
+
+notes = RequestNotes()
+
+
+def note(**details):
+    """
+    Describe the queries run by the current request, for the slow query log
+
+    Routes pass `template`, `params` (a list with the parameters of each
+    query) and `results` (the number of results found).
+    """
+    notes.details.update(details)
+
+
+class SlowQueryLog:
+    """
+    Bottle plugin writing requests slower than `threshold` seconds to a JSON lines file
+
+    Only `sample` (between 0 and 1) of the slow requests are written, to keep
+    the file small when everything is slow. `routes` are the names of the
+    route functions to log.
+    """
+    name = "slow_query_log"
+    api = 2
+
+    def __init__(self, filename, threshold=1.0, sample=1.0, routes=("home", "reconcile", "autocomplete")):
+        self.filename = filename
+        self.threshold = threshold
+        self.sample = sample
+        self.routes = set(routes)
+        self.lock = threading.Lock()
+        self.written = 0
+
+    def apply(self, callback, route):
+        if route.callback.__name__ not in self.routes:
+            return callback
+
+        def wrapper(*args, **kwargs):
+            notes.details = {}
+            took = timings.took
+            storage = timings.storage
+            start = time.perf_counter()
+            error = None
+            try:
+                return callback(*args, **kwargs)
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                total = time.perf_counter() - start
+                # requests that didn't run any queries (eg the service spec) aren't logged
+                ran_queries = notes.details.get("params") or error
+                if ran_queries and total >= self.threshold and random.random() < self.sample:
+                    self.write(dict(
+                        notes.details,
+                        route=route.rule,
+                        took=round(timings.took - took, 4),
+                        storage=round(timings.storage - storage, 4),
+                        total=round(total, 4),
+                        error=error,
+                    ))
+
+        return wrapper
+
+    def write(self, entry):
+        """
+        Add an entry to the log
+        """
+        params = entry.get("params") or []
+        entry.setdefault("batch_size", len(params))
+        entry["time"] = datetime.now(timezone.utc).isoformat()
+        line = json.dumps(entry, sort_keys=True, default=str) + "\n"
+        # each worker opens the file for appending, so lines from different workers don't overlap
+        with self.lock:
+            with open(self.filename, "a", encoding="utf8") as log_file:
+                log_file.write(line)
+            self.written += 1
+
+
+def read_log(filename, routes=None):
+    """
+    Read the entries in a slow query log, optionally only those for some routes
+    """
+    with open(filename, encoding="utf8") as log_file:
+        for line in log_file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry.get("params") is None:
+                continue
+            if routes and entry.get("route") not in routes:
+                continue
+            yield entry
+
+
+def replay_entry(storage, entry, template_registry=templates):
+    """
+    Run the queries from a log entry again
+
+    Returns the entry with the new total time, took time and number of
+    results added as `replay_total`, `replay_took` and `replay_results`.
+    """
+    start = time.perf_counter()
+    result = dict(entry)
+    try:
+        if entry["template"] == "completion":
+            res = None
+            results = sum(len(storage.completion(p["prefix"], size=p.get("size", 5))) for p in entry["params"])
+        else:
+            source = template_registry.get(entry["template"]).source
+            queries = [{"inline": source, "params": p} for p in entry["params"]]
+            if entry.get("batch"):
+                res = storage.msearch_template(queries)
+                responses = res.get("responses", [])
+            else:
+                res = storage.search_template(queries[0])
+                responses = [res]
+            results = sum(len(r.get("hits", {}).get("hits", [])) for r in responses)
+        result["replay_took"] = round(es_took(res), 4)
+        result["replay_results"] = results
+    except Exception as e:
+        result["replay_error"] = "{}: {}".format(type(e).__name__, e)
+    result["replay_total"] = round(time.perf_counter() - start, 4)
+    return result
+
+
+def summarise(results):
+    """
+    Percentiles of the logged and replayed times
+    """
+    summary = {"queries": len(results), "errors": sum(1 for r in results if "replay_error" in r)}
+    for key in ["total", "took", "replay_total", "replay_took"]:
+        values = [r[key] for r in results if r.get(key) is not None]
+        summary[key] = {
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": max(values) if values else None,
+        }
+    summary["slower"] = sum(
+        1 for r in results if r.get("replay_total") is not None and r["replay_total"] > r.get("total", 0))
+    return summary
+
+
+def main():
+    """
+    Replay a slow query log against an elasticsearch index
+    """
+    parser = argparse.ArgumentParser(description='Run the queries from a slow query log against an elasticsearch index')
+    parser.add_argument('log', help='slow query log to replay')
+    parser.add_argument('--es-host', default="localhost", help='host for the elasticsearch instance (separate several nodes with commas)')
+    parser.add_argument('--es-port', default=9200, help='port for the elasticsearch instance')
+    parser.add_argument('--es-url-prefix', default='', help='Elasticsearch url prefix')
+    parser.add_argument('--es-use-ssl', action='store_true', help='Use ssl to connect to elasticsearch')
+    parser.add_argument('--es-index', default='charitysearch', help='index to run the queries against')
+    parser.add_argument('--es-type', default='charity', help='type used to store charity data')
+    parser.add_argument('--es-timeout', type=int, default=30, help='seconds allowed for each elasticsearch request')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of queries to run at the same time')
+    parser.add_argument('--repeat', type=int, default=1, help='number of times to run each query')
+    parser.add_argument('--route', action='append', help='only replay requests to this route (can be given more than once)')
+    parser.add_argument('--output', help='write each replayed entry to this JSON lines file')
+    args = parser.parse_args()
+
+    es = create_client(
+        [{"host": host, "port": args.es_port, "url_prefix": args.es_url_prefix, "use_ssl": args.es_use_ssl}
+         for host in parse_hosts(args.es_host)],
+        timeout=args.es_timeout,
+        maxsize=max(args.concurrency, 1),
+        max_retries=0,
+    )
+    storage = ElasticsearchStorage(es, args.es_index, args.es_type)
+    entries = list(read_log(args.log, args.route)) * args.repeat
+    print("[replay] running {} queries against {} with concurrency {}".format(
+        len(entries), args.es_index, args.concurrency))
+
+    results = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(args.concurrency, 1)) as executor:
+        for result in executor.map(lambda e: replay_entry(storage, e), entries):
+            results.append(result)
+            print('\r', "[replay] %s queries run" % len(results), end='')
+    elapsed = time.perf_counter() - start
+    print('\r', "[replay] %s queries run in %0.1f seconds" % (len(results), elapsed))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as output:
+            for result in results:
+                output.write(json.dumps(result, sort_keys=True) + "\n")
+
+    summary = summarise(results)
+    summary["seconds"] = round(elapsed, 2)
+    summary["qps"] = round(len(results) / elapsed, 2) if elapsed else None
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
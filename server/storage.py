@@ -0,0 +1,545 @@
+"""
+Storage backends for the server
+
+The server talks to its data through one of these classes rather than
+calling elasticsearch directly. They all return responses in the same shape
+as elasticsearch does, so the rest of the server doesn't need to know which
+one is in use.
+
+- `ElasticsearchStorage` uses an elasticsearch index (the default)
+- `SQLiteStorage` uses an SQLite database with an FTS5 full text index, so
+  the server can run on one machine without elasticsearch. Create the
+  database from the output files with:
+
+      python server/storage.py data/output/all.jsonl.gz data/output/charities.sqlite
+"""
+import argparse
+import gzip
+import json
+import math
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+
+from elasticsearch.exceptions import ConnectionTimeout
+from elasticsearch.helpers import bulk, scan
+
+
+class ElasticsearchStorage:
+    """
+    Storage using an elasticsearch index
+    """
+
+    def __init__(self, es, es_index="charitysearch", es_type="charity"):
+        self.es = es
+        self.es_index = es_index
+        self.es_type = es_type
+        self.local = threading.local()
+
+    def set_request_timeout(self, seconds):
+        """
+        Give the requests made by the current thread `seconds` in total (None for the client default)
+
+        Each request gets the time that is left, so a route making several
+        requests can't take longer than its budget.
+        """
+        self.local.deadline = time.monotonic() + seconds if seconds else None
+
+    def _options(self):
+        deadline = getattr(self.local, "deadline", None)
+        if deadline is None:
+            return {}
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise ConnectionTimeout("TIMEOUT", "request budget used up", TimeoutError("request budget used up"))
+        return {"request_timeout": remaining}
+
+    def ping(self):
+        """
+        Check the index can be reached
+        """
+        return self.es.ping()
+
+    def get(self, record_id, source_exclude=None):
+        """
+        Fetch one record
+        """
+        kwargs = self._options()
+        if source_exclude:
+            kwargs["_source_exclude"] = source_exclude
+        return self.es.get(index=self.es_index, doc_type=self.es_type,
+                           id=record_id, ignore=[404], **kwargs)
+
+    def mget(self, ids, source_include=None, source_exclude=None):
+        """
+        Fetch a list of records
+        """
+        kwargs = self._options()
+        if source_include:
+            kwargs["_source_include"] = source_include
+        if source_exclude:
+            kwargs["_source_exclude"] = source_exclude
+        return self.es.mget(body={"ids": ids}, index=self.es_index,
+                            doc_type=self.es_type, **kwargs)
+
+    def search_template(self, query):
+        """
+        Run a search template query
+        """
+        return self.es.search_template(index=self.es_index, doc_type=self.es_type,
+                                       body=query, ignore=[404], **self._options())
+
+    def msearch_template(self, queries):
+        """
+        Run a list of search template queries in one request
+        """
+        body = []
+        for query in queries:
+            body.append({})
+            body.append(query)
+        return self.es.msearch_template(index=self.es_index, doc_type=self.es_type, body=body,
+                                        **self._options())
+
+    def find_orgids(self, orgids):
+        """
+        Search for the records with a list of org-ids
+
+        Returns a list of search hits for each org-id, from an exact match on
+        the `org-ids.keyword` field.
+        """
+        body = []
+        for orgid in orgids:
+            body.append({})
+            body.append({
+                "size": 5,
+                "query": {
+                    "constant_score": {
+                        "filter": {"term": {"org-ids.keyword": orgid}}
+                    }
+                },
+                "_source": {"excludes": ["complete_names"]},
+            })
+        res = self.es.msearch(index=self.es_index, doc_type=self.es_type, body=body,
+                              **self._options())
+        return [
+            sub_res.get("hits", {}).get("hits", [])
+            for sub_res in res.get("responses", [])
+        ]
+
+    def random_record(self, active=False):
+        """
+        Find a random record using a random score query
+        """
+        query = {
+            "size": 1,
+            "query": {
+                "function_score": {
+                    "functions": [
+                        {
+                            "random_score": {
+                                "seed": str(time.time())
+                            }
+                        }
+                    ]
+                }
+            }
+        }
+
+        if active:
+            query["query"]["function_score"]["query"] = {"match": {"active": True}}
+
+        res = self.es.search(index=self.es_index, doc_type=self.es_type,
+                             body=query, ignore=[404], **self._options())
+        if res.get("hits", {}).get("hits"):
+            return res["hits"]["hits"][0]
+        return None
+
+    def completion(self, prefix, size=5):
+        """
+        Suggest records whose names start with a prefix
+
+        Returns a list of (id, name) tuples.
+        """
+        doc = {
+            "suggest": {
+                "suggest-1": {
+                    "prefix": prefix,
+                    "completion": {
+                        "field": "complete_names",
+                        "size": size,
+                        "fuzzy" : {
+                            "fuzziness" : 1
+                        }
+                    }
+                }
+            }
+        }
+        res = self.es.search(index=self.es_index, doc_type=self.es_type, body=doc,
+                             _source_include=['known_as'], **self._options())
+        return [
+            (x["_id"], x["_source"]["known_as"])
+            for x in res.get("suggest", {}).get("suggest-1", [{}])[0].get("options", [])
+        ]
+
+    def scan(self, source_include=None):
+        """
+        Iterate through every record
+        """
+        kwargs = {"_source_include": source_include} if source_include else {}
+        return scan(self.es, index=self.es_index, doc_type=self.es_type,
+                    query={"query": {"match_all": {}}}, size=5000, **kwargs)
+
+    def bulk(self, actions):
+        """
+        Save a list of records
+        """
+        return bulk(self.es, actions, index=self.es_index, doc_type=self.es_type,
+                    raise_on_error=False, request_timeout=60)
+
+    def index_version(self):
+        """
+        Something that changes whenever records in the index are changed
+        """
+        stats = self.es.indices.stats(index=self.es_index, metric="indexing")
+        indexing = stats["_all"]["primaries"]["indexing"]
+        return (
+            tuple(sorted(stats.get("indices", {}).keys())),
+            indexing.get("index_total"),
+            indexing.get("delete_total"),
+        )
+
+
+class SQLiteStorage:
+    """
+    Storage using an SQLite database
+
+    Records are stored as JSON, with an FTS5 index of their names and
+    registration numbers used for searching. Search template queries use
+    the `name` parameter and are ranked in a similar way to the templates in
+    `es_config.yml` and `recon_config.yml`.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS records (
+            rowid INTEGER PRIMARY KEY,
+            id TEXT UNIQUE NOT NULL,
+            active INTEGER,
+            latest_income INTEGER,
+            source TEXT NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS orgids (
+            orgid TEXT PRIMARY KEY,
+            id TEXT NOT NULL
+        )""",
+        """CREATE VIRTUAL TABLE IF NOT EXISTS names USING fts5(
+            known_as, alt_names, numbers, tokenize='unicode61'
+        )""",
+    ]
+
+    # number of candidates fetched from the full text index before ranking
+    CANDIDATES = 100
+
+    def __init__(self, filename, es_index="charitysearch", es_type="charity", readonly=True):
+        self.filename = filename
+        self.es_index = es_index
+        self.es_type = es_type
+        self.readonly = readonly
+        self.local = threading.local()
+        self.generation = 0
+
+    def reopen(self):
+        """
+        Make each thread open a new connection, eg after the database file is replaced
+        """
+        self.generation += 1
+
+    @property
+    def db(self):
+        """
+        Connection to the database for the current thread
+        """
+        if getattr(self.local, "db", None) is None or self.local.generation != self.generation:
+            if getattr(self.local, "db", None) is not None:
+                self.local.db.close()
+            if self.readonly:
+                db = sqlite3.connect("file:{}?mode=ro".format(self.filename), uri=True)
+            else:
+                db = sqlite3.connect(self.filename)
+                for statement in self.SCHEMA:
+                    db.execute(statement)
+            self.local.db = db
+            self.local.generation = self.generation
+        return self.local.db
+
+    def _hit(self, record_id, source, score=None, source_include=None, source_exclude=None):
+        source = json.loads(source)
+        if source_include:
+            source = _include_fields(source, source_include)
+        for field in source_exclude or []:
+            source.pop(field, None)
+        hit = {
+            "_index": self.es_index,
+            "_type": self.es_type,
+            "_id": record_id,
+            "_source": source,
+        }
+        if score is not None:
+            hit["_score"] = score
+        return hit
+
+    def ping(self):
+        """
+        Check the database can be opened
+        """
+        try:
+            self.db.execute("SELECT 1 FROM records LIMIT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def get(self, record_id, source_exclude=None):
+        """
+        Fetch one record
+        """
+        row = self.db.execute("SELECT id, source FROM records WHERE id = ?", (record_id,)).fetchone()
+        if not row:
+            return {"_index": self.es_index, "_type": self.es_type, "_id": record_id, "found": False}
+        return dict(self._hit(*row, source_exclude=source_exclude), found=True)
+
+    def mget(self, ids, source_include=None, source_exclude=None):
+        """
+        Fetch a list of records
+        """
+        rows = {}
+        if ids:
+            rows = dict(self.db.execute(
+                "SELECT id, source FROM records WHERE id IN ({})".format(",".join("?" * len(ids))),
+                ids
+            ).fetchall())
+        docs = []
+        for record_id in ids:
+            if record_id in rows:
+                docs.append(dict(self._hit(record_id, rows[record_id], source_include=source_include,
+                                           source_exclude=source_exclude), found=True))
+            else:
+                docs.append({"_index": self.es_index, "_type": self.es_type, "_id": record_id, "found": False})
+        return {"docs": docs}
+
+    def search_template(self, query, size=10):
+        """
+        Search for records matching the `name` parameter of a search template query
+        """
+        start = time.perf_counter()
+        term = query.get("params", {}).get("name", "")
+        words = re.findall(r'\w+', term.lower())
+        hits = []
+        if words:
+            match = " OR ".join('"{}"'.format(w) for w in words)
+            rows = self.db.execute("""
+                SELECT r.id, r.source, r.active, r.latest_income, -bm25(names, 3.0, 1.0, 1.0)
+                FROM names JOIN records r ON r.rowid = names.rowid
+                WHERE names MATCH ?
+                ORDER BY bm25(names, 3.0, 1.0, 1.0)
+                LIMIT ?""", (match, self.CANDIDATES)).fetchall()
+            for record_id, source, active, latest_income, score in rows:
+                hit = self._hit(record_id, source, source_exclude=["complete_names"])
+                hit["_score"] = self._score(hit["_source"], term, words, score, active, latest_income)
+                hits.append(hit)
+        hits = sorted(hits, key=lambda h: -h["_score"])[:size]
+        return {
+            "took": int((time.perf_counter() - start) * 1000),
+            "hits": {
+                "total": len(hits),
+                "max_score": hits[0]["_score"] if hits else None,
+                "hits": hits,
+            }
+        }
+
+    def _score(self, source, term, words, score, active, latest_income):
+        """
+        Boost the full text score in the same way as the function score in the templates
+        """
+        known_as = (source.get("known_as") or "").lower()
+        names = " ".join([known_as] + source.get("alt_names", [])).lower()
+        if known_as.startswith(term.lower().strip()):
+            score *= 200
+        if all(w in names for w in words):
+            score *= 10
+        if not active:
+            score *= 0.9
+        return score * math.log10(2 + (latest_income or 0))
+
+    def msearch_template(self, queries):
+        """
+        Run a list of search template queries
+        """
+        return {"responses": [self.search_template(query) for query in queries]}
+
+    def find_orgids(self, orgids):
+        """
+        Find the records with a list of org-ids
+
+        Returns a list of search hits for each org-id.
+        """
+        results = []
+        for orgid in orgids:
+            row = self.db.execute("""
+                SELECT r.id, r.source FROM orgids o JOIN records r ON r.id = o.id
+                WHERE o.orgid = ?""", (orgid,)).fetchone()
+            results.append([self._hit(*row, score=1.0, source_exclude=["complete_names"])] if row else [])
+        return results
+
+    def random_record(self, active=False):
+        """
+        Pick a random record
+        """
+        where = "WHERE active = 1" if active else ""
+        count = self.db.execute("SELECT count(*) FROM records {}".format(where)).fetchone()[0]
+        if not count:
+            return None
+        row = self.db.execute(
+            "SELECT id, source FROM records {} LIMIT 1 OFFSET ?".format(where),
+            (random.randrange(count),)
+        ).fetchone()
+        return self._hit(*row)
+
+    def completion(self, prefix, size=5):
+        """
+        Suggest records whose names start with a prefix
+
+        Returns a list of (id, name) tuples.
+        """
+        words = re.findall(r'\w+', prefix.lower())
+        if not words:
+            return []
+        match = " ".join('"{}"'.format(w) for w in words[:-1])
+        match = (match + ' "{}"*'.format(words[-1])).strip()
+        rows = self.db.execute("""
+            SELECT r.id, r.source FROM names JOIN records r ON r.rowid = names.rowid
+            WHERE names MATCH ?
+            ORDER BY r.latest_income DESC
+            LIMIT ?""", ("{known_as alt_names}: " + match, size)).fetchall()
+        return [(record_id, json.loads(source).get("known_as")) for record_id, source in rows]
+
+    def scan(self, source_include=None):
+        """
+        Iterate through every record
+        """
+        for row in self.db.execute("SELECT id, source FROM records ORDER BY rowid"):
+            yield self._hit(*row, source_include=source_include)
+
+    def bulk(self, actions):
+        """
+        Save a list of records
+
+        Each action is a record with its id in `_id`, as used by the
+        elasticsearch bulk helper.
+        """
+        db = self.db
+        count = 0
+        with db:
+            for action in actions:
+                record = {k: v for k, v in action.items() if not k.startswith("_")}
+                record_id = action["_id"]
+                existing = db.execute("SELECT rowid FROM records WHERE id = ?", (record_id,)).fetchone()
+                if existing:
+                    db.execute("DELETE FROM records WHERE rowid = ?", existing)
+                    db.execute("DELETE FROM orgids WHERE id = ?", (record_id,))
+                    db.execute("DELETE FROM names WHERE rowid = ?", existing)
+                cur = db.execute(
+                    "INSERT INTO records (id, active, latest_income, source) VALUES (?, ?, ?, ?)",
+                    (record_id, bool(record.get("active")), record.get("latest_income"),
+                     json.dumps(record, default=str))
+                )
+                db.execute(
+                    "INSERT INTO names (rowid, known_as, alt_names, numbers) VALUES (?, ?, ?, ?)",
+                    (cur.lastrowid, record.get("known_as") or "",
+                     " ".join(record.get("alt_names") or []), " ".join(_record_numbers(record)))
+                )
+                db.executemany(
+                    "INSERT OR REPLACE INTO orgids (orgid, id) VALUES (?, ?)",
+                    [(orgid, record_id) for orgid in record.get("org-ids") or []]
+                )
+                count += 1
+        return count, []
+
+    def index_version(self):
+        """
+        Something that changes whenever the database is replaced or changed
+        """
+        stat = os.stat(self.filename)
+        return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+
+def _include_fields(source, fields):
+    """
+    Keep only the listed fields in a record, including dotted nested fields
+    """
+    result = {}
+    for field in fields:
+        value = source
+        parts = field.split(".")
+        for part in parts:
+            if not isinstance(value, dict) or part not in value:
+                break
+            value = value[part]
+        else:
+            target = result
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = value
+    return result
+
+
+def _record_numbers(record):
+    """
+    Registration and company numbers for a record
+    """
+    numbers = [record.get(f) for f in ["ccew_number", "oscr_number", "ccni_number"]]
+    numbers += [c.get("number") for c in record.get("company_number") or []]
+    return [str(n) for n in numbers if n]
+
+
+def main():
+    """
+    Create an SQLite database from the output files
+    """
+    parser = argparse.ArgumentParser(description='Create an SQLite database for the server from the output files')
+    parser.add_argument('source', help='gzipped JSON lines file of records (eg data/output/all.jsonl.gz)')
+    parser.add_argument('target', help='SQLite database to create')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='number of records to save at a time')
+    args = parser.parse_args()
+
+    tmp_target = args.target + ".tmp"
+    if os.path.exists(tmp_target):
+        os.remove(tmp_target)
+    storage = SQLiteStorage(tmp_target, readonly=False)
+
+    count = 0
+    chunk = []
+    with gzip.open(args.source, 'rt', encoding='utf8') as records:
+        for line in records:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record["_id"] = record.pop("id")
+            chunk.append(record)
+            if len(chunk) >= args.chunk_size:
+                count += storage.bulk(chunk)[0]
+                chunk = []
+                print('\r', "[sqlite] %s records saved" % count, end='')
+    count += storage.bulk(chunk)[0]
+    print('\r', "[sqlite] %s records saved" % count)
+
+    storage.db.execute("INSERT INTO names(names) VALUES ('optimize')")
+    storage.db.commit()
+    storage.db.close()
+    os.replace(tmp_target, args.target)
+    print("[sqlite] database saved to {}".format(args.target))
+
+
+if __name__ == '__main__':
+    main()
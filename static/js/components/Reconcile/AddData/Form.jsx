@@ -8,6 +8,9 @@ import FieldSelector from "./FieldSelector";
 import FieldsToAdd from "./FieldsToAdd";
 import Progress from "./Progress";
 
+// number of charity numbers to send to the API in each request
+const BATCH_SIZE = 1000;
+
 const mapStateToProps = (state) => {
     return { 
         fields: state.fields,
@@ -70,36 +73,54 @@ class ReconcileAddData extends React.Component {
         let comp = this;
         if(charity_numbers){
 
-            // Promise which will return when all the charity data has been fetched
-            Promise.all([...charity_numbers].map(charity_number => {
+            // split the charity numbers into batches that can be fetched
+            // from the API in one request each
+            let batches = [];
+            let all_numbers = [...charity_numbers];
+            for (let i = 0; i < all_numbers.length; i += BATCH_SIZE) {
+                batches.push(all_numbers.slice(i, i + BATCH_SIZE));
+            }
 
-                // work out the URL to fetch charity data from
-                let charity_url = encodeURI(`/charity/${charity_number}.json`);
+            // Promise which will return when all the charity data has been fetched
+            Promise.all(batches.map(batch => {
 
                 // do the actual fetching of the data
-                // @TODO handle errors here
-                return fetch(charity_url)
+                return fetch('/charity/batch.json', {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/json' },
+                        body: JSON.stringify({
+                            ids: batch,
+                            fields: comp.fieldsToFetch(),
+                        }),
+                    })
                     .then(function (response) {
                         if(response.ok){
                             return response.json();
                         }
-                        comp.setState(function (prevState) {
-                            return { organisationsNotFound: prevState.organisationsNotFound + 1 }
-                        });
+                        throw new Error(response.statusText);
                     })
-                    .then(function (charity_data) {
-                        // when the data has been fetched store the record
-                        comp.props.addOrgRecord(
-                            charity_number, 
-                            comp.processCharity(charity_data)
-                        )
+                    .then(function (batch_data) {
+                        // when the data has been fetched store each record
+                        let found = 0;
+                        Object.entries(batch_data.records).forEach(([charity_number, charity_data]) => {
+                            if(charity_data){
+                                comp.props.addOrgRecord(
+                                    charity_number,
+                                    comp.processCharity(charity_data)
+                                )
+                                found += 1;
+                            }
+                        });
                         comp.setState(function (prevState) {
-                            return {organisationsFound: prevState.organisationsFound + 1}
+                            return {
+                                organisationsFound: prevState.organisationsFound + found,
+                                organisationsNotFound: prevState.organisationsNotFound + batch_data.not_found.length,
+                            }
                         });
                     })
                     .catch(function(error){
                         comp.setState(function (prevState) {
-                            return { fetchErrors: prevState.fetchErrors + 1 }
+                            return { fetchErrors: prevState.fetchErrors + batch.length }
                         });
                     });
 
@@ -111,6 +132,11 @@ class ReconcileAddData extends React.Component {
 
     }
 
+    // fields needed from the API to create the selected columns
+    fieldsToFetch(){
+        return this.props.fields_to_add.map(f => f == 'postcode' ? 'geo.postcode' : f);
+    }
+
     getCharityNumbers(){
         return new Set(this.props.data.map((record, i) => {
             if (record[this.props.charity_number_field] != "") {
@@ -123,7 +149,8 @@ class ReconcileAddData extends React.Component {
         let new_fields = {}
         this.props.fields_to_add.forEach(f => {
             if(f=='postcode'){
-                new_fields[f] = charity_data["geo"]["postcode"];
+                // records are only sent with the fields asked for, so geo may be missing
+                new_fields[f] = charity_data["geo"] ? charity_data["geo"]["postcode"] : undefined;
             } else {
                 new_fields[f] = charity_data[f];
             }
@@ -0,0 +1,13 @@
+"""
+The server and import scripts import their modules by name, so both folders
+are added to the path, and the tests run from the root of the repository
+(where the query templates are).
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.join(ROOT, "server"))
+sys.path.insert(0, os.path.join(ROOT, "data_import"))
+os.chdir(ROOT)
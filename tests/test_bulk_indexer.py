@@ -0,0 +1,81 @@
+import json
+import threading
+
+import pytest
+from elasticsearch import Elasticsearch
+
+from bulk_indexer import BulkIndexer, is_rejection, read_dead_letter
+
+
+class FakeClient(Elasticsearch):
+    """
+    Client whose bulk requests reject each document once, and fail documents with ids starting with "bad"
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.docs = set()
+        self.rejected = set()
+        self.lock = threading.Lock()
+
+    def bulk(self, body, **kwargs):
+        lines = body.splitlines()
+        items = []
+        for line in lines[::2]:
+            op_type, meta = list(json.loads(line).items())[0]
+            with self.lock:
+                if meta["_id"].startswith("bad"):
+                    items.append({op_type: {"_id": meta["_id"], "status": 400,
+                                            "error": {"type": "mapper_parsing_exception"}}})
+                elif meta["_id"] not in self.rejected:
+                    self.rejected.add(meta["_id"])
+                    items.append({op_type: {"_id": meta["_id"], "status": 429,
+                                            "error": {"type": "es_rejected_execution_exception"}}})
+                else:
+                    self.docs.add(meta["_id"])
+                    items.append({op_type: {"_id": meta["_id"], "status": 201}})
+        return {"took": 1, "errors": True, "items": items}
+
+
+def actions(ids):
+    return [{"_index": "charitysearch", "_type": "charity", "_id": i, "n": n} for n, i in enumerate(ids)]
+
+
+@pytest.fixture
+def dead_letter(tmpdir):
+    return str(tmpdir.join("bulk_failures.jsonl"))
+
+
+def test_is_rejection():
+    assert is_rejection({"status": 429})
+    assert is_rejection({"status": 400, "error": {"type": "es_rejected_execution_exception"}})
+    assert not is_rejection({"status": 400, "error": {"type": "mapper_parsing_exception"}})
+
+
+def test_retries_rejections_and_records_failures(dead_letter):
+    es = FakeClient()
+    ids = [str(i) for i in range(200)] + ["bad1", "bad2"]
+    indexer = BulkIndexer(es, workers=3, chunk_size=20, min_chunk_size=5, initial_backoff=0.001,
+                          dead_letter=dead_letter)
+    stats = indexer.index(actions(ids))
+    assert stats["indexed"] == 200
+    assert stats["failed"] == 2
+    assert stats["retried"] >= 200
+    assert es.docs == set(ids[:200])
+    assert indexer.failed_ids == {"bad1", "bad2"}
+
+    failed = list(read_dead_letter(dead_letter))
+    assert sorted(a["_id"] for a in failed) == ["bad1", "bad2"]
+    assert failed[0]["_op_type"] == "index"
+    assert "n" in failed[0]["_source"]
+
+
+def test_dead_letter_only_has_this_run(dead_letter):
+    with open(dead_letter, "w") as f:
+        f.write(json.dumps({"action": {"index": {"_id": "old"}}, "source": {}, "error": "x"}) + "\n")
+    BulkIndexer(FakeClient(), workers=1, initial_backoff=0.001, dead_letter=dead_letter).index(actions(["bad3"]))
+    assert [a["_id"] for a in read_dead_letter(dead_letter)] == ["bad3"]
+
+    BulkIndexer(FakeClient(), workers=1, initial_backoff=0.001, dead_letter=dead_letter).index(actions(["1"]))
+    with pytest.raises(IOError):
+        open(dead_letter)
@@ -0,0 +1,178 @@
+import fnmatch
+
+import pytest
+from elasticsearch.exceptions import NotFoundError, RequestError
+
+from create_elasticsearch import BUILD_SETTINGS, LIVE_SETTINGS, create_build_index, publish_index, \
+    rollback, generations, live_settings
+
+
+class FakeIndices:
+    """
+    Indexes and aliases kept in dictionaries, with the requests made to them
+    """
+
+    def __init__(self, remove_index=True):
+        self.settings = {}
+        self.aliases = {}
+        self.log = []
+        self.remove_index = remove_index
+
+    def create(self, index, body=None):
+        self.settings[index] = dict(body["settings"]) if body else {}
+
+    def put_mapping(self, doc_type, body, index=None):
+        self.log.append(("mapping", index))
+
+    def exists(self, index):
+        return index in self.settings or index in self.aliases.values()
+
+    def exists_alias(self, name):
+        return name in self.aliases.values()
+
+    def get_alias(self, name):
+        found = {i: {"aliases": {name: {}}} for i, alias in self.aliases.items() if alias == name}
+        if not found:
+            raise NotFoundError(404, "alias missing")
+        return found
+
+    def get(self, index):
+        return {i: {} for i in self.settings if fnmatch.fnmatch(i, index)}
+
+    def get_settings(self, index):
+        return {index: {"settings": {"index": {k: str(v) for k, v in self.settings[index].items()}}}}
+
+    def put_settings(self, index, body):
+        self.settings[index].update(body["index"])
+        self.log.append(("settings", index, body["index"]))
+
+    def refresh(self, index):
+        pass
+
+    def forcemerge(self, index, **kwargs):
+        self.log.append(("forcemerge", index))
+
+    def update_aliases(self, body):
+        for action in body["actions"]:
+            op, params = list(action.items())[0]
+            if op == "remove_index" and not self.remove_index:
+                raise RequestError(400, "action_request_validation_exception")
+        for action in body["actions"]:
+            op, params = list(action.items())[0]
+            if op == "add":
+                self.aliases[params["index"]] = params["alias"]
+            elif op == "remove":
+                self.aliases.pop(params["index"])
+            elif op == "remove_index":
+                self.settings.pop(params["index"])
+        self.log.append(("aliases", body["actions"]))
+
+    def delete(self, index):
+        self.settings.pop(index)
+        self.aliases.pop(index, None)
+        self.log.append(("delete", index))
+
+
+class FakeCluster:
+    def __init__(self):
+        self.calls = []
+
+    def health(self, **kwargs):
+        self.calls.append(kwargs)
+        return {"status": "yellow"}
+
+
+class FakeClient:
+    def __init__(self, remove_index=True):
+        self.indices = FakeIndices(remove_index)
+        self.cluster = FakeCluster()
+
+
+def build(es, name):
+    """
+    Add a built index with a given timestamp
+    """
+    index = "charitysearch_" + name
+    es.indices.create(index=index, body={"settings": BUILD_SETTINGS})
+    return index
+
+
+def test_create_build_index():
+    es = FakeClient()
+    index = create_build_index(es, "charitysearch", "charity")
+    assert generations(es, "charitysearch") == [index]
+    assert es.indices.settings[index] == BUILD_SETTINGS
+    assert ("mapping", index) in es.indices.log
+
+
+def test_publish_first_index():
+    es = FakeClient()
+    index = build(es, "20190101000000")
+    publish_index(es, index, "charitysearch")
+    assert es.indices.aliases == {index: "charitysearch"}
+    assert live_settings(es, "charitysearch") == {k: str(v) for k, v in LIVE_SETTINGS.items()}
+    assert ("forcemerge", index) in es.indices.log
+    assert es.cluster.calls[0]["timeout"]
+
+
+def test_publish_copies_live_settings():
+    es = FakeClient()
+    first = build(es, "20190101000000")
+    publish_index(es, first, "charitysearch")
+    es.indices.put_settings(index=first, body={"index": {"number_of_replicas": 2, "refresh_interval": "30s"}})
+
+    second = build(es, "20190102000000")
+    publish_index(es, second, "charitysearch")
+    assert es.indices.aliases == {second: "charitysearch"}
+    assert es.indices.settings[second] == {"number_of_replicas": "2", "refresh_interval": "30s"}
+
+    third = build(es, "20190103000000")
+    publish_index(es, third, "charitysearch", replicas=0)
+    assert es.indices.settings[third] == {"number_of_replicas": 0, "refresh_interval": "30s"}
+
+
+def test_publish_keeps_previous_generations():
+    es = FakeClient()
+    indexes = []
+    for day in range(1, 6):
+        indexes.append(build(es, "2019010{}000000".format(day)))
+        publish_index(es, indexes[-1], "charitysearch", keep=2)
+    assert generations(es, "charitysearch") == indexes[-3:]
+    assert es.indices.aliases == {indexes[-1]: "charitysearch"}
+
+
+def test_publish_replaces_plain_index():
+    es = FakeClient()
+    es.indices.create(index="charitysearch", body={"settings": {"number_of_replicas": 3}})
+    index = build(es, "20190101000000")
+    publish_index(es, index, "charitysearch")
+    assert "charitysearch" not in es.indices.settings
+    assert es.indices.aliases == {index: "charitysearch"}
+    assert es.indices.settings[index]["number_of_replicas"] == "3"
+    # the index was replaced in the same request as the alias was added
+    assert not any(entry[0] == "delete" for entry in es.indices.log)
+
+
+def test_publish_plain_index_needs_replace_index():
+    es = FakeClient(remove_index=False)
+    es.indices.create(index="charitysearch")
+    index = build(es, "20190101000000")
+    with pytest.raises(ValueError):
+        publish_index(es, index, "charitysearch")
+    assert es.indices.aliases == {}
+
+    publish_index(es, index, "charitysearch", replace_index=True)
+    assert es.indices.aliases == {index: "charitysearch"}
+    assert ("delete", "charitysearch") in es.indices.log
+
+
+def test_rollback():
+    es = FakeClient()
+    first = build(es, "20190101000000")
+    second = build(es, "20190102000000")
+    publish_index(es, first, "charitysearch")
+    publish_index(es, second, "charitysearch")
+    assert rollback(es, "charitysearch") == first
+    assert es.indices.aliases == {first: "charitysearch"}
+    with pytest.raises(ValueError):
+        rollback(es, "charitysearch")
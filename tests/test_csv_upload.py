@@ -0,0 +1,103 @@
+import io
+import sys
+
+import pytest
+from elasticsearch.exceptions import ConnectionTimeout
+
+from csv_upload import csv_app, enrich_rows, field_value
+
+RECORDS = {
+    "123": {"known_as": "Village Hall", "geo": {"postcode": "AB1 2CD"}, "latest_income": 1000},
+    "SC0001": {"known_as": "Age Scotland", "geo": {"postcode": "EH1 1AA"}, "latest_income": 50000},
+}
+
+
+class FakeStorage:
+    """
+    Storage answering `mget` from `RECORDS`, failing after `fail_after` calls
+    """
+
+    def __init__(self, fail_after=None):
+        self.calls = 0
+        self.fail_after = fail_after
+
+    def mget(self, ids, source_include=None, source_exclude=None):
+        self.calls += 1
+        if self.fail_after is not None and self.calls > self.fail_after:
+            raise ConnectionTimeout("TIMEOUT", "timed out", TimeoutError("timed out"))
+        return {"docs": [
+            {"_id": i, "found": True, "_source": RECORDS[i]} if i in RECORDS else {"_id": i, "found": False}
+            for i in ids
+        ]}
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    storage = FakeStorage()
+    monkeypatch.setitem(csv_app.config, "storage", storage)
+    return storage
+
+
+def post_csv(body, query="charity_number_field=regno"):
+    environ = {
+        "REQUEST_METHOD": "POST", "PATH_INFO": "/adddata.csv", "QUERY_STRING": query,
+        "CONTENT_TYPE": "text/csv", "CONTENT_LENGTH": str(len(body)), "wsgi.input": io.BytesIO(body),
+        "SERVER_NAME": "localhost", "SERVER_PORT": "80", "wsgi.url_scheme": "http", "wsgi.errors": sys.stderr,
+    }
+    status = []
+    body = b"".join(csv_app(environ, lambda s, headers, exc_info=None: status.append(s)))
+    return status[0], body.decode("utf8")
+
+
+def test_field_value():
+    record = {"geo": {"postcode": "AB1 2CD"}, "company_number": [{"number": "001"}, {"number": "002"}]}
+    assert field_value(record, "geo.postcode") == "AB1 2CD"
+    assert field_value(record, "company_number") == "001; 002"
+    assert field_value(record, "missing.field") is None
+    assert field_value(None, "known_as") is None
+
+
+def test_enrich_rows(storage):
+    rows = [["x", "123"], ["y", "SC0001"], ["z", "999"], ["short"]]
+    output = "".join(enrich_rows(iter(rows), ["name", "regno"], 1, ["known_as", "geo.postcode"], batch_size=2))
+    assert output.splitlines() == [
+        "name,regno,findthatcharity_known_as,findthatcharity_geo.postcode",
+        "x,123,Village Hall,AB1 2CD",
+        "y,SC0001,Age Scotland,EH1 1AA",
+        "z,999,,",
+        "short,,",
+    ]
+    assert storage.calls == 2
+
+
+def test_enrich_rows_raises_errors_in_first_batch(monkeypatch):
+    monkeypatch.setitem(csv_app.config, "storage", FakeStorage(fail_after=0))
+    rows = enrich_rows(iter([["x", "123"]]), ["name", "regno"], 1, ["known_as"])
+    with pytest.raises(ConnectionTimeout):
+        next(rows)
+
+
+def test_enrich_rows_ends_with_error_row(monkeypatch):
+    monkeypatch.setitem(csv_app.config, "storage", FakeStorage(fail_after=1))
+    rows = [["x", "123"], ["y", "SC0001"], ["z", "123"]]
+    output = "".join(enrich_rows(iter(rows), ["name", "regno"], 1, ["known_as"], batch_size=2))
+    lines = output.splitlines()
+    assert lines[:3] == ["name,regno,findthatcharity_known_as", "x,123,Village Hall", "y,SC0001,Age Scotland"]
+    assert lines[3].startswith("ERROR: the file stopped after 2 rows")
+
+
+def test_upload(storage):
+    status, body = post_csv(b"name,regno\nx,123\n")
+    assert status.startswith("200")
+    assert body.splitlines()[1] == "x,123,Village Hall,AB1 2CD,1000"
+
+
+def test_upload_missing_column(storage):
+    status, _ = post_csv(b"name,number\nx,123\n")
+    assert status.startswith("400")
+
+
+def test_upload_not_utf8(storage):
+    status, body = post_csv(b"name,regno\n\xff\xfe,123\n")
+    assert status.startswith("400")
+    assert "UTF-8" in body
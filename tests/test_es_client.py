@@ -0,0 +1,84 @@
+import time
+
+import pytest
+from elasticsearch.exceptions import ConnectionError as ESConnectionError, ConnectionTimeout, TransportError
+
+from es_client import BreakerStorage, CircuitBreaker, CircuitOpenError
+from storage import ElasticsearchStorage
+
+
+class FakeStorage:
+    def __init__(self, error=None):
+        self.error = error
+
+    def get(self, record_id):
+        if self.error:
+            raise self.error
+        return {"_id": record_id, "found": True}
+
+    def scan(self, count):
+        for i in range(count):
+            if self.error and i == 1:
+                raise self.error
+            yield i
+
+
+def test_request_deadline():
+    storage = ElasticsearchStorage(es=None)
+    assert storage._options() == {}
+    storage.set_request_timeout(5)
+    assert 4 < storage._options()["request_timeout"] <= 5
+    storage.set_request_timeout(0.01)
+    time.sleep(0.02)
+    with pytest.raises(ConnectionTimeout):
+        storage._options()
+    storage.set_request_timeout(None)
+    assert storage._options() == {}
+
+
+def test_breaker_opens_after_failures():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=30)
+    storage = BreakerStorage(FakeStorage(ESConnectionError("N/A", "down", None)), breaker)
+    for _ in range(2):
+        with pytest.raises(ESConnectionError):
+            storage.get("123")
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        storage.get("123")
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_breaker_ignores_bad_requests():
+    breaker = CircuitBreaker(threshold=1)
+    storage = BreakerStorage(FakeStorage(TransportError(400, "bad request")), breaker)
+    with pytest.raises(TransportError):
+        storage.get("123")
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_half_open():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    breaker.opened -= 30
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    # only one trial call at a time
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_scan_records_outcome():
+    breaker = CircuitBreaker(threshold=1)
+    failing = BreakerStorage(FakeStorage(ESConnectionError("N/A", "down", None)), breaker)
+    results = failing.scan(3)
+    # nothing is recorded until the scroll runs
+    assert breaker.state == CircuitBreaker.CLOSED
+    with pytest.raises(ESConnectionError):
+        list(results)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    breaker.record_success()
+    breaker.failures = 0
+    assert list(BreakerStorage(FakeStorage(), breaker).scan(3)) == [0, 1, 2]
+    assert breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,74 @@
+import json
+import os
+
+import pytest
+
+import metrics
+from metrics import Registry, SharedMetrics
+
+
+@pytest.fixture
+def registry():
+    registry = Registry()
+    registry.counter("requests_total", "Requests", labels=("route",))
+    registry.histogram("request_seconds", "Request time", labels=("route",), buckets=(0.1, 1))
+    registry.collector(lambda: [("cache_items", "gauge", "Items in the cache", [({"cache": "result"}, 3)])])
+    return registry
+
+
+@pytest.fixture
+def shared(registry, tmpdir, monkeypatch):
+    # don't save to the temporary folder when the tests finish
+    monkeypatch.setattr(metrics.atexit, "register", lambda func: func)
+    return SharedMetrics(registry, str(tmpdir.join("metrics")))
+
+
+def test_histogram_samples(registry):
+    histogram = registry.metrics[1]
+    histogram.observe(0.05, "search")
+    histogram.observe(0.5, "search")
+    histogram.observe(5, "search")
+    samples = dict(histogram.samples())
+    assert samples['request_seconds_bucket{route="search",le="0.1"}'] == 1
+    assert samples['request_seconds_bucket{route="search",le="1"}'] == 2
+    assert samples['request_seconds_bucket{route="search",le="+Inf"}'] == 3
+    assert samples['request_seconds_count{route="search"}'] == 3
+    assert samples['request_seconds_sum{route="search"}'] == pytest.approx(5.55)
+
+
+def test_shared_metrics_add_up_workers(registry, shared):
+    counter, histogram = registry.metrics
+    counter.inc("search", amount=2)
+    histogram.observe(0.5, "search")
+
+    # another worker that is still running, and one that has stopped
+    other = {
+        "metrics": {
+            "requests_total": [[["search"], 3], [["reconcile"], 1]],
+            "request_seconds": [[["search"], [1, 0, 0, 0.05]]],
+        },
+        "collected": [["cache_items", "gauge", "Items in the cache", [[{"cache": "result"}, 4]]]],
+    }
+    with open(os.path.join(shared.folder, "{}.json".format(os.getppid())), "w") as f:
+        json.dump(other, f)
+    with open(os.path.join(shared.folder, "999999999.json"), "w") as f:
+        json.dump(other, f)
+
+    lines = shared.render().splitlines()
+    assert 'requests_total{route="search"} 8' in lines
+    assert 'requests_total{route="reconcile"} 2' in lines
+    assert 'request_seconds_count{route="search"} 3' in lines
+    # gauges from workers that have stopped aren't counted
+    assert 'cache_items{cache="result"} 7' in lines
+    assert os.path.exists(os.path.join(shared.folder, "{}.json".format(os.getpid())))
+    # the worker's own metrics aren't changed by adding up the others
+    assert dict(counter.samples())['requests_total{route="search"}'] == 2
+
+
+def test_shared_metrics_skip_other_files(shared):
+    with open(os.path.join(shared.folder, "notes.txt"), "w") as f:
+        f.write("not metrics")
+    with open(os.path.join(shared.folder, "123.json"), "w") as f:
+        f.write("{broken")
+    shared.save()
+    assert [pid for pid, _ in shared.snapshots()] == [os.getpid()]
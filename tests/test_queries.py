@@ -0,0 +1,108 @@
+import time
+
+from cache import ResultCache, normalise_term
+from queries import templates, recon_query, recon_response, extend_fields, extend_response
+
+
+def search_response(*hits):
+    return {"hits": {
+        "max_score": max(score for _, _, score in hits),
+        "hits": [{
+            "_id": record_id,
+            "_type": "charity",
+            "_index": "charitysearch",
+            "_score": score,
+            "_source": {"known_as": name, "active": True},
+        } for record_id, name, score in hits],
+    }}
+
+
+def test_normalise_term():
+    assert normalise_term("  Village\tHALL \n") == "village hall"
+
+
+def test_cache_key_is_normalised():
+    assert templates.cache_key("recon", "Village  Hall") == templates.cache_key("recon", "village hall")
+    assert templates.cache_key("recon", "village hall") != templates.cache_key("search", "village hall")
+
+
+def test_recon_response_matches_normalised_term():
+    for term in ["Village Hall", "village  hall", " VILLAGE HALL"]:
+        result = recon_response(search_response(("123", "Village Hall", 2.0), ("456", "Village Hall Trust", 1.0)),
+                                recon_query(term))
+        assert [(r["id"], r["match"]) for r in result["result"]] == [("123", True), ("456", False)]
+        assert result["result"][0]["name"] == "Village Hall (123)"
+
+
+def test_recon_response_only_matches_best_score():
+    result = recon_response(search_response(("456", "Village Hall Trust", 2.0), ("123", "Village Hall", 1.0)),
+                            recon_query("village hall"))
+    assert not any(r["match"] for r in result["result"])
+
+
+def test_result_cache_evicts_least_recently_used():
+    cache = ResultCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_result_cache_expires_entries():
+    cache = ResultCache(maxsize=2, ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a") is None
+
+
+def test_result_cache_copies_values():
+    cache = ResultCache(maxsize=2, copy=True)
+    value = {"result": [{"id": "123"}]}
+    cache.set("a", value)
+    value["result"].clear()
+    cache.get("a")["result"].clear()
+    assert cache.get("a") == {"result": [{"id": "123"}]}
+
+
+def test_extend_fields():
+    extend = {"properties": [{"id": "postcode"}, {"id": "known_as"}, {"id": "postcode"}, {"id": "unknown"}]}
+    assert extend_fields(extend) == ["geo.postcode", "known_as"]
+
+
+def test_extend_response():
+    extend = {
+        "ids": ["123", 456, "999"],
+        "properties": [{"id": "postcode"}, {"id": "company_number"}, {"id": "latest_income"},
+                       {"id": "active"}, {"id": "unknown"}],
+    }
+    records = {
+        "123": {"geo": {"postcode": "AB1 2CD"}, "company_number": [], "latest_income": 1000, "active": True},
+        "456": {"geo": {"postcode": None}, "company_number": [{"number": "00001234"}, {"number": ""}],
+                "latest_income": "50000", "active": False},
+        "999": None,
+    }
+    response = extend_response(extend, records)
+    assert response["meta"] == [
+        {"id": "postcode", "name": "Postcode"},
+        {"id": "company_number", "name": "Company number"},
+        {"id": "latest_income", "name": "Latest income"},
+        {"id": "active", "name": "Active"},
+        {"id": "unknown", "name": "unknown"},
+    ]
+    assert list(response["rows"].keys()) == ["123", "456", "999"]
+    assert response["rows"]["123"] == {
+        "postcode": [{"str": "AB1 2CD"}],
+        "company_number": [],
+        "latest_income": [{"float": 1000.0}],
+        "active": [{"bool": True}],
+        "unknown": [],
+    }
+    assert response["rows"]["456"]["postcode"] == []
+    assert response["rows"]["456"]["company_number"] == [{"str": "00001234"}]
+    assert response["rows"]["456"]["latest_income"] == [{"float": 50000.0}]
+    assert response["rows"]["456"]["active"] == [{"bool": False}]
+    assert all(values == [] for values in response["rows"]["999"].values())
@@ -0,0 +1,83 @@
+import pytest
+
+from record_hashes import HashStore, record_hash
+
+
+def record(record_id, name, last_modified="2019-01-01T00:00:00"):
+    return {"_id": record_id, "_index": "charitysearch", "_type": "charity",
+            "known_as": name, "last_modified": last_modified}
+
+
+@pytest.fixture
+def filename(tmpdir):
+    return str(tmpdir.join("import_hashes.sqlite"))
+
+
+def run(filename, records, delta=True, failed_ids=(), deleted=True, batch_size=2):
+    """
+    Go through an import, returning the ids sent and the ids deleted
+    """
+    hashes = HashStore(filename)
+    sent = [r["_id"] for r in hashes.changes(records, delta=delta, batch_size=batch_size)]
+    deletions = [d["_id"] for d in hashes.deletions("charitysearch", "charity")]
+    hashes.commit(failed_ids, deleted=deleted)
+    hashes.close()
+    return sent, deletions
+
+
+def test_record_hash_ignores_generated_fields():
+    assert record_hash(record("1", "A", "2019-01-01")) == record_hash(dict(record("1", "A", "2020-01-01"),
+                                                                           complete_names=["a"]))
+    assert record_hash(record("1", "A")) != record_hash(record("1", "B"))
+
+
+def test_only_changes_are_sent(filename):
+    assert run(filename, [record("1", "A"), record("2", "B"), record("3", "C")]) == (["1", "2", "3"], [])
+    assert run(filename, [record("1", "A"), record("2", "B2"), record("4", "D")]) == (["2", "4"], ["3"])
+    assert run(filename, [record("1", "A"), record("2", "B2"), record("4", "D")]) == ([], [])
+
+
+def test_unchanged_records_keep_last_modified(filename):
+    run(filename, [record("1", "A", "2019-01-01T00:00:00")])
+    unchanged = record("1", "A", "2020-06-01T00:00:00")
+    hashes = HashStore(filename)
+    list(hashes.changes([unchanged], delta=False))
+    hashes.close()
+    assert unchanged["last_modified"] == "2019-01-01T00:00:00"
+
+
+def test_full_import_sends_everything(filename):
+    run(filename, [record("1", "A"), record("2", "B")])
+    sent, _ = run(filename, [record("1", "A"), record("2", "B")], delta=False)
+    assert sent == ["1", "2"]
+
+
+def test_failed_records_are_sent_again(filename):
+    run(filename, [record("1", "A"), record("2", "B")])
+    sent, _ = run(filename, [record("1", "A2"), record("2", "B2"), record("3", "C")], failed_ids={"2", "3"})
+    assert sent == ["1", "2", "3"]
+    # the failed records still have their old hash (or none), so they are sent again
+    sent, _ = run(filename, [record("1", "A2"), record("2", "B2"), record("3", "C")])
+    assert sent == ["2", "3"]
+
+
+def test_failed_deletes_are_sent_again(filename):
+    run(filename, [record("1", "A"), record("2", "B")])
+    assert run(filename, [record("1", "A")], failed_ids={"2"}) == ([], ["2"])
+    assert run(filename, [record("1", "A")]) == ([], ["2"])
+    assert run(filename, [record("1", "A")]) == ([], [])
+    assert len(HashStore(filename)) == 1
+
+
+def test_missing_records_kept_without_deleted(filename):
+    run(filename, [record("1", "A"), record("2", "B")])
+    run(filename, [record("1", "A")], deleted=False)
+    assert len(HashStore(filename)) == 2
+
+
+def test_nothing_saved_until_commit(filename):
+    hashes = HashStore(filename)
+    assert [r["_id"] for r in hashes.changes([record("1", "A"), record("2", "B")])] == ["1", "2"]
+    hashes.close()
+    # the import stopped before commit, so the records are sent again
+    assert run(filename, [record("1", "A"), record("2", "B")]) == (["1", "2"], [])
@@ -0,0 +1,95 @@
+import gzip
+import json
+
+import pytest
+
+from record_store import build_store, RecordStore, LocalRecordStorage
+
+RECORDS = [
+    {"id": "SC0001", "known_as": "Age Scotland", "active": False, "complete_names": ["age"]},
+    {"id": "123", "known_as": "Village Hall", "active": True, "geo": {"postcode": "AB1 2CD"}},
+    {"id": "NIC100", "known_as": "Belfast Trust", "active": True},
+]
+
+
+class FailingStorage:
+    """
+    Wrapped storage that knows one extra record, or can't be reached
+    """
+    es_index = "charitysearch"
+    es_type = "charity"
+
+    def __init__(self, down=False):
+        self.down = down
+        self.calls = []
+
+    def get(self, record_id, source_exclude=None):
+        self.calls.append(("get", record_id))
+        if self.down:
+            raise ConnectionError("elasticsearch is down")
+        return {"_id": record_id, "found": record_id == "999", "_source": {"known_as": "Remote"}}
+
+    def mget(self, ids, source_include=None, source_exclude=None):
+        self.calls.append(("mget", ids))
+        if self.down:
+            raise ConnectionError("elasticsearch is down")
+        return {"docs": [{"_id": i, "found": i == "999", "_source": {"known_as": "Remote"}} for i in ids]}
+
+
+@pytest.fixture
+def source(tmpdir):
+    filename = str(tmpdir.join("all.jsonl.gz"))
+    with gzip.open(filename, "wt", encoding="utf8") as f:
+        for record in RECORDS:
+            f.write(json.dumps(record) + "\n")
+    return filename
+
+
+def test_build_and_get(source, tmpdir):
+    target = str(tmpdir.join("all.records"))
+    assert build_store(source, target) == 3
+    store = RecordStore(target)
+    assert len(store) == 3
+    assert store.get("123") == {"known_as": "Village Hall", "active": True, "geo": {"postcode": "AB1 2CD"}}
+    # the id and completion names aren't kept in the records
+    assert store.get("SC0001") == {"known_as": "Age Scotland", "active": False}
+    assert store.get("NIC100")["known_as"] == "Belfast Trust"
+    assert store.get("12") is None
+    assert store.get("999") is None
+    assert [record_id for record_id, _ in store] == ["123", "NIC100", "SC0001"]
+
+
+def test_random_record(source, tmpdir):
+    target = str(tmpdir.join("all.records"))
+    build_store(source, target)
+    store = RecordStore(target)
+    for _ in range(10):
+        record_id, record = store.random_record(active=True)
+        assert record_id in ("123", "NIC100") and record["active"]
+
+
+def test_not_a_record_store(tmpdir):
+    filename = tmpdir.join("other.records")
+    filename.write_binary(b"NOTRECS!" + b"\0" * 16)
+    with pytest.raises(ValueError):
+        RecordStore(str(filename))
+
+
+def test_local_storage(source):
+    storage = FailingStorage()
+    local = LocalRecordStorage(storage, source)
+    assert local.get("123")["_source"]["known_as"] == "Village Hall"
+    assert local.get("999")["_source"]["known_as"] == "Remote"
+    assert storage.calls == [("get", "999")]
+
+    res = local.mget(["123", "999", "SC0001", "404"], source_include=["known_as"])
+    assert [doc["found"] for doc in res["docs"]] == [True, True, True, False]
+    assert res["docs"][0]["_source"] == {"known_as": "Village Hall"}
+    assert storage.calls[-1] == ("mget", ["999", "404"])
+
+
+def test_local_storage_while_down(source):
+    local = LocalRecordStorage(FailingStorage(down=True), source)
+    assert local.get("123")["found"]
+    assert not local.get("999")["found"]
+    assert [doc["found"] for doc in local.mget(["123", "999"])["docs"]] == [True, False]
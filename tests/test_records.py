@@ -0,0 +1,78 @@
+from records import clean_regno, orgid_to_id, fetch_orgids, fetch_records
+
+RECORDS = {
+    "123": {"known_as": "Village Hall", "org-ids": ["GB-CHC-123"]},
+    "SC0001": {"known_as": "Age Scotland", "org-ids": ["GB-SC-SC0001", "GB-COH-00001234"]},
+    "NIC100": {"known_as": "Belfast Trust", "org-ids": ["GB-NIC-100"]},
+}
+
+
+class FakeStorage:
+    """
+    Storage answering `mget` and `find_orgids` from `RECORDS`
+
+    `find_orgids` also returns a record that doesn't have the org-id, as a
+    partial match would, to check that it is left out.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def mget(self, ids, source_include=None, source_exclude=None):
+        self.calls.append(("mget", ids))
+        return {"docs": [
+            {"_id": i, "found": True, "_source": dict(RECORDS[i])} if i in RECORDS else {"_id": i, "found": False}
+            for i in ids
+        ]}
+
+    def find_orgids(self, orgids):
+        self.calls.append(("find_orgids", orgids))
+        return [
+            [{"_id": "123", "_source": dict(RECORDS["123"])}] +
+            [{"_id": i, "_source": dict(r)} for i, r in RECORDS.items() if orgid in r["org-ids"]]
+            for orgid in orgids
+        ]
+
+
+class FakeApp:
+    def __init__(self, storage):
+        self.config = {"storage": storage}
+
+
+def test_clean_regno():
+    assert clean_regno(" 123456 ") == "123456"
+    assert clean_regno("sc012345") == "SC012345"
+    assert clean_regno(123) == "123"
+
+
+def test_orgid_to_id():
+    assert orgid_to_id("GB-CHC-123") == "123"
+    assert orgid_to_id("GB-SC-SC0001") == "SC0001"
+    assert orgid_to_id("GB-NIC-100") == "NIC100"
+    assert orgid_to_id("GB-COH-00001234") is None
+
+
+def test_fetch_records():
+    storage = FakeStorage()
+    records = fetch_records(["123", " sc0001", "999", "123"], FakeApp(storage), chunk_size=1)
+    assert list(records.keys()) == ["123", " sc0001", "999"]
+    assert records["123"]["known_as"] == "Village Hall"
+    assert records[" sc0001"]["known_as"] == "Age Scotland"
+    assert records["999"] is None
+    assert len(storage.calls) == 3
+
+
+def test_fetch_orgids():
+    storage = FakeStorage()
+    orgids = ["gb-chc-123", "GB-COH-00001234", "GB-NIC-100", "GB-CHC-999", "XI-UNKNOWN-1"]
+    found = fetch_orgids(orgids, FakeApp(storage))
+    assert list(found.keys()) == orgids
+    assert found["gb-chc-123"]["id"] == "123"
+    assert found["GB-COH-00001234"]["id"] == "SC0001"
+    assert found["GB-NIC-100"]["id"] == "NIC100"
+    assert found["GB-CHC-999"] is None
+    assert found["XI-UNKNOWN-1"] is None
+
+    # ids that can be worked out are fetched directly, and only the rest are searched for
+    searched = [orgid for method, args in storage.calls if method == "find_orgids" for orgid in args]
+    assert sorted(searched) == ["GB-CHC-999", "GB-COH-00001234", "XI-UNKNOWN-1"]
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from spill_store import SpillStore
+
+
+@pytest.fixture
+def store(tmpdir):
+    store = SpillStore(cache_size=4, folder=str(tmpdir))
+    yield store
+    store.close()
+
+
+def test_keeps_cache_bounded(store):
+    for i in range(10):
+        store[str(i)] = {"n": i}
+    assert len(store) == 10
+    assert len(store.cache) <= 4
+    assert store["0"] == {"n": 0}
+    assert "3" in store and "10" not in store
+    assert store.get("10") is None
+    with pytest.raises(KeyError):
+        store["10"]
+
+
+def test_changes_are_written_back_on_eviction(store):
+    for i in range(4):
+        store[str(i)] = {"n": i, "names": []}
+    # changed in place, as the import functions do
+    store["0"]["names"].append("first")
+    for i in range(4, 10):
+        store[str(i)] = {"n": i, "names": []}
+    assert "0" not in store.cache
+    assert store["0"]["names"] == ["first"]
+
+    # read back from the file, changed again, then evicted again
+    store["0"]["names"].append("second")
+    for i in range(10, 20):
+        store[str(i)] = {"n": i, "names": []}
+    assert "0" not in store.cache
+    assert store["0"]["names"] == ["first", "second"]
+
+
+def test_values_include_cached_records(store):
+    for i in range(6):
+        store[str(i)] = {"n": i}
+    store["5"]["n"] = 50
+    assert sorted(r["n"] for r in store.values()) == [0, 1, 2, 3, 4, 50]
+    assert dict(store.items())["5"] == {"n": 50}
+
+
+def test_temporary_file_removed(tmpdir):
+    store = SpillStore(cache_size=2, folder=str(tmpdir))
+    store["a"] = {}
+    assert os.path.exists(store.filename)
+    store.close()
+    assert not os.path.exists(store.filename)
@@ -0,0 +1,86 @@
+import pytest
+
+from storage import SQLiteStorage, _include_fields
+
+RECORDS = [
+    {"_id": "123", "known_as": "Village Hall", "alt_names": ["The Hall"], "active": True,
+     "latest_income": 1000, "ccew_number": "123", "org-ids": ["GB-CHC-123"], "geo": {"postcode": "AB1 2CD"}},
+    {"_id": "SC0001", "known_as": "Age Scotland", "alt_names": [], "active": False,
+     "latest_income": 50000, "oscr_number": "SC0001", "company_number": [{"number": "00001234"}],
+     "org-ids": ["GB-SC-SC0001", "GB-COH-00001234"], "geo": {"postcode": "EH1 1AA"}},
+    {"_id": "456", "known_as": "Village Hall Trust", "alt_names": [], "active": True,
+     "latest_income": 10, "ccew_number": "456", "org-ids": ["GB-CHC-456"], "geo": {"postcode": None}},
+]
+
+
+@pytest.fixture
+def storage(tmpdir):
+    filename = str(tmpdir.join("charities.sqlite"))
+    writer = SQLiteStorage(filename, readonly=False)
+    assert writer.bulk(RECORDS) == (3, [])
+    return SQLiteStorage(filename)
+
+
+def test_include_fields():
+    source = {"known_as": "Village Hall", "geo": {"postcode": "AB1 2CD", "location": [0, 0]}}
+    assert _include_fields(source, ["known_as", "geo.postcode", "missing.field"]) == \
+        {"known_as": "Village Hall", "geo": {"postcode": "AB1 2CD"}}
+
+
+def test_get(storage):
+    res = storage.get("123")
+    assert res["found"] and res["_id"] == "123"
+    assert res["_source"]["known_as"] == "Village Hall"
+    assert not storage.get("999")["found"]
+
+
+def test_mget(storage):
+    res = storage.mget(["SC0001", "999", "123"], source_include=["known_as", "geo.postcode"])
+    assert [doc["found"] for doc in res["docs"]] == [True, False, True]
+    assert res["docs"][0]["_source"] == {"known_as": "Age Scotland", "geo": {"postcode": "EH1 1AA"}}
+
+
+def test_bulk_replaces_records(storage):
+    writer = SQLiteStorage(storage.filename, readonly=False)
+    writer.bulk([dict(RECORDS[0], known_as="Town Hall", **{"org-ids": ["GB-CHC-123", "GB-COH-999"]})])
+    assert storage.get("123")["_source"]["known_as"] == "Town Hall"
+    assert [h["_id"] for h in storage.search_template({"params": {"name": "town"}})["hits"]["hits"]] == ["123"]
+    assert storage.find_orgids(["GB-COH-999"])[0][0]["_id"] == "123"
+
+
+def test_search_template(storage):
+    res = storage.search_template({"params": {"name": "village hall"}})
+    hits = res["hits"]["hits"]
+    assert [h["_id"] for h in hits] == ["123", "456"]
+    assert res["hits"]["max_score"] == hits[0]["_score"]
+    assert storage.search_template({"params": {"name": "00001234"}})["hits"]["hits"][0]["_id"] == "SC0001"
+    assert storage.search_template({"params": {"name": ""}})["hits"]["hits"] == []
+
+
+def test_msearch_template(storage):
+    res = storage.msearch_template([{"params": {"name": "scotland"}}, {"params": {"name": "nothing"}}])
+    assert [[h["_id"] for h in r["hits"]["hits"]] for r in res["responses"]] == [["SC0001"], []]
+
+
+def test_find_orgids(storage):
+    hits = storage.find_orgids(["GB-COH-00001234", "GB-CHC-123", "GB-COH-1234"])
+    assert [[h["_id"] for h in r] for r in hits] == [["SC0001"], ["123"], []]
+
+
+def test_completion(storage):
+    assert storage.completion("villa") == [("123", "Village Hall"), ("456", "Village Hall Trust")]
+    assert storage.completion("village hall tr") == [("456", "Village Hall Trust")]
+    assert storage.completion("") == []
+
+
+def test_random_record(storage):
+    for _ in range(10):
+        assert storage.random_record(active=True)["_source"]["active"]
+
+
+def test_scan(storage):
+    assert [(h["_id"], h["_source"]) for h in storage.scan(source_include=["known_as"])] == [
+        ("123", {"known_as": "Village Hall"}),
+        ("SC0001", {"known_as": "Age Scotland"}),
+        ("456", {"known_as": "Village Hall Trust"}),
+    ]